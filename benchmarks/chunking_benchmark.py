@@ -0,0 +1,153 @@
+"""Compare the automatic chunk shapes with the static chunking defaults.
+
+Writes the same synthetic tiled image with the static defaults and with
+`chunking="auto"` for each access profile, and reports for the full
+resolution level:
+
+- the write time, the number of chunk files and their mean size,
+- the time to read one z-plane, one tile-sized z-stack and a 256 px block.
+
+Run with:
+
+    python benchmarks/chunking_benchmark.py --grid 4 --tile-size 1024 --num-z 20
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+from fractal_converters_tools import (
+    OriginDict,
+    Point,
+    SimplePathBuilder,
+    Tile,
+    TiledImage,
+    Vector,
+)
+from fractal_converters_tools._stitching import standard_stitching_pipe
+from ngio import PixelSize, open_ome_zarr_container
+
+from nd2_omezarr_converter.image_writers import write_tiled_image
+
+LAYOUTS = {
+    "static": {},
+    "auto per-plane": {"chunking": "auto", "access_profile": "per-plane"},
+    "auto per-timepoint": {"chunking": "auto", "access_profile": "per-timepoint"},
+    "auto volumetric": {"chunking": "auto", "access_profile": "volumetric"},
+}
+
+
+class ArrayTileLoader:
+    """Tile loader returning an in-memory array."""
+
+    def __init__(self, data):
+        """Initialize the loader with the tile data."""
+        self.data = data
+
+    @property
+    def dtype(self):
+        """Data type of the tile."""
+        return str(self.data.dtype)
+
+    def load(self):
+        """Load the tile data."""
+        return self.data
+
+
+def synthetic_tiled_image(grid: int, tile_size: int, num_z: int) -> TiledImage:
+    """A grid of identical 2 channel uint16 tiles of smooth signal and noise."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:tile_size, :tile_size]
+    signal = 1000 + 500 * np.sin(x / 37.0) * np.cos(y / 53.0)
+    data = signal + rng.normal(0, 50, (1, 2, num_z, tile_size, tile_size))
+    data = np.clip(data, 0, 65535).astype(np.uint16)
+
+    pixel_size = 0.5
+    tiled_image = TiledImage(
+        name="benchmark",
+        path_builder=SimplePathBuilder(path="benchmark"),
+        channel_names=["DAPI", "GFP"],
+        wavelength_ids=["450", "510"],
+    )
+    extent = tile_size * pixel_size
+    for i in range(grid):
+        for j in range(grid):
+            tiled_image.add_tile(
+                Tile(
+                    top_l=Point(x=i * extent, y=j * extent, z=0, c=0, t=0),
+                    diag=Vector(x=extent, y=extent, z=num_z, c=2, t=1),
+                    pixel_size=PixelSize(x=pixel_size, y=pixel_size, z=1),
+                    origin=OriginDict(),
+                    data_loader=ArrayTileLoader(data),
+                )
+            )
+    return tiled_image
+
+
+def _timed(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def run(grid: int, tile_size: int, num_z: int, out_dir: Path) -> None:
+    """Write and read the benchmark image with each layout."""
+    tiled_image = synthetic_tiled_image(grid, tile_size, num_z)
+    print(
+        f"{'layout':20s} {'chunks (c,z,y,x)':>22s} {'write s':>8s} {'files':>6s} "
+        f"{'MB/file':>8s} {'plane s':>8s} {'stack s':>8s} {'block s':>8s}"
+    )
+    for k, (name, options) in enumerate(LAYOUTS.items()):
+        zarr_url = out_dir / f"{k}.zarr"
+        write_s = _timed(
+            lambda zarr_url=zarr_url, options=options: write_tiled_image(
+                zarr_url=zarr_url,
+                tiled_image=tiled_image,
+                stiching_pipe=partial(standard_stitching_pipe, mode="grid"),
+                num_levels=3,
+                **options,
+            )
+        )
+        array = open_ome_zarr_container(zarr_url).get_image().zarr_array
+        files = [
+            Path(root) / f
+            for root, _, names in os.walk(zarr_url / "0")
+            for f in names
+            if not f.startswith(".")
+        ]
+        file_mb = np.mean([f.stat().st_size for f in files]) / 1e6
+        plane_s = _timed(lambda array=array: array[0, num_z // 2])
+        stack_s = _timed(lambda array=array: array[0, :, :tile_size, :tile_size])
+        block_s = _timed(lambda array=array: array[0, :, 1000:1256, 1000:1256])
+        print(
+            f"{name:20s} {array.chunks!s:>22s} {write_s:8.2f} {len(files):6d} "
+            f"{file_mb:8.2f} {plane_s:8.3f} {stack_s:8.3f} {block_s:8.3f}"
+        )
+
+
+def main():
+    """Command line entry point of the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--grid", type=int, default=4, help="Tiles per side.")
+    parser.add_argument("--tile-size", type=int, default=1024, help="Tile size (px).")
+    parser.add_argument("--num-z", type=int, default=20, help="Number of z-planes.")
+    parser.add_argument(
+        "--out-dir", type=Path, default=None, help="Output directory (default: tmp)."
+    )
+    args = parser.parse_args()
+    out_dir = args.out_dir or Path(tempfile.mkdtemp(prefix="chunking_benchmark_"))
+    out_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        run(args.grid, args.tile_size, args.num_z, out_dir)
+    finally:
+        if args.out_dir is None:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
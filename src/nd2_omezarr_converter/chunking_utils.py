@@ -0,0 +1,94 @@
+"""Automatic choice of the chunk shape of the converted images.
+
+The static chunking options apply the same chunk shape to every image. With
+`chunking="auto"`, the chunk shape is chosen per image from the shape of its
+tiles, its data type and the way the image is read downstream:
+
+- "per-plane": one z-plane of one time point and channel at a time (2D
+  viewers, 2D segmentation).
+- "per-timepoint": the whole z-stack of one time point and channel.
+- "volumetric": 3D blocks of a z-stack (3D viewers, 3D processing).
+
+The chunks hold a single channel and time point, and never span more than a
+tile in y and x, so that each tile is written as whole chunks. Within these
+limits, the chunks are shrunk until they are smaller than the target size.
+"""
+
+import logging
+import math
+from typing import Literal
+
+logger = logging.getLogger(__name__)
+
+AccessProfile = Literal["per-plane", "per-timepoint", "volumetric"]
+
+DEFAULT_TARGET_CHUNK_MB = 16.0
+
+
+def _halve(size: int) -> int:
+    return max(1, math.ceil(size / 2))
+
+
+def auto_chunk_shape(
+    tile_shape: tuple[int, int, int, int, int],
+    itemsize: int,
+    access_profile: AccessProfile = "per-plane",
+    target_chunk_mb: float = DEFAULT_TARGET_CHUNK_MB,
+) -> tuple[int, int, int, int, int]:
+    """Choose the chunk shape of an image, and log the choice.
+
+    The y and x chunk sizes are kept equal (up to the tile size), as for the
+    static `max_xy_chunk` option.
+
+    Args:
+        tile_shape (tuple[int, int, int, int, int]): (t, c, z, y, x) shape of
+            the tiles of the image.
+        itemsize (int): Size in bytes of a pixel.
+        access_profile (AccessProfile): How the image is read downstream.
+        target_chunk_mb (float): Maximum size of an (uncompressed) chunk in MB.
+
+    Returns:
+        tuple[int, int, int, int, int]: The (t, c, z, y, x) chunk shape.
+    """
+    _, _, size_z, size_y, size_x = tile_shape
+    target = target_chunk_mb * 1e6
+    tile_xy = max(size_y, size_x)
+    xy = tile_xy
+
+    def nbytes(z: int, xy: int) -> int:
+        return z * min(size_y, xy) * min(size_x, xy) * itemsize
+
+    if access_profile == "per-plane":
+        z = 1
+        reason = "single z-planes"
+    elif access_profile == "per-timepoint":
+        z = size_z
+        reason = "whole z-stacks"
+    elif access_profile == "volumetric":
+        z = size_z
+        reason = "blocks as close to cubes as the target size allows"
+        # shrink the longest side first
+        while nbytes(z, xy) > target and max(z, xy) > 1:
+            if z > xy:
+                z = _halve(z)
+            else:
+                xy = _halve(xy)
+    else:
+        raise ValueError(f"Unknown access profile {access_profile}.")
+
+    while nbytes(z, xy) > target and xy > 1:
+        xy = _halve(xy)
+
+    if xy < tile_xy:
+        reason += f", tiles split in {xy} px squares"
+    elif nbytes(z, xy) < target / 2:
+        reason += ", whole tiles (below the target, chunks never span tiles)"
+    else:
+        reason += ", whole tiles"
+    chunks = (1, 1, z, min(size_y, xy), min(size_x, xy))
+    logger.info(
+        f"Auto chunking for {access_profile} access: (t, c, z, y, x) chunks "
+        f"{chunks}, {nbytes(z, xy) / 1e6:.2f} MB per chunk (target "
+        f"{target_chunk_mb} MB), {reason}."
+    )
+    return chunks
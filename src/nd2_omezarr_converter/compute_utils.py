@@ -0,0 +1,159 @@
+"""Tools to convert a single nd2 tiled image in the compute task."""
+
+import logging
+from collections.abc import Mapping
+from functools import partial
+from pathlib import Path
+
+from fractal_converters_tools import PlatePathBuilder
+from fractal_converters_tools._pkl_utils import remove_pkl
+
+from nd2_omezarr_converter.image_writers import write_tiled_image
+from nd2_omezarr_converter.init_utils import projected_path_builder
+from nd2_omezarr_converter.nd2_utils import set_decode_threads
+from nd2_omezarr_converter.profiling_utils import profile_name, profile_run
+from nd2_omezarr_converter.stitching_utils import nd2_stitching_pipe
+from nd2_omezarr_converter.task_models import ConvertNd2InitArgs
+from nd2_omezarr_converter.tile_descriptors import load_saved_tiled_image
+
+logger = logging.getLogger(__name__)
+
+
+def compute_tiled_image(
+    *,
+    zarr_url: str,
+    init_args: ConvertNd2InitArgs,
+) -> dict:
+    """Convert the pickled tiled image of the init task to OME-Zarr.
+
+    This follows `fractal_converters_tools.generic_compute_task`, but writes
+    the image with the nd2 writers, which compute the channel display windows
+    while the data is written, and optionally write the z projection of the
+    image from the same data.
+
+    Args:
+        zarr_url (str): URL to the OME-Zarr file.
+        init_args (ConvertNd2InitArgs): Arguments for the initialization task.
+    """
+    pickle_path = Path(init_args.tiled_image_pickled_path)
+    tiled_image = load_saved_tiled_image(pickle_path)
+    set_decode_threads(init_args.advanced_compute_options.num_decode_threads)
+
+    projection = init_args.advanced_compute_options.projection
+    projection = None if projection == "none" else projection
+    projection_builder = None
+    projection_zarr_url = None
+    if projection is not None:
+        projection_builder = projected_path_builder(
+            tiled_image.path_builder, suffix=f"_{projection}"
+        )
+        zarr_dir = zarr_url.removesuffix(tiled_image.path).rstrip("/")
+        projection_zarr_url = f"{zarr_dir}/{projection_builder.path}"
+
+    try:
+        stitching_pipe = partial(
+            nd2_stitching_pipe,
+            mode=init_args.advanced_compute_options.tiling_mode,
+            swap_xy=init_args.advanced_compute_options.swap_xy,
+            invert_x=init_args.advanced_compute_options.invert_x,
+            invert_y=init_args.advanced_compute_options.invert_y,
+        )
+
+        im_list_types = write_tiled_image(
+            zarr_url=zarr_url,
+            tiled_image=tiled_image,
+            stiching_pipe=stitching_pipe,
+            num_levels=init_args.advanced_compute_options.num_levels,
+            max_xy_chunk=init_args.advanced_compute_options.max_xy_chunk,
+            z_chunk=init_args.advanced_compute_options.z_chunk,
+            c_chunk=init_args.advanced_compute_options.c_chunk,
+            t_chunk=init_args.advanced_compute_options.t_chunk,
+            overwrite=init_args.overwrite,
+            projection=projection,
+            projection_zarr_url=projection_zarr_url,
+            num_workers=init_args.advanced_compute_options.num_writer_processes,
+            streaming_pyramid=init_args.advanced_compute_options.streaming_pyramid,
+            chunking=init_args.advanced_compute_options.chunking,
+            access_profile=init_args.advanced_compute_options.access_profile,
+            target_chunk_mb=init_args.advanced_compute_options.target_chunk_mb,
+        )
+    except Exception as e:
+        remove_pkl(pickle_path)
+        logger.error(f"An error occurred while processing {tiled_image}.")
+        logger.exception(e)
+        raise e
+
+    if isinstance(tiled_image.path_builder, PlatePathBuilder):
+        plate_attributes = {
+            "well": f"{tiled_image.path_builder.row}{tiled_image.path_builder.column}",
+            "plate": tiled_image.path_builder.plate_path,
+            "acquisition": str(tiled_image.path_builder.acquisition_id),
+        }
+        tiled_image.update_attributes(plate_attributes)
+
+    remove_pkl(pickle_path)
+
+    image_list_updates = [
+        {
+            "zarr_url": zarr_url,
+            "types": im_list_types[str(Path(zarr_url))],
+            "attributes": tiled_image.attributes,
+        }
+    ]
+    if projection_zarr_url in im_list_types:
+        attributes = dict(tiled_image.attributes)
+        if isinstance(projection_builder, PlatePathBuilder):
+            attributes["plate"] = projection_builder.plate_path
+        image_list_updates.append(
+            {
+                "zarr_url": projection_zarr_url,
+                "origin": zarr_url,
+                "types": im_list_types[projection_zarr_url],
+                "attributes": attributes,
+            }
+        )
+    return {"image_list_updates": image_list_updates}
+
+
+def compute_batched_tiled_images(
+    *,
+    zarr_url: str,
+    init_args: ConvertNd2InitArgs,
+    profile_settings: Mapping[str, str] | None = None,
+) -> dict:
+    """Convert the image of a compute job and the images batched with it.
+
+    The images are converted in turn in the same process, and the image list
+    updates of all of them are returned together. Each image is profiled
+    separately when profiling is enabled (see `profiling_utils`).
+
+    Args:
+        zarr_url (str): URL to the OME-Zarr file of the first image.
+        init_args (ConvertNd2InitArgs): Arguments for the initialization task.
+        profile_settings (Mapping[str, str] | None): Profiling variables of the
+            job, if not taken from the environment of the process.
+    """
+    jobs = [(zarr_url, init_args.model_copy(update={"batched_images": []}))]
+    for batched_image in init_args.batched_images:
+        batched_init_args = init_args.model_copy(
+            update={
+                "tiled_image_pickled_path": batched_image.tiled_image_pickled_path,
+                "batched_images": [],
+            }
+        )
+        jobs.append((batched_image.zarr_url, batched_init_args))
+
+    image_list_updates = []
+    for i, (job_zarr_url, job_init_args) in enumerate(jobs):
+        try:
+            with profile_run(profile_name(job_zarr_url), profile_settings):
+                updates = compute_tiled_image(
+                    zarr_url=job_zarr_url, init_args=job_init_args
+                )
+        except Exception:
+            # the pickles of the images not converted yet are not needed anymore
+            for _, remaining_init_args in jobs[i + 1 :]:
+                remove_pkl(Path(remaining_init_args.tiled_image_pickled_path))
+            raise
+        image_list_updates.extend(updates["image_list_updates"])
+    return {"image_list_updates": image_list_updates}
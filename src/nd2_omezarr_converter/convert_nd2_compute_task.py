@@ -3,9 +3,12 @@
 import logging
 import time
 
-from fractal_converters_tools import ConvertParallelInitArgs, generic_compute_task
 from pydantic import validate_call
 
+from nd2_omezarr_converter.compute_utils import compute_batched_tiled_images
+from nd2_omezarr_converter.task_models import ConvertNd2InitArgs
+from nd2_omezarr_converter.worker_service import submit_job, worker_socket_path
+
 logger = logging.getLogger(__name__)
 
 
@@ -14,7 +17,7 @@ def convert_nd2_compute_task(
     *,
     # Fractal parameters
     zarr_url: str,
-    init_args: ConvertParallelInitArgs,
+    init_args: ConvertNd2InitArgs,
 ):
     """Compute task to convert a nd2 acquisition to OME-Zarr.
 
@@ -23,13 +26,29 @@ def convert_nd2_compute_task(
         init_args (ConvertScanrInitArgs): Arguments for the initialization task.
     """
     timer = time.time()
-    img_list_update = generic_compute_task(
-        zarr_url=zarr_url,
-        init_args=init_args,
-    )
-    zarr_output = img_list_update["image_list_updates"][0]["zarr_url"]
+    img_list_update = None
+    worker_socket = worker_socket_path()
+    if worker_socket is not None:
+        try:
+            img_list_update = submit_job(
+                worker_socket, zarr_url=zarr_url, init_args=init_args.model_dump()
+            )
+            logger.info(f"Converted by the worker service at {worker_socket}")
+        except OSError as e:
+            logger.warning(
+                f"Worker service at {worker_socket} not reachable ({e}), "
+                "converting in this process."
+            )
+    if img_list_update is None:
+        img_list_update = compute_batched_tiled_images(
+            zarr_url=zarr_url,
+            init_args=init_args,
+        )
+    zarr_outputs = [
+        update["zarr_url"] for update in img_list_update["image_list_updates"]
+    ]
     run_time = time.time() - timer
-    logger.info(f"Succesfully converted: {zarr_output}, in {run_time:.2f}[s]")
+    logger.info(f"Succesfully converted: {zarr_outputs}, in {run_time:.2f}[s]")
     return img_list_update
 
 
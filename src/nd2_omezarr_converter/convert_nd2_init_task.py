@@ -3,16 +3,18 @@
 import logging
 from pathlib import Path
 
-from fractal_converters_tools import (
-    AdvancedComputeOptions,
-    PlatePathBuilder,
-    SimplePathBuilder,
+from fractal_converters_tools import PlatePathBuilder, SimplePathBuilder
+from pydantic import BaseModel, Field, validate_call
+
+from nd2_omezarr_converter.init_utils import (
     build_parallelization_list,
     initiate_ome_zarr_plates,
+    order_tiled_images,
+    projected_tiled_images,
 )
-from pydantic import BaseModel, Field, validate_call
-
 from nd2_omezarr_converter.nd2_utils import parse_nd2_acquisition
+from nd2_omezarr_converter.profiling_utils import profile_name, profile_run
+from nd2_omezarr_converter.task_models import AdvancedOptions
 
 logger = logging.getLogger(__name__)
 
@@ -27,40 +29,47 @@ class Nd2InputModel(BaseModel):
             nd2 file name or folder name.
         acquisition_id: Acquisition ID, used to identify multiple rounds
             of acquisitions for the same plate.
+        channels (Optional[list[str | int]]): Channels to convert, given by
+            channel name or index. If not provided, all channels are converted.
+        positions (Optional[list[int]]): Indices of the XY positions to convert.
+            If not provided, all positions are converted.
+        t_start (int): Index of the first timepoint to convert.
+        t_stop (Optional[int]): Index after the last timepoint to convert.
+            If not provided, all timepoints from t_start on are converted.
+        z_start (int): Index of the first z-plane to convert.
+        z_stop (Optional[int]): Index after the last z-plane to convert.
+            If not provided, all z-planes from z_start on are converted.
+        recursive (bool): Search the folder recursively for nd2 files. The
+            timestamped folders of a NIS-Elements JOBS export with the same
+            parent folder are converted as acquisitions of a single plate,
+            numbered from acquisition_id. Other plate folders are converted as
+            separate plates, and the remaining folders as folders of nd2 files.
     """
 
     path: str
     plate_name: str | None = None
     acquisition_id: int = Field(default=0, ge=0)
-
-
-class AdvancedOptions(AdvancedComputeOptions):
-    """Advanced options for the conversion.
-
-    Attributes:
-        num_levels (int): The number of resolution levels in the pyramid.
-        tiling_mode (Literal["auto", "grid", "free", "none"]): Specify the tiling mode.
-            "auto" will automatically determine the tiling mode.
-            "grid" if the input data is a grid, it will be tiled using snap-to-grid.
-            "free" will remove any overlap between tiles using a snap-to-corner
-            approach.
-            "none" will write the positions as is, using the microscope metadata.
-        swap_xy (bool): Swap x and y axes coordinates in the metadata. This is sometimes
-            necessary to ensure correct image tiling and registration.
-        invert_x (bool): Invert x axis coordinates in the metadata. This is
-            sometimes necessary to ensure correct image tiling and registration.
-        invert_y (bool): Invert y axis coordinates in the metadata. This is
-            sometimes necessary to ensure correct image tiling and registration.
-        max_xy_chunk (int): XY chunk size is set as the minimum of this value and the
-            microscope tile size.
-        z_chunk (int): Z chunk size.
-        c_chunk (int): C chunk size.
-        t_chunk (int): T chunk size.
-    """
-
-    # set invert_y to True by default
-    # (for use with ZMB Nikon SD microscope, test for others)
-    invert_y: bool = True
+    channels: list[str | int] | None = None
+    positions: list[int] | None = None
+    t_start: int = Field(default=0, ge=0)
+    t_stop: int | None = Field(default=None, ge=1)
+    z_start: int = Field(default=0, ge=0)
+    z_stop: int | None = Field(default=None, ge=1)
+    recursive: bool = False
+
+    @property
+    def t_slice(self) -> slice | None:
+        """Slice of the selected timepoints, None if all are selected."""
+        if self.t_start == 0 and self.t_stop is None:
+            return None
+        return slice(self.t_start, self.t_stop)
+
+    @property
+    def z_slice(self) -> slice | None:
+        """Slice of the selected z-planes, None if all are selected."""
+        if self.z_start == 0 and self.z_stop is None:
+            return None
+        return slice(self.z_start, self.z_stop)
 
 
 @validate_call
@@ -91,43 +100,81 @@ def convert_nd2_init_task(
         logger.info(f"Creating directory: {zarr_dir_path}")
         zarr_dir_path.mkdir(parents=True)
 
-    # prepare the parallel list of zarr urls
-    tiled_images = []
-    for acq in acquisitions:
-        _tiled_images = parse_nd2_acquisition(
-            acq_path=Path(acq.path),
-            plate_name=acq.plate_name,
-            acquisition_id=acq.acquisition_id,
-        )
-
-        if not _tiled_images:
-            logger.warning(f"No images found in {acq.path}")
-            continue
-        tiled_images.extend(list(_tiled_images))
-
-    # Common fractal-converters-tools functions
-    parallelization_list = build_parallelization_list(
-        zarr_dir=zarr_dir_path,
-        tiled_images=tiled_images,
-        overwrite=overwrite,
-        advanced_compute_options=advanced_options,
-    )
-    logger.info(f"Total {len(parallelization_list)} images to convert.")
-
-    types = {type(tiled_image.path_builder) for tiled_image in tiled_images}
-    if types == {PlatePathBuilder}:
-        initiate_ome_zarr_plates(
+    with profile_run(f"{profile_name(zarr_dir)}_init"):
+        # prepare the parallel list of zarr urls
+        tiled_images = []
+        for acq in acquisitions:
+            z_slice = acq.z_slice
+            if advanced_options.z_step > 1:
+                z_slice = slice(acq.z_start, acq.z_stop, advanced_options.z_step)
+            _tiled_images = parse_nd2_acquisition(
+                acq_path=Path(acq.path),
+                plate_name=acq.plate_name,
+                acquisition_id=acq.acquisition_id,
+                channels=acq.channels,
+                positions=acq.positions,
+                t_slice=acq.t_slice,
+                z_slice=z_slice,
+                xy_binning=advanced_options.xy_binning,
+                binning_reducer=advanced_options.binning_reducer,
+                output_dtype=(
+                    None
+                    if advanced_options.output_dtype == "source"
+                    else advanced_options.output_dtype
+                ),
+                rescale_percentiles=(
+                    advanced_options.rescale_low_percentile,
+                    advanced_options.rescale_high_percentile,
+                ),
+                rescale_sample_frames=advanced_options.rescale_sample_frames,
+                recursive=acq.recursive,
+            )
+
+            if not _tiled_images:
+                logger.warning(f"No images found in {acq.path}")
+                continue
+            tiled_images.extend(list(_tiled_images))
+
+        # largest jobs first, jobs reading the same file back to back
+        parallelization_list = build_parallelization_list(
             zarr_dir=zarr_dir_path,
-            tiled_images=tiled_images,
+            tiled_images=order_tiled_images(tiled_images),
             overwrite=overwrite,
+            advanced_compute_options=advanced_options,
+            max_images_per_job=advanced_options.max_images_per_job,
+            max_bytes_per_job=advanced_options.max_job_size_mb * 1e6,
         )
-        logger.info(f"Initialized OME-Zarr Plate at: {zarr_dir_path}")
-    elif types == {SimplePathBuilder, PlatePathBuilder}:
-        raise ValueError(
-            "Detected some plate acquisitions and some non-plate acquisitions. "
-            "This is currently not supported. Please run the task separately for "
-            "plate and non-plate acquisitions."
+        logger.info(
+            f"Total {len(tiled_images)} images to convert "
+            f"in {len(parallelization_list)} jobs."
         )
+
+        types = {type(tiled_image.path_builder) for tiled_image in tiled_images}
+        if types == {PlatePathBuilder}:
+            initiate_ome_zarr_plates(
+                zarr_dir=zarr_dir_path,
+                tiled_images=tiled_images,
+                overwrite=overwrite,
+            )
+            logger.info(f"Initialized OME-Zarr Plate at: {zarr_dir_path}")
+            projected = []
+            if advanced_options.projection != "none":
+                projected = projected_tiled_images(
+                    tiled_images, suffix=f"_{advanced_options.projection}"
+                )
+            if projected:
+                initiate_ome_zarr_plates(
+                    zarr_dir=zarr_dir_path,
+                    tiled_images=projected,
+                    overwrite=overwrite,
+                )
+                logger.info(f"Initialized projected OME-Zarr Plate at: {zarr_dir_path}")
+        elif types == {SimplePathBuilder, PlatePathBuilder}:
+            raise ValueError(
+                "Detected some plate acquisitions and some non-plate acquisitions. "
+                "This is currently not supported. Please run the task separately for "
+                "plate and non-plate acquisitions."
+            )
     return {"parallelization_list": parallelization_list}
 
 
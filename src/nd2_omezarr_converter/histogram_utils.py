@@ -0,0 +1,101 @@
+"""Fixed-memory, mergeable per-channel histograms of integer image data."""
+
+import numpy as np
+
+
+class StreamingHistogram:
+    """Per-channel histogram of integer data with a fixed number of bins.
+
+    Each bin counts a single integer value in [0, num_bins). Values above the
+    range are counted in the last bin, so the memory footprint does not depend
+    on the amount of data. Histograms with the same shape can be merged, which
+    makes it possible to accumulate statistics over frames, tiles or images
+    independently and combine them afterwards.
+    """
+
+    def __init__(self, num_channels: int, num_bins: int):
+        """Initialize an empty histogram.
+
+        Args:
+            num_channels (int): Number of channels.
+            num_bins (int): Number of bins (integer values) per channel.
+        """
+        if num_channels < 1 or num_bins < 1:
+            raise ValueError("num_channels and num_bins must be at least 1.")
+        self.counts = np.zeros((num_channels, num_bins), dtype=np.int64)
+
+    @classmethod
+    def for_dtype(cls, num_channels: int, dtype: np.dtype, bits: int | None = None):
+        """Create a histogram covering the range of an unsigned integer dtype.
+
+        Args:
+            num_channels (int): Number of channels.
+            dtype (np.dtype): Data type of the data.
+            bits (int | None): Number of significant bits of the data
+                (e.g. 12 for 12 bit data stored as uint16). If None, the full
+                range of the data type is used.
+        """
+        dtype = np.dtype(dtype)
+        if dtype.kind != "u":
+            raise ValueError(
+                f"Histograms are only supported for unsigned integer data, got {dtype}."
+            )
+        max_bits = dtype.itemsize * 8
+        if max_bits > 16:
+            raise ValueError(f"Data type {dtype} has too many bits for a histogram.")
+        if bits is None or not 0 < bits <= max_bits:
+            bits = max_bits
+        return cls(num_channels=num_channels, num_bins=2**bits)
+
+    @property
+    def num_channels(self) -> int:
+        """Number of channels."""
+        return self.counts.shape[0]
+
+    @property
+    def num_bins(self) -> int:
+        """Number of bins per channel."""
+        return self.counts.shape[1]
+
+    def update(self, channel: int, data: np.ndarray) -> None:
+        """Add the values of an integer array to the histogram of a channel."""
+        counts = np.bincount(data.ravel(), minlength=self.num_bins)
+        if len(counts) > self.num_bins:
+            counts[self.num_bins - 1] += counts[self.num_bins :].sum()
+            counts = counts[: self.num_bins]
+        self.counts[channel] += counts
+
+    def merge(self, other: "StreamingHistogram") -> "StreamingHistogram":
+        """Add the counts of another histogram to this one in place."""
+        if self.counts.shape != other.counts.shape:
+            raise ValueError(
+                f"Cannot merge histograms of shape {other.counts.shape} "
+                f"into {self.counts.shape}."
+            )
+        self.counts += other.counts
+        return self
+
+    def percentiles(self, q: float, ignore_zeros: bool = False) -> list[int]:
+        """Get the q-th percentile (0 to 100) of each channel.
+
+        Args:
+            q (float): Percentile to compute.
+            ignore_zeros (bool): Exclude zero valued pixels from the computation.
+
+        Empty channels return 0.
+        """
+        if not 0 <= q <= 100:
+            raise ValueError(f"Percentile must be in [0, 100], got {q}.")
+        counts = self.counts
+        if ignore_zeros:
+            counts = counts.copy()
+            counts[:, 0] = 0
+        cumulative = np.cumsum(counts, axis=1)
+        total = cumulative[:, -1]
+        # first bin whose cumulative count reaches the requested fraction
+        targets = np.maximum(np.ceil(total * q / 100), 1)
+        values = [
+            int(np.searchsorted(cum, target)) if tot > 0 else 0
+            for cum, target, tot in zip(cumulative, targets, total, strict=True)
+        ]
+        return values
@@ -0,0 +1,614 @@
+"""OME-Zarr image writers for nd2 tiled images."""
+
+import logging
+import multiprocessing
+import traceback
+from collections.abc import Callable
+from pathlib import Path
+from typing import Literal
+
+import numpy as np
+from fractal_converters_tools import OriginDict, Point, Tile, TiledImage
+from fractal_converters_tools._omezarr_image_writers import (
+    apply_stitching_pipe,
+    init_empty_ome_zarr_image,
+)
+from ngio import OmeZarrContainer, RoiPixels, open_ome_zarr_container
+from ngio.tables import RoiTable
+
+from nd2_omezarr_converter.chunking_utils import (
+    DEFAULT_TARGET_CHUNK_MB,
+    AccessProfile,
+    auto_chunk_shape,
+)
+from nd2_omezarr_converter.histogram_utils import StreamingHistogram
+from nd2_omezarr_converter.nd2_utils import binned_dtype
+from nd2_omezarr_converter.pyramid_utils import StreamingPyramid, rects_overlap, z_order
+from nd2_omezarr_converter.shared_memory_utils import (
+    SharedMemoryRing,
+    get_with_liveness_check,
+    shared_array,
+)
+
+logger = logging.getLogger(__name__)
+
+WINDOW_PERCENTILES = (1, 99.9)
+
+Projection = Literal["mip", "mean", "sum"]
+
+
+def projected_dtype(dtype: np.dtype, projection: Projection) -> np.dtype:
+    """Get the data type of the z projection of data.
+
+    As for binning, summing integer data promotes it to (at least) 32 bit.
+    """
+    return binned_dtype(dtype, "sum" if projection == "sum" else "max")
+
+
+def project_z(data: np.ndarray, projection: Projection) -> np.ndarray:
+    """Project (t, c, z, y, x) data along z, keeping a singleton z axis."""
+    if projection == "mip":
+        return data.max(axis=2, keepdims=True)
+    if projection == "sum":
+        return data.sum(
+            axis=2, keepdims=True, dtype=projected_dtype(data.dtype, projection)
+        )
+    if projection == "mean":
+        projected = data.mean(axis=2, keepdims=True)
+        if data.dtype.kind in "ui":
+            projected = np.rint(projected)
+        return projected.astype(data.dtype)
+    raise ValueError(f"Unknown projection {projection}.")
+
+
+def _new_channel_histogram(num_channels: int, dtype) -> StreamingHistogram | None:
+    """Create a histogram for the tile data, None if the dtype is not supported."""
+    try:
+        return StreamingHistogram.for_dtype(num_channels=num_channels, dtype=dtype)
+    except ValueError:
+        return None
+
+
+def set_channel_windows(
+    ome_zarr_container: OmeZarrContainer,
+    histogram: StreamingHistogram,
+    percentiles: tuple[float, float] = WINDOW_PERCENTILES,
+) -> None:
+    """Set the omero channel windows from the percentiles of a histogram.
+
+    As in `ngio`, zero valued pixels are ignored, since they mostly come from
+    the regions of the image that are not covered by any tile.
+    """
+    starts = histogram.percentiles(percentiles[0], ignore_zeros=True)
+    ends = histogram.percentiles(percentiles[1], ignore_zeros=True)
+    minima = histogram.percentiles(0)
+    maxima = histogram.percentiles(100)
+
+    channels = ome_zarr_container.image_meta.channels_meta.channels
+    for c, channel in enumerate(channels):
+        logger.info(
+            f"Channel {channel.label}: min={minima[c]}, max={maxima[c]}, "
+            f"window=[{starts[c]}, {ends[c]}]"
+        )
+    # the channels are rebuilt by ngio, keep their labels, colors, etc.
+    ome_zarr_container.images_container.set_channel_meta(
+        labels=[channel.label for channel in channels],
+        wavelength_id=[channel.wavelength_id for channel in channels],
+        start=[float(start) for start in starts],
+        end=[float(end) for end in ends],
+        colors=[channel.channel_visualisation.color for channel in channels],
+        active=[channel.channel_visualisation.active for channel in channels],
+    )
+
+
+def _tile_rects(tiles: list[Tile]) -> np.ndarray:
+    """Get the (y, x, height, width) rectangles of tiles in pixel space."""
+    return np.array(
+        [
+            (int(tile.top_l.y), int(tile.top_l.x), tile.shape[-2], tile.shape[-1])
+            for tile in tiles
+        ],
+        dtype=np.int64,
+    ).reshape(-1, 4)
+
+
+def can_stream_pyramid(ome_zarr_container: OmeZarrContainer, tiles: list[Tile]) -> bool:
+    """Check if the pyramid of an image can be built while its tiles are written.
+
+    The tiles must not overlap, and must span all the z-planes, channels and
+    time points of the image (see `StreamingPyramid`).
+    """
+    image = ome_zarr_container.get_image()
+    shape = dict(zip(image.axes_mapper.on_disk_axes_names, image.shape, strict=True))
+    for tile in tiles:
+        t, c, z, _, _ = tile.shape
+        if (
+            int(tile.top_l.z) != 0
+            or int(tile.top_l.t) != 0
+            or int(tile.top_l.c) != 0
+            or z != shape.get("z", 1)
+            or c != shape.get("c", 1)
+            or t != shape.get("t", 1)
+        ):
+            logger.info("Tiles do not span the whole image, consolidating the pyramid.")
+            return False
+    if rects_overlap(_tile_rects(tiles)):
+        logger.info("Tiles overlap, consolidating the pyramid.")
+        return False
+    return True
+
+
+def tile_write_order(tiles: list[Tile], streaming_pyramid: bool = False) -> list[int]:
+    """Get the order in which the tiles are written.
+
+    With a streaming pyramid, the tiles are written along a Z-order curve, so
+    that the blocks and chunks of the lower levels are completed early.
+    """
+    if not streaming_pyramid:
+        return list(range(len(tiles)))
+    return z_order(_tile_rects(tiles)).tolist()
+
+
+class _RoiWriter:
+    """Write tiles as ROIs in an image, accumulating the channel histograms."""
+
+    def __init__(
+        self,
+        ome_zarr_container: OmeZarrContainer,
+        projection: Projection | None = None,
+        streaming_pyramid: bool = False,
+    ):
+        self.ome_zarr_container = ome_zarr_container
+        self.image = ome_zarr_container.get_image()
+        self.projection = projection
+        self.squeeze_t = not ome_zarr_container.is_time_series
+        self.histogram = _new_channel_histogram(
+            self.image.num_channels, self.image.dtype
+        )
+        self.fov_rois = []
+        self.pyramid = None
+        if streaming_pyramid:
+            levels = [
+                ome_zarr_container.get_image(path=path).zarr_array
+                for path in ome_zarr_container.levels_paths[1:]
+            ]
+            self.pyramid = StreamingPyramid(
+                self.image.zarr_array, levels, order=self.pyramid_order
+            )
+
+    @property
+    def pyramid_order(self) -> int:
+        """Interpolation order of the pyramid, 0 for time series."""
+        return 1 if self.squeeze_t else 0
+
+    def _project(self, tile_data: np.ndarray, top_l: Point) -> tuple[np.ndarray, int]:
+        """Get the data written for a tile, and its z position."""
+        if self.projection is not None:
+            return project_z(tile_data, self.projection), 0
+        return tile_data, int(top_l.z)
+
+    def write(
+        self, tile_data: np.ndarray, top_l: Point, origin: OriginDict, index: int
+    ) -> None:
+        """Write the (t, c, z, y, x) data of a tile at its top left corner."""
+        tile_data, z = self._project(tile_data, top_l)
+        _, s_c, s_z, s_y, s_x = tile_data.shape
+
+        if self.histogram is not None:
+            for c in range(s_c):
+                self.histogram.update(c, tile_data[:, c])
+
+        tile_data = tile_data[0] if self.squeeze_t else tile_data
+        roi_pix = RoiPixels(
+            name=f"FOV_{index}",
+            x=int(top_l.x),
+            y=int(top_l.y),
+            z=z,
+            x_length=s_x,
+            y_length=s_y,
+            z_length=s_z,
+            **origin._asdict(),
+        )
+        roi = roi_pix.to_roi(pixel_size=self.image.pixel_size)
+        self.fov_rois.append((index, roi))
+        self.image.set_roi(roi=roi, patch=tile_data)
+        if self.pyramid is not None:
+            self.pyramid.add_tile(tile_data, y0=int(top_l.y), x0=int(top_l.x))
+
+    def add_to_pyramid(self, tile_data: np.ndarray, top_l: Point) -> None:
+        """Add the data of a tile written by another process to the pyramid."""
+        tile_data, _ = self._project(tile_data, top_l)
+        tile_data = tile_data[0] if self.squeeze_t else tile_data
+        self.pyramid.add_tile(tile_data, y0=int(top_l.y), x0=int(top_l.x))
+
+    def merge(self, other: "_RoiWriter") -> None:
+        """Add the ROIs and histograms of a writer of the same image."""
+        self.fov_rois.extend(other.fov_rois)
+        if self.histogram is not None and other.histogram is not None:
+            self.histogram.merge(other.histogram)
+
+    def __getstate__(self) -> dict:
+        """Only the ROIs and histograms are sent between processes."""
+        return {"fov_rois": self.fov_rois, "histogram": self.histogram}
+
+    def finalize(self) -> None:
+        """Build the pyramid, set the channel windows and the FOV ROI table."""
+        if self.pyramid is not None:
+            self.pyramid.finalize()
+        else:
+            self.image.consolidate(order=self.pyramid_order)
+        if self.histogram is not None:
+            set_channel_windows(self.ome_zarr_container, self.histogram)
+        else:
+            # no fixed range histogram for this dtype, read the lowest level back
+            self.ome_zarr_container.set_channel_percentiles(
+                start_percentile=WINDOW_PERCENTILES[0],
+                end_percentile=WINDOW_PERCENTILES[1],
+            )
+        rois = [roi for _, roi in sorted(self.fov_rois, key=lambda r: r[0])]
+        table = RoiTable(rois=rois)
+        self.ome_zarr_container.add_table("FOV_ROI_table", table=table)
+
+
+def write_tiles_as_rois(
+    ome_zarr_container: OmeZarrContainer,
+    tiles: list[Tile],
+    projection: Projection | None = None,
+    projection_container: OmeZarrContainer | None = None,
+    streaming_pyramid: bool = False,
+):
+    """Write the tiles as ROIs in the image.
+
+    Per-channel histograms of the tile data are accumulated while the tiles
+    are written, and used to set the channel display windows without reading
+    the image back.
+
+    If a projection container is given, the z projection of each tile is
+    written to it from the same data, so the tiles are only loaded once.
+
+    With streaming_pyramid, the lower resolution levels are written from the
+    tile data (see `StreamingPyramid`) instead of being consolidated from the
+    full resolution level once all the tiles are written.
+    """
+    streaming_pyramid = streaming_pyramid and can_stream_pyramid(
+        ome_zarr_container, tiles
+    )
+    writers = [_RoiWriter(ome_zarr_container, streaming_pyramid=streaming_pyramid)]
+    if projection_container is not None:
+        if projection is None:
+            raise ValueError("A projection is required to write a projection image.")
+        writers.append(
+            _RoiWriter(
+                projection_container,
+                projection=projection,
+                streaming_pyramid=streaming_pyramid,
+            )
+        )
+
+    for i in tile_write_order(tiles, streaming_pyramid):
+        # Load the whole tile and set the data in the images
+        tile = tiles[i]
+        tile_data = tile.load()
+        for writer in writers:
+            writer.write(tile_data, top_l=tile.top_l, origin=tile.origin, index=i)
+
+    for writer in writers:
+        writer.finalize()
+    return writers[0].image
+
+
+def _chunk_conflict_groups(tiles: list[Tile], chunk_yx: tuple[int, int]) -> list[int]:
+    """Group the tiles that write to the same zarr chunks.
+
+    Tiles of different groups never touch the same chunk, so they can be
+    written concurrently without corrupting partially written chunks.
+
+    Returns:
+        list[int]: The group index of each tile.
+    """
+    parents = list(range(len(tiles)))
+
+    def find(i: int) -> int:
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    chunk_owner = {}
+    for i, tile in enumerate(tiles):
+        _, _, _, s_y, s_x = tile.shape
+        y0, x0 = int(tile.top_l.y), int(tile.top_l.x)
+        for cy in range(y0 // chunk_yx[0], (y0 + s_y - 1) // chunk_yx[0] + 1):
+            for cx in range(x0 // chunk_yx[1], (x0 + s_x - 1) // chunk_yx[1] + 1):
+                owner = chunk_owner.setdefault((cy, cx), i)
+                parents[find(i)] = find(owner)
+    roots = [find(i) for i in range(len(tiles))]
+    group_ids = {root: g for g, root in enumerate(dict.fromkeys(roots))}
+    return [group_ids[root] for root in roots]
+
+
+def _write_tiles_worker(
+    zarr_urls: list[str],
+    projections: list[Projection | None],
+    slot_names: list[str],
+    tasks,
+    free_slots,
+    results,
+    locks,
+) -> None:
+    """Write the tiles handed over in shared memory by the parent process."""
+    from multiprocessing.shared_memory import SharedMemory
+
+    try:
+        writers = [
+            _RoiWriter(open_ome_zarr_container(zarr_url), projection=projection)
+            for zarr_url, projection in zip(zarr_urls, projections, strict=True)
+        ]
+        slots = [SharedMemory(name=name) for name in slot_names]
+        try:
+            while (task := tasks.get()) is not None:
+                slot, shape, dtype, top_l, origin, index, group = task
+                tile_data = shared_array(slots[slot], shape, dtype)
+                with locks[group % len(locks)]:
+                    for writer in writers:
+                        writer.write(tile_data, top_l=top_l, origin=origin, index=index)
+                del tile_data
+                free_slots.put(slot)
+        finally:
+            for shared_memory in slots:
+                shared_memory.close()
+        results.put(writers)
+    except Exception:
+        results.put(traceback.format_exc())
+        raise
+
+
+def write_tiles_as_rois_parallel(
+    zarr_url: Path | str,
+    tiles: list[Tile],
+    num_workers: int,
+    projection: Projection | None = None,
+    projection_zarr_url: Path | str | None = None,
+    streaming_pyramid: bool = False,
+):
+    """Write the tiles as ROIs using a pool of writer processes.
+
+    The tiles are loaded in this process, one after the other, into a ring of
+    shared memory buffers. The writer processes compress and write the tiles
+    (and their projections) straight from the shared memory, so the tile data
+    is never pickled. At most two tiles per writer are held in memory: the
+    loading waits for a buffer to be released by the writers.
+
+    Tiles that share zarr chunks are never written at the same time. The
+    pyramid, channel windows and ROI tables are built in this process once
+    all the tiles are written, as in `write_tiles_as_rois`. With
+    streaming_pyramid, the writer processes only write the full resolution
+    level, and this process writes the lower levels from the loaded tiles.
+    """
+    containers = [open_ome_zarr_container(zarr_url)]
+    zarr_urls, projections = [str(zarr_url)], [None]
+    if projection_zarr_url is not None:
+        if projection is None:
+            raise ValueError("A projection is required to write a projection image.")
+        containers.append(open_ome_zarr_container(projection_zarr_url))
+        zarr_urls.append(str(projection_zarr_url))
+        projections.append(projection)
+    streaming_pyramid = streaming_pyramid and can_stream_pyramid(containers[0], tiles)
+    writers = [
+        _RoiWriter(
+            container, projection=projection, streaming_pyramid=streaming_pyramid
+        )
+        for container, projection in zip(containers, projections, strict=True)
+    ]
+
+    image = writers[0].image
+    groups = _chunk_conflict_groups(tiles, chunk_yx=image.chunks[-2:])
+    num_workers = min(num_workers, max(groups) + 1)
+    dtype = np.dtype(image.dtype)
+    # allow for the off by one tile shapes tolerated by Tile.load
+    slot_nbytes = max(
+        t * c * z * (y + 1) * (x + 1) * dtype.itemsize
+        for t, c, z, y, x in (tile.shape for tile in tiles)
+    )
+
+    context = multiprocessing.get_context("spawn")
+    tasks, results = context.Queue(), context.Queue()
+    locks = [context.Lock() for _ in range(min(max(groups) + 1, 64))]
+    with SharedMemoryRing(2 * num_workers, slot_nbytes, context) as ring:
+        processes = [
+            context.Process(
+                target=_write_tiles_worker,
+                args=(
+                    zarr_urls,
+                    projections,
+                    ring.names,
+                    tasks,
+                    ring.free_slots,
+                    results,
+                    locks,
+                ),
+                name=f"nd2-writer-{i}",
+                daemon=True,
+            )
+            for i in range(num_workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for i in tile_write_order(tiles, streaming_pyramid):
+                tile = tiles[i]
+                tile_data = tile.load()
+                slot = get_with_liveness_check(ring.free_slots, processes)
+                ring.view(slot, tile_data.shape, dtype)[...] = tile_data
+                tasks.put(
+                    (
+                        slot,
+                        tile_data.shape,
+                        dtype,
+                        tile.top_l,
+                        tile.origin,
+                        i,
+                        groups[i],
+                    )
+                )
+                if streaming_pyramid:
+                    for writer in writers:
+                        writer.add_to_pyramid(tile_data, top_l=tile.top_l)
+            for _ in processes:
+                tasks.put(None)
+
+            for _ in processes:
+                worker_writers = get_with_liveness_check(results, processes)
+                if isinstance(worker_writers, str):
+                    raise RuntimeError(f"Writer process failed:\n{worker_writers}")
+                for writer, worker_writer in zip(writers, worker_writers, strict=True):
+                    writer.merge(worker_writer)
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+    for writer in writers:
+        writer.finalize()
+    return image
+
+
+def init_projection_ome_zarr_image(
+    zarr_url: Path | str,
+    ome_zarr_container: OmeZarrContainer,
+    projection: Projection,
+    overwrite: bool = False,
+) -> OmeZarrContainer:
+    """Initialize an empty image for the z projection of an image.
+
+    The projection has the same metadata as the image, with a single z-plane.
+    """
+    image = ome_zarr_container.get_image()
+    z_axis = image.axes_mapper.get_index("z")
+    shape = list(image.shape)
+    shape[z_axis] = 1
+    chunks = list(image.chunks)
+    chunks[z_axis] = 1
+    return ome_zarr_container.derive_image(
+        store=zarr_url,
+        shape=shape,
+        chunks=chunks,
+        dtype=str(projected_dtype(image.dtype, projection)),
+        overwrite=overwrite,
+    )
+
+
+def write_tiled_image(
+    zarr_url: Path | str,
+    tiled_image: TiledImage,
+    stiching_pipe: Callable[[list[Tile]], list[Tile]],
+    num_levels: int = 5,
+    max_xy_chunk: int = 4096,
+    z_chunk: int = 10,
+    c_chunk: int = 1,
+    t_chunk: int = 1,
+    overwrite: bool = False,
+    projection: Projection | None = None,
+    projection_zarr_url: Path | str | None = None,
+    num_workers: int = 1,
+    streaming_pyramid: bool = False,
+    chunking: Literal["static", "auto"] = "static",
+    access_profile: AccessProfile = "per-plane",
+    target_chunk_mb: float = DEFAULT_TARGET_CHUNK_MB,
+) -> dict[str, dict[str, bool]]:
+    """Build a tiled ome-zarr image from a TiledImage object.
+
+    If a projection and a projection zarr url are given, the z projection of a
+    3D image is written alongside, from the same tile data. With more than one
+    worker, the tiles are written by a pool of processes (see
+    `write_tiles_as_rois_parallel`). With streaming_pyramid, the pyramid
+    levels are written while the tiles are written (see `StreamingPyramid`).
+
+    With "auto" chunking, the chunk shape is chosen from the tiles, the data
+    type and the access profile (see `auto_chunk_shape`) instead of the
+    max_xy_chunk, z_chunk, c_chunk and t_chunk arguments.
+
+    Returns:
+        dict[str, dict[str, bool]]: The image list types of each written image,
+            by zarr url.
+    """
+    tiles = apply_stitching_pipe(tiled_image, stiching_pipe)
+
+    zarr_url = Path(zarr_url)
+    zarr_url.mkdir(parents=True, exist_ok=True)
+
+    pixel_size = tiled_image.pixel_size
+    if pixel_size is None:
+        raise ValueError("Pixel size is not defined in the TiledImage object.")
+
+    if chunking == "auto":
+        t_chunk, c_chunk, z_chunk, y_chunk, x_chunk = auto_chunk_shape(
+            tiles[0].shape,
+            itemsize=np.dtype(tiles[0].dtype()).itemsize,
+            access_profile=access_profile,
+            target_chunk_mb=target_chunk_mb,
+        )
+        max_xy_chunk = max(y_chunk, x_chunk)
+
+    ome_zarr_container = init_empty_ome_zarr_image(
+        zarr_url=zarr_url,
+        tiles=tiles,
+        pixel_size=pixel_size,
+        channel_names=tiled_image.channel_names,
+        wavelength_ids=tiled_image.wavelength_ids,
+        num_levels=num_levels,
+        max_xy_chunk=max_xy_chunk,
+        z_chunk=z_chunk,
+        c_chunk=c_chunk,
+        t_chunk=t_chunk,
+        overwrite=overwrite,
+    )
+    well_roi = ome_zarr_container.build_image_roi_table("Well")
+    ome_zarr_container.add_table("well_ROI_table", table=well_roi)
+
+    projection_container = None
+    if projection is not None and projection_zarr_url is not None:
+        if ome_zarr_container.is_3d:
+            projection_container = init_projection_ome_zarr_image(
+                zarr_url=projection_zarr_url,
+                ome_zarr_container=ome_zarr_container,
+                projection=projection,
+                overwrite=overwrite,
+            )
+            well_roi = projection_container.build_image_roi_table("Well")
+            projection_container.add_table("well_ROI_table", table=well_roi)
+        else:
+            logger.info(f"{zarr_url} has a single z-plane, skipping the projection.")
+
+    # Write the tiles as ROIs in the image
+    if num_workers > 1 and len(tiles) > 1:
+        image = write_tiles_as_rois_parallel(
+            zarr_url=zarr_url,
+            tiles=tiles,
+            num_workers=num_workers,
+            projection=projection,
+            projection_zarr_url=(
+                projection_zarr_url if projection_container is not None else None
+            ),
+            streaming_pyramid=streaming_pyramid,
+        )
+    else:
+        image = write_tiles_as_rois(
+            ome_zarr_container=ome_zarr_container,
+            tiles=tiles,
+            projection=projection,
+            projection_container=projection_container,
+            streaming_pyramid=streaming_pyramid,
+        )
+
+    im_list_types = {
+        str(zarr_url): {"is_3D": image.is_3d, "has_time": image.is_time_series}
+    }
+    if projection_container is not None:
+        im_list_types[str(projection_zarr_url)] = {
+            "is_3D": False,
+            "has_time": image.is_time_series,
+        }
+    return im_list_types
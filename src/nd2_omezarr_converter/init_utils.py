@@ -0,0 +1,353 @@
+"""Tools to build the parallelization list of the nd2 init task."""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from fractal_converters_tools import (
+    AdvancedComputeOptions,
+    PlatePathBuilder,
+    SimplePathBuilder,
+    TiledImage,
+)
+from fractal_converters_tools._pkl_utils import remove_pkl_dir
+from ngio.ome_zarr_meta import (
+    NgioPlateMeta,
+    NgioWellMeta,
+    get_plate_meta_handler,
+    get_well_meta_handler,
+)
+from ngio.utils import ZarrGroupHandler
+
+from nd2_omezarr_converter.task_models import BatchedImageArgs, ConvertNd2InitArgs
+from nd2_omezarr_converter.tile_descriptors import save_tiled_image
+
+logger = logging.getLogger(__name__)
+
+# wells are written concurrently, which pays off on network storage
+PLATE_INIT_WORKERS = 16
+
+
+def projected_path_builder(
+    path_builder: PlatePathBuilder | SimplePathBuilder, suffix: str
+) -> PlatePathBuilder | SimplePathBuilder:
+    """Get the path builder of the projection of an image.
+
+    Projections of plate images are stored in a separate plate with the suffix
+    appended to the plate name, in the same well and acquisition. Other images
+    get the suffix appended to the zarr name.
+    """
+    if isinstance(path_builder, PlatePathBuilder):
+        return PlatePathBuilder(
+            plate_name=f"{path_builder.plate_name}{suffix}",
+            row=path_builder.row,
+            column=path_builder.column,
+            acquisition_id=path_builder.acquisition_id,
+        )
+    path = path_builder.path.removesuffix(".zarr")
+    return SimplePathBuilder(path=f"{path}{suffix}")
+
+
+def projected_tiled_images(
+    tiled_images: list[TiledImage], suffix: str
+) -> list[TiledImage]:
+    """Get empty tiled images pointing to the projections of the tiled images.
+
+    Only the path builders of the returned tiled images are set, which is
+    enough to initialize the plates of the projections. As in
+    `write_tiled_image`, only the tiled images with more than one z-plane are
+    projected.
+    """
+    projected = []
+    for tiled_image in tiled_images:
+        if not tiled_image_is_3d(tiled_image):
+            continue
+        path_builder = projected_path_builder(tiled_image.path_builder, suffix)
+        projected.append(TiledImage(name=path_builder.path, path_builder=path_builder))
+    return projected
+
+
+def tiled_image_is_3d(tiled_image: TiledImage) -> bool:
+    """Check if any tile of a tiled image has more than one z-plane."""
+    return any(tile.to_pixel_space().shape[2] > 1 for tile in tiled_image.tiles)
+
+
+def tiled_image_nbytes(tiled_image: TiledImage) -> int:
+    """Get the uncompressed size in bytes of the data of a tiled image."""
+    if not tiled_image.tiles:
+        return 0
+    # the tiles share the dtype of the image, and getting it can open the file
+    itemsize = np.dtype(tiled_image.tiles[0].dtype()).itemsize
+    return tiled_image_num_pixels(tiled_image) * itemsize
+
+
+def tiled_image_source(tiled_image: TiledImage) -> str | None:
+    """Get the path of the file the tiles of a tiled image are loaded from.
+
+    None if the tiles are not loaded from a single file, or if their loader
+    does not expose the path of its file (only the nd2 loader does).
+    """
+    # the tile loader is not exposed publicly by fractal_converters_tools
+    sources = {getattr(tile._data_loader, "path", None) for tile in tiled_image.tiles}
+    if len(sources) != 1:
+        return None
+    source = sources.pop()
+    return str(source) if source is not None else None
+
+
+def tiled_image_num_pixels(tiled_image: TiledImage) -> int:
+    """Get the number of pixels of a tiled image, without reading its files."""
+    return sum(int(np.prod(tile.to_pixel_space().shape)) for tile in tiled_image.tiles)
+
+
+def order_tiled_images(tiled_images: list[TiledImage]) -> list[TiledImage]:
+    """Order tiled images for a short conversion time on shared resources.
+
+    The images are grouped by source file, so that the jobs reading the same
+    file (e.g. the positions of a multi-position nd2 file) run back to back
+    and reuse the page cache and open file handles. The groups are sorted from
+    the largest to the smallest (longest processing time first), so that the
+    largest files are not left for the end when fewer workers are busy, and
+    images of the same size are ordered by storage device and file. The
+    images of a group are also ordered from the largest. Images with unknown
+    source form their own group.
+    """
+    groups: dict[str, list[tuple[int, int, TiledImage]]] = {}
+    for i, tiled_image in enumerate(tiled_images):
+        source = tiled_image_source(tiled_image)
+        key = source if source is not None else f"<image {i}>"
+        groups.setdefault(key, []).append(
+            (tiled_image_num_pixels(tiled_image), i, tiled_image)
+        )
+
+    def device(source: str) -> int:
+        try:
+            return os.stat(source).st_dev
+        except OSError:
+            return -1
+
+    group_order = sorted(
+        groups.items(),
+        key=lambda item: (
+            -sum(num_pixels for num_pixels, _, _ in item[1]),
+            device(item[0]),
+            item[0],
+        ),
+    )
+    ordered = []
+    for _, group in group_order:
+        group.sort(key=lambda item: (-item[0], item[1]))
+        ordered.extend(tiled_image for _, _, tiled_image in group)
+    return ordered
+
+
+def batch_tiled_images(
+    tiled_images: list[TiledImage],
+    max_images: int = 1,
+    max_bytes: float | None = None,
+) -> list[list[TiledImage]]:
+    """Group consecutive tiled images into batches converted by a single job.
+
+    A batch is closed when it holds max_images images, or when adding the next
+    image would exceed max_bytes. Images larger than max_bytes get their own
+    batch.
+    """
+    if max_images == 1:
+        return [[tiled_image] for tiled_image in tiled_images]
+    batches = []
+    batch, batch_bytes = [], 0
+    for tiled_image in tiled_images:
+        nbytes = tiled_image_nbytes(tiled_image) if max_bytes is not None else 0
+        if batch and (
+            len(batch) >= max_images
+            or (max_bytes is not None and batch_bytes + nbytes > max_bytes)
+        ):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(tiled_image)
+        batch_bytes += nbytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def build_parallelization_list(
+    zarr_dir: str | Path,
+    tiled_images: list[TiledImage],
+    overwrite: bool,
+    advanced_compute_options: AdvancedComputeOptions,
+    tmp_dir_name: str = "_tmp_converter_dir",
+    max_images_per_job: int = 1,
+    max_bytes_per_job: float | None = None,
+) -> list[dict]:
+    """Build a list of dictionaries to parallelize the conversion.
+
+    Same as `fractal_converters_tools.build_parallelization_list`, but the init
+    args keep the nd2 specific advanced options for the compute task, small
+    images can be batched into a single compute job, and the tiles of nd2
+    images are saved as compact descriptors (see `tile_descriptors`) instead
+    of pickles.
+
+    Args:
+        zarr_dir (str): The path to the zarr directory.
+        tiled_images (list[TiledImage]): A list of tiled images objects to convert.
+        overwrite (bool): Overwrite the existing zarr directory.
+        advanced_compute_options (AdvancedComputeOptions): The advanced compute options.
+        tmp_dir_name (str): The name of the temporary directory to store the
+            saved tiled images.
+        max_images_per_job (int): Maximum number of images converted by a single
+            compute job.
+        max_bytes_per_job (float | None): Maximum uncompressed size of the images
+            of a batched compute job. None means no limit.
+    """
+    parallelization_list = []
+    zarr_dir = Path(zarr_dir)
+
+    pickle_dir = zarr_dir / tmp_dir_name
+
+    if pickle_dir.exists():
+        # Reinitialize the directory
+        remove_pkl_dir(pickle_dir)
+
+    batches = batch_tiled_images(
+        tiled_images, max_images=max_images_per_job, max_bytes=max_bytes_per_job
+    )
+    for batch in batches:
+        batched_images = []
+        for tiled_image in batch:
+            tile_pickle_path = save_tiled_image(
+                pickle_dir=pickle_dir, tiled_image=tiled_image
+            )
+            batched_images.append(
+                BatchedImageArgs(
+                    zarr_url=str(zarr_dir / tiled_image.path),
+                    tiled_image_pickled_path=str(tile_pickle_path),
+                )
+            )
+        first, *others = batched_images
+        parallelization_list.append(
+            {
+                "zarr_url": first.zarr_url,
+                "init_args": ConvertNd2InitArgs(
+                    tiled_image_pickled_path=first.tiled_image_pickled_path,
+                    overwrite=overwrite,
+                    advanced_compute_options=advanced_compute_options,
+                    batched_images=others,
+                ).model_dump(),
+            }
+        )
+    if len(batches) < len(tiled_images):
+        logger.info(
+            f"Batched {len(tiled_images)} images into {len(batches)} compute jobs."
+        )
+    return parallelization_list
+
+
+def _plate_path_builders(
+    tiled_images: list[TiledImage],
+) -> dict[str, list[PlatePathBuilder]]:
+    """Group the path builders of plate images by plate name."""
+    plates: dict[str, list[PlatePathBuilder]] = {}
+    for tiled_image in tiled_images:
+        path_builder = tiled_image.path_builder
+        if not isinstance(path_builder, PlatePathBuilder):
+            raise ValueError(
+                "Something went wrong with the parsing. "
+                "Some of the metadata is missing or not correctly "
+                "formatted."
+            )
+        plates.setdefault(path_builder.plate_name, []).append(path_builder)
+    return plates
+
+
+def _initiate_ome_zarr_plate(
+    zarr_url: Path,
+    plate_name: str,
+    path_builders: list[PlatePathBuilder],
+    overwrite: bool = False,
+    max_workers: int = PLATE_INIT_WORKERS,
+) -> None:
+    """Create an OME-Zarr plate and its wells from the path builders of its images.
+
+    The plate and well metadata are built in memory and each of them is written
+    once, the wells concurrently.
+    """
+    version = "0.4"
+    plate_meta = NgioPlateMeta.default_init(name=plate_name, version=version)
+    wells: dict[tuple[str, str | int], list[int]] = {}
+    for path_builder in path_builders:
+        plate_meta = plate_meta.add_well(
+            row=path_builder.row, column=path_builder.column
+        )
+        plate_meta = plate_meta.add_acquisition(
+            acquisition_id=path_builder.acquisition_id,
+            acquisition_name=f"{plate_name}_id{path_builder.acquisition_id}",
+        )
+        wells.setdefault((path_builder.row, path_builder.column), []).append(
+            path_builder.acquisition_id
+        )
+
+    plate_handler = ZarrGroupHandler(
+        store=zarr_url,
+        cache=False,
+        mode="w" if overwrite else "w-",
+        parallel_safe=False,
+    )
+    get_plate_meta_handler(plate_handler, version=version).write_meta(plate_meta)
+
+    # the row groups are shared by the wells, create them before the wells
+    well_paths = {
+        well: plate_meta.get_well_path(row=well[0], column=well[1]) for well in wells
+    }
+    row_handlers = {
+        row_path: plate_handler.derive_handler(row_path)
+        for row_path in {path.split("/")[0] for path in well_paths.values()}
+    }
+
+    def write_well(well: tuple[str, str | int]) -> None:
+        row_path, column_path = well_paths[well].split("/")
+        well_handler = row_handlers[row_path].derive_handler(column_path)
+        well_meta = NgioWellMeta.default_init(version=version)
+        for acquisition_id in wells[well]:
+            well_meta = well_meta.add_image(
+                path=str(acquisition_id), acquisition=acquisition_id, strict=False
+            )
+        get_well_meta_handler(well_handler, version=version).write_meta(well_meta)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results to raise the errors of the threads
+        for _ in executor.map(write_well, wells):
+            pass
+
+
+def initiate_ome_zarr_plates(
+    zarr_dir: str | Path,
+    tiled_images: list[TiledImage],
+    overwrite: bool = False,
+    max_workers: int = PLATE_INIT_WORKERS,
+) -> None:
+    """Create the OME-Zarr plates of a list of tiled images.
+
+    Same as `fractal_converters_tools.initiate_ome_zarr_plates`, but the
+    metadata of a plate is written once instead of once per image, and its
+    wells are written concurrently by a bounded pool of threads. This keeps
+    the initialization of large multi-acquisition plates on network storage
+    short.
+
+    Args:
+        zarr_dir (str | Path): The directory to create the plates in.
+        tiled_images (list[TiledImage]): The tiled images of the plates.
+        overwrite (bool): Overwrite existing plates.
+        max_workers (int): Maximum number of wells written concurrently.
+    """
+    zarr_dir = Path(zarr_dir)
+    for plate_name, path_builders in _plate_path_builders(tiled_images).items():
+        _initiate_ome_zarr_plate(
+            zarr_url=zarr_dir / f"{plate_name}.zarr",
+            plate_name=plate_name,
+            path_builders=path_builders,
+            overwrite=overwrite,
+            max_workers=max_workers,
+        )
@@ -1,10 +1,15 @@
 """Tools to convert nd2 files to ome-zarr."""
 
 import logging
+import os
 import re
-from collections.abc import Generator
+import threading
+from collections import OrderedDict
+from collections.abc import Generator, Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any
+from typing import Any, Literal, NamedTuple
 
 import nd2
 import numpy as np
@@ -19,66 +24,731 @@ from fractal_converters_tools import (
 )
 from ngio import PixelSize
 
+from nd2_omezarr_converter.histogram_utils import StreamingHistogram
+
 logger = logging.getLogger(__name__)
 
+BinningReducer = Literal["mean", "sum", "max"]
+
+WELL_PATTERN = re.compile(r"Well([A-Z])(\d+)")
+# name of the timestamped run folders of a NIS-Elements JOBS export
+JOBS_RUN_PATTERN = re.compile(r"\d{8}_\d{6}_\d{3}")
+
+# directories are listed concurrently, which pays off on network storage
+DISCOVERY_WORKERS = 16
+
+# columns of the nd2 events table
+TIME_COLUMN = "Time [s]"
+Z_SERIES_COLUMN = "Z-Series"
+Z_COORD_COLUMNS = ("Z Coord [\u00b5m]", "Z Coord [um]", "Z [\u00b5m]")
+
+
+class Nd2HandlePool:
+    """Least recently used pool of open nd2 files.
+
+    Opening an nd2 file parses its metadata, which is repeated for every tile
+    of a file with several positions. A long running process can keep the
+    files open across tiles and jobs instead. A file is reopened if it was
+    modified since it was opened. Each handle is used by one thread at a time.
+    """
+
+    def __init__(self, max_open: int = 32):
+        """Initialize an empty pool.
+
+        Args:
+            max_open (int): Maximum number of files kept open.
+        """
+        self.max_open = max_open
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of open files."""
+        return len(self._handles)
+
+    def _get(self, path: str | Path) -> tuple[nd2.ND2File, threading.Lock]:
+        key = (str(path), os.stat(path).st_mtime_ns)
+        evicted = []
+        with self._lock:
+            entry = self._handles.pop(key, None)
+            if entry is None or entry[0].closed:
+                entry = (nd2.ND2File(path), threading.Lock())
+            self._handles[key] = entry
+            # close the least recently used files, unless they are being read
+            for other in list(self._handles):
+                if len(self._handles) <= self.max_open:
+                    break
+                if other != key and not self._handles[other][1].locked():
+                    evicted.append(self._handles.pop(other))
+        for handle, lock in evicted:
+            with lock:
+                handle.close()
+        return entry
+
+    @contextmanager
+    def open(self, path: str | Path) -> Iterator[nd2.ND2File]:
+        """Get the open nd2 file, for the duration of the context."""
+        while True:
+            handle, lock = self._get(path)
+            with lock:
+                # the handle may have been evicted by another thread meanwhile
+                if not handle.closed:
+                    yield handle
+                    return
+
+    def close(self) -> None:
+        """Close all the open files."""
+        with self._lock:
+            entries = list(self._handles.values())
+            self._handles.clear()
+        for handle, lock in entries:
+            with lock:
+                handle.close()
+
+
+_handle_pool: Nd2HandlePool | None = None
+_decode_threads: int | None = None
+
+
+def set_handle_pool(pool: Nd2HandlePool | None) -> None:
+    """Set the pool of nd2 files used by the tile loaders of this process.
+
+    With None (the default), every tile load opens and closes its nd2 file.
+    """
+    global _handle_pool
+    _handle_pool = pool
+
+
+def available_cpus() -> int:
+    """Get the number of CPUs this process may use.
+
+    Takes the CPU affinity of the process and the CPUs allocated by SLURM
+    (cpus_per_task of the Fractal task) into account.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # pragma: no cover
+        cpus = os.cpu_count() or 1
+    slurm_cpus = os.environ.get("SLURM_CPUS_PER_TASK")
+    if slurm_cpus and slurm_cpus.isdigit():
+        cpus = min(cpus, int(slurm_cpus))
+    return max(cpus, 1)
+
+
+def set_decode_threads(num_threads: int | None) -> None:
+    """Set the number of threads decoding the compressed nd2 frames of a tile.
+
+    With None (the default), one thread per available CPU is used.
+    """
+    global _decode_threads
+    _decode_threads = num_threads
+
+
+def decode_threads() -> int:
+    """Get the number of threads decoding the compressed nd2 frames of a tile."""
+    if _decode_threads is None:
+        return available_cpus()
+    return _decode_threads
+
+
+def is_compressed(nd2file) -> bool:
+    """Check if the frames of a nd2 file are stored compressed."""
+    return getattr(nd2file.attributes, "compressionType", None) == "lossless"
+
+
+@contextmanager
+def open_nd2(path: str | Path) -> Iterator[nd2.ND2File]:
+    """Open an nd2 file, from the handle pool if one is set."""
+    pool = _handle_pool
+    if pool is None:
+        with nd2.ND2File(path) as nd2file:
+            yield nd2file
+    else:
+        with pool.open(path) as nd2file:
+            yield nd2file
+
 
 class nd2TileLoader:
     """nd2 tile loader."""
 
-    def __init__(self, path: str, p: int):
-        """Initialize LifTileLoader."""
+    def __init__(
+        self,
+        path: str,
+        p: int | None,
+        channels: Sequence[int] | None = None,
+        t_indices: Sequence[int] | None = None,
+        z_indices: Sequence[int] | None = None,
+        xy_binning: int = 1,
+        binning_reducer: BinningReducer = "mean",
+        output_dtype: str | None = None,
+        rescale_limits: Sequence[tuple[int, int]] | None = None,
+    ):
+        """Initialize nd2TileLoader.
+
+        Args:
+            path (str): Path to the nd2 file.
+            p (int | None): Index of the position to load, None if the file has
+                no position loop.
+            channels (Sequence[int] | None): Indices of the channels to load.
+                If None, all channels are loaded.
+            t_indices (Sequence[int] | None): Indices of the timepoints to load.
+                If None, all timepoints are loaded.
+            z_indices (Sequence[int] | None): Indices of the z-planes to load.
+                If None, all z-planes are loaded.
+            xy_binning (int): XY bin factor applied to each frame while loading.
+            binning_reducer (BinningReducer): Reduction applied to the pixels of
+                each bin ("mean", "sum" or "max").
+            output_dtype (str | None): Unsigned integer data type to rescale the
+                data to. If None, the data type of the nd2 file is kept.
+            rescale_limits (Sequence[tuple[int, int]] | None): Per loaded channel
+                (low, high) source values mapped to 0 and to the maximum of
+                output_dtype. Required if output_dtype is set.
+        """
+        if output_dtype is not None and rescale_limits is None:
+            raise ValueError("rescale_limits are required to rescale the data.")
         self.path = path
         self.p = p
+        self.channels = channels
+        self.t_indices = t_indices
+        self.z_indices = z_indices
+        self.xy_binning = xy_binning
+        self.binning_reducer = binning_reducer
+        self.output_dtype = output_dtype
+        self.rescale_limits = rescale_limits
+
+    def _output_dtype(self, source_dtype: np.dtype) -> np.dtype:
+        """Get the data type of the loaded tile from the nd2 data type."""
+        dtype = np.dtype(source_dtype)
+        if self.output_dtype is not None:
+            dtype = np.dtype(self.output_dtype)
+        if self.xy_binning > 1:
+            dtype = binned_dtype(dtype, self.binning_reducer)
+        return dtype
 
     @property
     def dtype(self):
         """Get the data type of the tile."""
-        with nd2.ND2File(self.path) as nd2file:
+        with open_nd2(self.path) as nd2file:
             dtype = nd2file.dtype
-        return dtype
+        return self._output_dtype(dtype)
 
     def load(self) -> np.ndarray:
-        """Load the tile data."""
-        tile_data = nd2.imread(self.path, xarray=True, dask=True)
-        if "P" in tile_data.dims:
-            tile_data = tile_data.isel(P=self.p)
-        if not set(tile_data.dims).issubset(
-            ("T", "C", "Z", "Y", "X")
-        ):  # pragma: no cover
-            raise ValueError(
-                f"Data can only have dimensions T, C, Z, Y, X. Found: {tile_data.dims}"
+        """Load the tile data.
+
+        Only the frames of the selected timepoints and z-planes of the
+        position are read from the file. Rescaling and XY binning are applied
+        frame by frame, so the full resolution tile is never held in memory.
+        Compressed frames are decoded by a pool of threads (see
+        `set_decode_threads`), zlib releasing the GIL while decompressing.
+        """
+        with open_nd2(self.path) as nd2file:
+            sizes = nd2file.sizes
+            size_y, size_x = sizes.get("Y", 1), sizes.get("X", 1)
+            channels = _default_indices(self.channels, sizes.get("C", 1))
+            t_indices = _default_indices(self.t_indices, sizes.get("T", 1))
+            z_indices = _default_indices(self.z_indices, sizes.get("Z", 1))
+            layout = _loop_layout(nd2file)
+            luts = None
+            if self.output_dtype is not None:
+                luts = [
+                    rescale_lut(low, high, nd2file.dtype, self.output_dtype)
+                    for low, high in self.rescale_limits
+                ]
+
+            tile_data = np.empty(
+                (
+                    len(t_indices),
+                    len(channels),
+                    len(z_indices),
+                    size_y // self.xy_binning,
+                    size_x // self.xy_binning,
+                ),
+                dtype=self._output_dtype(nd2file.dtype),
+            )
+
+            def load_frame(i_t: int, i_z: int) -> None:
+                t, z = t_indices[i_t], z_indices[i_z]
+                frame = _read_frame(nd2file, layout, p=self.p, t=t, z=z)
+                frame = frame[channels]
+                if luts is not None:
+                    frame = np.stack(
+                        [lut[plane] for lut, plane in zip(luts, frame, strict=True)]
+                    )
+                if self.xy_binning > 1:
+                    frame = bin_xy(frame, self.xy_binning, self.binning_reducer)
+                tile_data[i_t, :, i_z] = frame
+
+            frames = [
+                (i_t, i_z)
+                for i_t in range(len(t_indices))
+                for i_z in range(len(z_indices))
+            ]
+            num_threads = min(decode_threads(), len(frames))
+            if num_threads > 1 and is_compressed(nd2file):
+                # every frame is written to its own slice of the output
+                with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                    for _ in executor.map(lambda frame: load_frame(*frame), frames):
+                        pass
+            else:
+                for i_t, i_z in frames:
+                    load_frame(i_t, i_z)
+        return tile_data
+
+
+def _default_indices(indices: Sequence[int] | None, size: int) -> Sequence[int]:
+    """Return the selected indices, or all indices of an axis of given size."""
+    return range(size) if indices is None else indices
+
+
+def _seq_index(
+    loop_axes: list[str], loop_shape: list[int], coords: dict[str, int]
+) -> int:
+    """Get the frame sequence index from the loop coordinates."""
+    if not loop_axes:
+        return 0
+    return int(np.ravel_multi_index([coords[ax] for ax in loop_axes], loop_shape))
+
+
+def _loop_layout(nd2file) -> tuple[list[str], list[int]]:
+    """Get the names and sizes of the loop (non-frame) axes of a nd2 file."""
+    sizes = nd2file.sizes
+    if nd2file.is_rgb:  # pragma: no cover
+        raise ValueError("RGB nd2 files are not supported.")
+    loop_axes = [ax for ax in sizes if ax not in ("C", "Y", "X")]
+    if not set(loop_axes).issubset(("T", "P", "Z")):  # pragma: no cover
+        raise ValueError(
+            f"Data can only have dimensions T, C, Z, Y, X. Found: {tuple(sizes)}"
+        )
+    return loop_axes, [sizes[ax] for ax in loop_axes]
+
+
+def _read_frame(
+    nd2file, layout: tuple[list[str], list[int]], p: int | None, t: int, z: int
+) -> np.ndarray:
+    """Read the frame of a position, timepoint and z-plane as a (c, y, x) array."""
+    loop_axes, loop_shape = layout
+    coords = {"T": t, "P": p or 0, "Z": z}
+    seq_index = _seq_index(loop_axes, loop_shape, coords)
+    frame = nd2file.read_frame(seq_index)
+    return frame.reshape(-1, nd2file.sizes.get("Y", 1), nd2file.sizes.get("X", 1))
+
+
+def rescale_lut(
+    low: int, high: int, source_dtype: np.dtype, output_dtype: str | np.dtype
+) -> np.ndarray:
+    """Build a lookup table linearly mapping [low, high] to the output dtype range.
+
+    Source values below low map to 0, values above high to the maximum of
+    output_dtype. The table has one entry per value of source_dtype and is
+    applied to a frame by indexing, `lut[frame]`.
+    """
+    source_dtype, output_dtype = np.dtype(source_dtype), np.dtype(output_dtype)
+    if source_dtype.kind != "u" or output_dtype.kind != "u":
+        raise ValueError(
+            "Rescaling is only supported between unsigned integer data types, "
+            f"got {source_dtype} to {output_dtype}."
+        )
+    out_max = np.iinfo(output_dtype).max
+    values = np.arange(np.iinfo(source_dtype).max + 1, dtype=np.float64)
+    scaled = (values - low) * (out_max / max(high - low, 1))
+    return np.clip(np.rint(scaled), 0, out_max).astype(output_dtype)
+
+
+def sample_channel_histogram(
+    nd2file,
+    channels: Sequence[int] | None = None,
+    positions: Sequence[int] | None = None,
+    t_slice: slice | None = None,
+    z_slice: slice | None = None,
+    num_frames: int = 32,
+) -> StreamingHistogram:
+    """Build per-channel histograms from evenly spaced frames of a nd2 file.
+
+    Only the frames of the selection are sampled. The histogram covers the
+    significant bits of the camera (e.g. 12 bit data in a 16 bit container).
+
+    Args:
+        nd2file (nd2.ND2File): The opened nd2 file.
+        channels (Sequence[int] | None): Indices of the channels to sample.
+        positions (Sequence[int] | None): Indices of the positions to sample.
+        t_slice (slice | None): Slice of the timepoints to sample.
+        z_slice (slice | None): Slice of the z-planes to sample.
+        num_frames (int): Maximum number of frames to sample.
+    """
+    sizes = nd2file.sizes
+    channels = _default_indices(channels, sizes.get("C", 1))
+    positions = _default_indices(positions, sizes.get("P", 1))
+    t_indices = range(sizes.get("T", 1))[t_slice or slice(None)]
+    z_indices = range(sizes.get("Z", 1))[z_slice or slice(None)]
+    layout = _loop_layout(nd2file)
+
+    histogram = StreamingHistogram.for_dtype(
+        num_channels=len(channels),
+        dtype=nd2file.dtype,
+        bits=nd2file.attributes.bitsPerComponentSignificant,
+    )
+    shape = (len(positions), len(t_indices), len(z_indices))
+    num_total = int(np.prod(shape))
+    samples = np.unique(np.linspace(0, num_total - 1, num=num_frames).round())
+    for sample in samples.astype(int):
+        i_p, i_t, i_z = np.unravel_index(sample, shape)
+        p = positions[i_p] if "P" in sizes else None
+        frame = _read_frame(nd2file, layout, p=p, t=t_indices[i_t], z=z_indices[i_z])
+        for i_c, c in enumerate(channels):
+            histogram.update(i_c, frame[c])
+    return histogram
+
+
+def compute_rescale_limits(
+    nd2_paths: Sequence[str | Path],
+    channels: Sequence[str | int] | None = None,
+    positions: Sequence[int] | None = None,
+    t_slice: slice | None = None,
+    z_slice: slice | None = None,
+    percentiles: tuple[float, float] = (0.0, 100.0),
+    num_frames: int = 32,
+) -> list[tuple[int, int]]:
+    """Compute per-channel rescale limits shared by a set of nd2 files.
+
+    The histograms sampled from each file (see `sample_channel_histogram`) are
+    merged, and the limits are taken at the given (low, high) percentiles.
+    """
+    histogram = None
+    for nd2_path in nd2_paths:
+        with nd2.ND2File(nd2_path) as nd2file:
+            channel_names = [ch.channel.name for ch in nd2file.metadata.channels]
+            file_histogram = sample_channel_histogram(
+                nd2file,
+                channels=resolve_channel_selection(channel_names, channels),
+                positions=positions,
+                t_slice=t_slice,
+                z_slice=z_slice,
+                num_frames=num_frames,
             )
-        if "Z" not in tile_data.dims:
-            tile_data = tile_data.expand_dims(Z=1, axis=0)
-        if "C" not in tile_data.dims:
-            tile_data = tile_data.expand_dims(C=1, axis=0)
-        if "T" not in tile_data.dims:
-            tile_data = tile_data.expand_dims(T=1, axis=0)
-        if tile_data.dims != ("T", "C", "Z", "Y", "X"):
-            tile_data = tile_data.transpose("T", "C", "Z", "Y", "X")
+        if histogram is None:
+            histogram = file_histogram
+        else:
+            histogram.merge(file_histogram)
+    if histogram is None:
+        raise ValueError("No nd2 files to compute the rescale limits from.")
+    return rescale_limits_from_histogram(histogram, *percentiles)
+
+
+def rescale_limits_from_histogram(
+    histogram: StreamingHistogram, low_percentile: float, high_percentile: float
+) -> list[tuple[int, int]]:
+    """Get the per-channel (low, high) rescale limits from a histogram."""
+    if low_percentile >= high_percentile:
+        raise ValueError(
+            f"Low percentile {low_percentile} must be smaller than high "
+            f"percentile {high_percentile}."
+        )
+    lows = histogram.percentiles(low_percentile)
+    highs = histogram.percentiles(high_percentile)
+    return [(low, max(high, low + 1)) for low, high in zip(lows, highs, strict=True)]
+
+
+def binned_dtype(dtype: np.dtype, reducer: BinningReducer) -> np.dtype:
+    """Get the data type of binned data.
+
+    Summing integer bins can overflow the input data type, so the sum reducer
+    promotes integer data to (at least) 32 bit.
+    """
+    dtype = np.dtype(dtype)
+    if reducer == "sum" and dtype.kind in "ui":
+        return np.promote_types(dtype, np.uint32 if dtype.kind == "u" else np.int32)
+    return dtype
+
+
+def bin_xy(data: np.ndarray, factor: int, reducer: BinningReducer) -> np.ndarray:
+    """Bin the last two (y, x) axes of an array by an integer factor.
+
+    Trailing rows and columns that do not fill a whole bin are dropped.
+
+    Args:
+        data (np.ndarray): Array with y and x as the last two axes.
+        factor (int): Bin factor.
+        reducer (BinningReducer): Reduction applied to the pixels of each bin
+            ("mean", "sum" or "max").
+    """
+    if factor == 1:
+        return data
+    *lead, size_y, size_x = data.shape
+    n_y, n_x = size_y // factor, size_x // factor
+    if n_y == 0 or n_x == 0:
+        raise ValueError(
+            f"Bin factor {factor} is larger than the frame size {size_y}x{size_x}."
+        )
+    blocks = data[..., : n_y * factor, : n_x * factor].reshape(
+        *lead, n_y, factor, n_x, factor
+    )
+    out_dtype = binned_dtype(data.dtype, reducer)
+    if reducer == "max":
+        return blocks.max(axis=(-3, -1))
+    if reducer == "sum":
+        return blocks.sum(axis=(-3, -1), dtype=out_dtype)
+    if reducer == "mean":
+        if data.dtype.kind in "ui":
+            # integer mean, rounded to the nearest integer
+            n = factor * factor
+            acc_dtype = np.int64 if data.dtype.kind == "i" else np.uint64
+            binned = blocks.sum(axis=(-3, -1), dtype=acc_dtype)
+            return ((binned + n // 2) // n).astype(out_dtype)
+        return blocks.mean(axis=(-3, -1), dtype=np.float64).astype(out_dtype)
+    raise ValueError(f"Unknown binning reducer: {reducer}")
+
 
-        return tile_data.data.compute()
+def resolve_channel_selection(
+    channel_names: list[str], channels: Sequence[str | int] | None
+) -> list[int] | None:
+    """Resolve channel names or indices to a list of channel indices.
 
+    Args:
+        channel_names (list[str]): Names of all channels in the nd2 file.
+        channels (Sequence[str | int] | None): Channel names or indices to select.
+            If None, all channels are selected and None is returned.
+    """
+    if channels is None:
+        return None
+    if len(channels) == 0:
+        raise ValueError("Channel selection is empty.")
+    indices = []
+    for channel in channels:
+        if isinstance(channel, str):
+            if channel not in channel_names:
+                raise ValueError(
+                    f"Channel {channel} not found. Available channels: {channel_names}"
+                )
+            indices.append(channel_names.index(channel))
+        else:
+            if not 0 <= channel < len(channel_names):
+                raise ValueError(
+                    f"Channel index {channel} out of range for "
+                    f"{len(channel_names)} channels."
+                )
+            indices.append(channel)
+    if len(set(indices)) != len(indices):
+        raise ValueError(f"Channel selection {channels} contains duplicates.")
+    return indices
+
+
+def resolve_slice_selection(
+    size: int, selection: slice | None, axis: str
+) -> range | None:
+    """Resolve a slice selection of an axis to a range of indices.
+
+    Args:
+        size (int): Size of the axis.
+        selection (slice | None): Slice of the axis to select. If None, the whole
+            axis is selected and None is returned.
+        axis (str): Name of the axis, used in error messages.
+    """
+    if selection is None:
+        return None
+    indices = range(size)[selection]
+    if len(indices) == 0:
+        raise ValueError(
+            f"Selection {selection} of axis {axis} (size {size}) is empty."
+        )
+    return indices
+
+
+def read_frame_events(nd2file) -> dict[str, np.ndarray]:
+    """Read the per-frame events table of an nd2 file in a single call.
+
+    Only the numeric columns are kept, as float arrays with one value per
+    frame (NaN where a value was not recorded). Returns an empty dict if the
+    table is not available, e.g. for legacy nd2 files.
+    """
+    try:
+        events = nd2file.events(orient="list")
+    except Exception as e:
+        logger.warning(f"Could not read the events table of {nd2file.path}: {e}")
+        return {}
+
+    columns = {}
+    for name, values in events.items():
+        try:
+            columns[name] = np.asarray(values, dtype=float)
+        except (TypeError, ValueError):
+            continue
+    if "Index" in columns:
+        # drop the rows of events that are not frames
+        is_frame = np.isfinite(columns["Index"])
+        columns = {name: values[is_frame] for name, values in columns.items()}
+    return columns
+
+
+def _loop_index(events: dict[str, np.ndarray], axis: str) -> np.ndarray | None:
+    """Per-frame index of a loop axis ("T", "P" or "Z"), None if not recorded."""
+    index = events.get(f"{axis} Index")
+    if index is None or not np.all(np.isfinite(index)):
+        return None
+    return index.astype(int)
+
+
+def frame_time_step(
+    events: dict[str, np.ndarray], t_indices: Sequence[int]
+) -> float | None:
+    """Get the time step between the selected timepoints from the frame timestamps.
+
+    The time of a timepoint is the mean timestamp of its frames, and the time
+    step is the median interval between consecutive selected timepoints.
+    Returns None if fewer than two timepoints have timestamps.
+    """
+    times = events.get(TIME_COLUMN)
+    t_index = _loop_index(events, "T")
+    if times is None or t_index is None or len(t_indices) < 2:
+        return None
+
+    valid = np.isfinite(times)
+    size = max(int(t_index.max()), max(t_indices)) + 1
+    counts = np.bincount(t_index[valid], minlength=size)
+    sums = np.bincount(t_index[valid], weights=times[valid], minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t_times = (sums / counts)[list(t_indices)]
+    t_times = t_times[np.isfinite(t_times)]
+    if len(t_times) < 2:
+        return None
+    step = float(np.median(np.diff(t_times)))
+    return step if step > 0 else None
+
+
+def position_z_origins(
+    events: dict[str, np.ndarray],
+    positions: Sequence[int],
+    t_index: int,
+    z_indices: Sequence[int],
+) -> dict[int, float]:
+    """Get the z origin of each position from the per-frame z positions.
+
+    The z origin is the lowest z of the selected z-planes of a position at
+    the first selected timepoint. The stage z recorded for each frame is used
+    if available, otherwise the z-series offsets relative to the home z of the
+    stack are returned.
+
+    Returns:
+        dict[int, float]: The z origin of each position with recorded z values.
+    """
+    z_column = next((name for name in Z_COORD_COLUMNS if name in events), None)
+    z_column = z_column or (Z_SERIES_COLUMN if Z_SERIES_COLUMN in events else None)
+    if z_column is None or not positions:
+        return {}
+
+    z = events[z_column]
+    mask = np.isfinite(z)
+    t_loop = _loop_index(events, "T")
+    if t_loop is not None:
+        mask &= t_loop == t_index
+    z_loop = _loop_index(events, "Z")
+    if z_loop is not None:
+        mask &= np.isin(z_loop, list(z_indices))
+    p_loop = _loop_index(events, "P")
+    if p_loop is None:
+        p_loop = np.zeros(len(z), dtype=int)
+
+    size = max(int(p_loop.max(initial=0)), max(positions)) + 1
+    origins = np.full(size, np.inf)
+    np.minimum.at(origins, p_loop[mask], z[mask])
+    return {p: float(origins[p]) for p in positions if np.isfinite(origins[p])}
+
+
+def _stage_z_origin(
+    z_origins: dict[int, float], p: int, home_z: float, absolute: bool
+) -> float:
+    """Get the z origin of a position, falling back to the home z of the stack."""
+    if p not in z_origins:
+        return home_z
+    return z_origins[p] if absolute else home_z + z_origins[p]
+
+
+def build_tiles(
+    nd2file,
+    positions: Sequence[int] | None = None,
+    channels: Sequence[int] | None = None,
+    t_slice: slice | None = None,
+    z_slice: slice | None = None,
+    xy_binning: int = 1,
+    binning_reducer: BinningReducer = "mean",
+    output_dtype: str | None = None,
+    rescale_limits: Sequence[tuple[int, int]] | None = None,
+) -> Generator[Tile, Any, None]:
+    """Build tiles from nd2 file.
+
+    The time step and the z origin of each tile are computed from the
+    timestamps and z positions of all the frames, read at once from the nd2
+    events table.
+
+    Args:
+        nd2file (nd2.ND2File): The opened nd2 file.
+        positions (Sequence[int] | None): Indices of the XYPosLoop positions to
+            build tiles for. If None, all positions are used.
+        channels (Sequence[int] | None): Indices of the channels to load.
+            If None, all channels are loaded.
+        t_slice (slice | None): Slice of the timepoints to load.
+            If None, all timepoints are loaded.
+        z_slice (slice | None): Slice of the z-planes to load.
+            If None, all z-planes are loaded. A slice step decimates the
+            z-planes, and the z pixel size is scaled accordingly.
+        xy_binning (int): XY bin factor applied while loading. The tile shape and
+            the xy pixel size are scaled accordingly.
+        binning_reducer (BinningReducer): Reduction applied to the pixels of
+            each bin ("mean", "sum" or "max").
+        output_dtype (str | None): Unsigned integer data type to rescale the
+            data to. If None, the data type of the nd2 file is kept.
+        rescale_limits (Sequence[tuple[int, int]] | None): Per selected channel
+            (low, high) source values used to rescale to output_dtype.
+    """
+    t_indices = resolve_slice_selection(nd2file.sizes.get("T", 1), t_slice, "T")
+    z_indices = resolve_slice_selection(nd2file.sizes.get("Z", 1), z_slice, "Z")
 
-def build_tiles(nd2file) -> Generator[Tile, Any, None]:
-    """Build tiles from nd2 file."""
     shape_x = nd2file.sizes["X"] if "X" in nd2file.sizes else 1
     shape_y = nd2file.sizes["Y"] if "Y" in nd2file.sizes else 1
     shape_z = nd2file.sizes["Z"] if "Z" in nd2file.sizes else 1
     shape_c = nd2file.sizes["C"] if "C" in nd2file.sizes else 1
     shape_t = nd2file.sizes["T"] if "T" in nd2file.sizes else 1
+    if channels is not None:
+        shape_c = len(channels)
+    if t_indices is not None:
+        shape_t = len(t_indices)
+    if z_indices is not None:
+        shape_z = len(z_indices)
+
+    # per-frame timestamps and z positions, read in one call
+    events = read_frame_events(nd2file)
+    selected_t = _default_indices(t_indices, nd2file.sizes.get("T", 1))
+    selected_z = _default_indices(z_indices, nd2file.sizes.get("Z", 1))
+    z_is_absolute = any(name in events for name in Z_COORD_COLUMNS)
 
     # scale factors [um]/[px]
     scale_x = nd2file.voxel_size().x
     scale_y = nd2file.voxel_size().y
     scale_z = nd2file.voxel_size().z
-    scale_t = 1  # TODO: read correctly from metadata
+    # [s], time scaling is not supported by the tiles, only by the pixel size
+    scale_t = frame_time_step(events, selected_t) or 1
+
+    if z_indices is not None:
+        scale_z = scale_z * z_indices.step
+    if xy_binning > 1:
+        shape_x = shape_x // xy_binning
+        shape_y = shape_y // xy_binning
+        scale_x = scale_x * xy_binning
+        scale_y = scale_y * xy_binning
+
+    loader_kwargs = {
+        "channels": channels,
+        "t_indices": t_indices,
+        "z_indices": z_indices,
+        "xy_binning": xy_binning,
+        "binning_reducer": binning_reducer,
+        "output_dtype": output_dtype,
+        "rescale_limits": rescale_limits,
+    }
 
     # [um]
     length_x = shape_x * scale_x
     length_y = shape_y * scale_y
     length_z = shape_z * scale_z
-    length_t = shape_t * scale_t
 
     # camera transformation matrix
     transformMatrix = nd2file.metadata.channels[0].volume.cameraTransformationMatrix
@@ -91,7 +761,20 @@ def build_tiles(nd2file) -> Generator[Tile, Any, None]:
                 f"The nd2 file {nd2file.path} contains multiple positions, "
                 "but no XYPosLoop was found in metadata."
             )
-        for p, pnt in enumerate(loops["XYPosLoop"].parameters.points):
+        points = loops["XYPosLoop"].parameters.points
+        if positions is None:
+            positions = range(len(points))
+        for p in positions:
+            if not 0 <= p < len(points):
+                raise ValueError(
+                    f"Position index {p} out of range for "
+                    f"{len(points)} positions in {nd2file.path}."
+                )
+        z_origins = position_z_origins(
+            events, positions, t_index=selected_t[0], z_indices=selected_z
+        )
+        for p in positions:
+            pnt = points[p]
             # rotate the xy coordinates with the camera transformation matrix
             xy_coords = np.array([pnt.stagePositionUm.x, pnt.stagePositionUm.y])
             xy_coords = np.dot(transformMatrix, xy_coords)
@@ -103,13 +786,15 @@ def build_tiles(nd2file) -> Generator[Tile, Any, None]:
                 c=0,
                 t=0,
             )
-            diag = Vector(x=length_x, y=length_y, z=length_z, c=shape_c, t=length_t)
-            tile_loader = nd2TileLoader(path=nd2file.path, p=p)
-            pixel_size = PixelSize(x=scale_x, y=scale_y, z=scale_z)
+            diag = Vector(x=length_x, y=length_y, z=length_z, c=shape_c, t=shape_t)
+            tile_loader = nd2TileLoader(path=nd2file.path, p=p, **loader_kwargs)
+            pixel_size = PixelSize(x=scale_x, y=scale_y, z=scale_z, t=scale_t)
             origin = OriginDict(
                 x_micrometer_original=xy_coords[0],
                 y_micrometer_original=xy_coords[1],
-                z_micrometer_original=pnt.stagePositionUm.z,
+                z_micrometer_original=_stage_z_origin(
+                    z_origins, p, pnt.stagePositionUm.z, absolute=z_is_absolute
+                ),
             )
             tile = Tile(
                 top_l=top_l,
@@ -120,8 +805,20 @@ def build_tiles(nd2file) -> Generator[Tile, Any, None]:
             )
             yield tile
     else:
+        if positions is not None and list(positions) != [0]:
+            raise ValueError(
+                f"The nd2 file {nd2file.path} contains a single position, "
+                f"position selection {list(positions)} is not valid."
+            )
         # TODO: check if this holds...
         pnt = nd2file.frame_metadata(0).channels[0].position
+        z_origins = position_z_origins(
+            events, [0], t_index=selected_t[0], z_indices=selected_z
+        )
+        home_z = pnt.stagePositionUm.z
+        if not z_is_absolute and Z_SERIES_COLUMN in events:
+            # the stage z of the first frame is offset from the home z of the stack
+            home_z -= float(events[Z_SERIES_COLUMN][0])
         top_l = Point(
             x=pnt.stagePositionUm.x,
             y=pnt.stagePositionUm.y,
@@ -130,13 +827,21 @@ def build_tiles(nd2file) -> Generator[Tile, Any, None]:
             c=0,
             t=0,
         )
-        diag = Vector(x=length_x, y=length_y, z=length_z, c=shape_c, t=length_t)
-        pixel_size = PixelSize(x=scale_x, y=scale_y, z=scale_z)
-        tile_loader = nd2TileLoader(path=nd2file.path, p=None)
+        diag = Vector(x=length_x, y=length_y, z=length_z, c=shape_c, t=shape_t)
+        pixel_size = PixelSize(x=scale_x, y=scale_y, z=scale_z, t=scale_t)
+        tile_loader = nd2TileLoader(path=nd2file.path, p=None, **loader_kwargs)
+        origin = OriginDict(
+            x_micrometer_original=pnt.stagePositionUm.x,
+            y_micrometer_original=pnt.stagePositionUm.y,
+            z_micrometer_original=_stage_z_origin(
+                z_origins, 0, home_z, absolute=z_is_absolute
+            ),
+        )
         tile = Tile(
             top_l=top_l,
             diag=diag,
             pixel_size=pixel_size,
+            origin=origin,
             data_loader=tile_loader,
         )
         yield tile
@@ -144,8 +849,7 @@ def build_tiles(nd2file) -> Generator[Tile, Any, None]:
 
 def parse_well_info(fn):
     """Get well info from filename."""
-    pattern = r"Well([A-Z])(\d+)"
-    match = re.search(pattern, Path(fn).stem)
+    match = WELL_PATTERN.search(Path(fn).stem)
     if match:
         row = match.group(1)
         col = int(match.group(2))
@@ -159,8 +863,23 @@ def build_tiled_image(
     zarr_name: str,
     acquisition_id: int | None = None,
     plate: bool = False,
+    channels: Sequence[str | int] | None = None,
+    positions: Sequence[int] | None = None,
+    t_slice: slice | None = None,
+    z_slice: slice | None = None,
+    xy_binning: int = 1,
+    binning_reducer: BinningReducer = "mean",
+    output_dtype: str | None = None,
+    rescale_limits: Sequence[tuple[int, int]] | None = None,
 ) -> list[TiledImage]:
-    """Build tiled image from nd2 file."""
+    """Build tiled image from nd2 file.
+
+    The channels, positions, t_slice and z_slice arguments restrict the
+    conversion to a subset of the nd2 file (see `build_tiles`). Channels can be
+    selected by name or by index. xy_binning and binning_reducer downsample the
+    data while it is loaded. If output_dtype is set, the data is rescaled with
+    the per selected channel rescale_limits (see `compute_rescale_limits`).
+    """
     nd2file = nd2.ND2File(nd2_path)
 
     # load channel info
@@ -171,6 +890,11 @@ def build_tiled_image(
         # take emission wavelength (excitation wavelength is not loaded correctly)
         channel_wavelengths.append(str(channel.channel.emissionLambdaNm))
 
+    channel_indices = resolve_channel_selection(channel_names, channels)
+    if channel_indices is not None:
+        channel_names = [channel_names[c] for c in channel_indices]
+        channel_wavelengths = [channel_wavelengths[c] for c in channel_indices]
+
     # Define path builder for relative ome-zarr path
     if plate:
         row, col = parse_well_info(nd2_path)
@@ -198,13 +922,147 @@ def build_tiled_image(
         channel_names=channel_names,
         wavelength_ids=channel_wavelengths,
     )
-    for tile in build_tiles(nd2file):
+    for tile in build_tiles(
+        nd2file,
+        positions=positions,
+        channels=channel_indices,
+        t_slice=t_slice,
+        z_slice=z_slice,
+        xy_binning=xy_binning,
+        binning_reducer=binning_reducer,
+        output_dtype=output_dtype,
+        rescale_limits=rescale_limits,
+    ):
         tiled_image.add_tile(tile)
 
     nd2file.close()
     return tiled_image
 
 
+class Nd2Acquisition(NamedTuple):
+    """nd2 files converted together, as a plate, a folder or a single file."""
+
+    path: Path
+    nd2_files: list[Path]
+    mode: str
+    plate_name: str | None
+    acquisition_id: int | None
+
+
+def _scan_directory(path: Path) -> tuple[Path, list[Path], list[Path]]:
+    """List the nd2 files and the subdirectories of a directory.
+
+    Hidden directories and zarr directories are skipped.
+    """
+    nd2_files, subdirs = [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                if not entry.name.endswith(".zarr"):
+                    subdirs.append(Path(entry.path))
+            elif entry.name.endswith(".nd2") and entry.is_file():
+                nd2_files.append(Path(entry.path))
+    return path, sorted(nd2_files), sorted(subdirs)
+
+
+def _input_mode(nd2_files: Sequence[Path]) -> str:
+    """Get the mode of a directory from the names of its nd2 files."""
+    if all(WELL_PATTERN.search(p.stem) for p in nd2_files):
+        return "plate"
+    return "folder"
+
+
+def scan_nd2_directories(
+    path: str | Path, max_workers: int = DISCOVERY_WORKERS
+) -> dict[Path, list[Path]]:
+    """Recursively find the directories containing nd2 files.
+
+    The subdirectories are listed concurrently with os.scandir.
+
+    Returns:
+        dict[Path, list[Path]]: The sorted nd2 files of each directory, sorted
+            by directory.
+    """
+    found = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = {executor.submit(_scan_directory, Path(path))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory, nd2_files, subdirs = future.result()
+                if nd2_files:
+                    found[directory] = nd2_files
+                pending |= {executor.submit(_scan_directory, d) for d in subdirs}
+    return dict(sorted(found.items()))
+
+
+def discover_nd2_acquisitions(
+    path: str | Path,
+    plate_name: str | None = None,
+    acquisition_id: int = 0,
+    max_workers: int = DISCOVERY_WORKERS,
+) -> list[Nd2Acquisition]:
+    """Recursively discover the nd2 acquisitions in a directory tree.
+
+    Directories where all nd2 files have well info in their name are plate
+    acquisitions. The timestamped run folders of a NIS-Elements JOBS export
+    (e.g. 20250506_124144_018) with the same parent directory are acquisitions
+    of the same plate, named after the parent directory and numbered from
+    acquisition_id in the order of the directory names. Other plate
+    directories are separate plates. Plates and folders (directories of other
+    nd2 files) are named after their path relative to the input path.
+
+    Args:
+        path (str | Path): Root directory.
+        plate_name (str | None): Name of the plate, or prefix of the zarr names
+            if the tree contains several plates or folders. If None, the name of
+            the root directory is used.
+        acquisition_id (int): Acquisition id of the first acquisition of a plate.
+        max_workers (int): Number of directories listed concurrently.
+    """
+    root = Path(path)
+    prefix = (plate_name or root.name).replace(" ", "_")
+    directories = scan_nd2_directories(root, max_workers=max_workers)
+    if not directories:
+        raise ValueError(f"No nd2 files found in directory tree {root}")
+
+    plates, folders = {}, []
+    for directory, nd2_files in directories.items():
+        if _input_mode(nd2_files) == "plate":
+            is_jobs_run = JOBS_RUN_PATTERN.fullmatch(directory.name) is not None
+            if directory != root and is_jobs_run:
+                plate_dir = directory.parent
+            else:
+                plate_dir = directory
+            plates.setdefault(plate_dir, []).append((directory, nd2_files))
+        else:
+            folders.append((directory, nd2_files))
+
+    def _name(directory: Path) -> str:
+        parts = directory.relative_to(root).parts
+        return "_".join((prefix, *parts)).replace(" ", "_")
+
+    single_plate = len(plates) == 1 and not folders
+    acquisitions = []
+    for plate_dir, plate_acquisitions in plates.items():
+        name = prefix if single_plate else _name(plate_dir)
+        for i, (directory, nd2_files) in enumerate(plate_acquisitions):
+            acquisitions.append(
+                Nd2Acquisition(directory, nd2_files, "plate", name, acquisition_id + i)
+            )
+    for directory, nd2_files in folders:
+        acquisitions.append(
+            Nd2Acquisition(directory, nd2_files, "folder", _name(directory), None)
+        )
+    logger.info(
+        f"Discovered {sum(len(a.nd2_files) for a in acquisitions)} nd2 files in "
+        f"{len(acquisitions)} acquisitions under {root}"
+    )
+    return acquisitions
+
+
 def parse_input_path(path: str | Path) -> tuple[list[Path], str]:
     """Parse input path and return list of nd2 files and mode.
 
@@ -215,16 +1073,10 @@ def parse_input_path(path: str | Path) -> tuple[list[Path], str]:
     """
     path = Path(path)
     if path.is_dir():
-        paths = sorted(path.glob("*.nd2"))
+        _, paths, _ = _scan_directory(path)
         if not paths:
             raise ValueError(f"No nd2 files found in directory {path}")
-        # check mode
-        mode = "plate"
-        for p in paths:
-            try:
-                parse_well_info(p)
-            except ValueError:
-                mode = "folder"
+        mode = _input_mode(paths)
     elif path.is_file():
         if path.suffix != ".nd2":
             raise ValueError(f"File {path} is not an nd2 file")
@@ -240,12 +1092,80 @@ def parse_nd2_acquisition(
     acq_path: str | Path,
     plate_name: str | None = None,
     acquisition_id: int | None = None,
+    channels: Sequence[str | int] | None = None,
+    positions: Sequence[int] | None = None,
+    t_slice: slice | None = None,
+    z_slice: slice | None = None,
+    xy_binning: int = 1,
+    binning_reducer: BinningReducer = "mean",
+    output_dtype: str | None = None,
+    rescale_percentiles: tuple[float, float] = (0.0, 100.0),
+    rescale_sample_frames: int = 32,
+    recursive: bool = False,
 ) -> list[TiledImage]:
-    """Parse nd2 acquisition and return list of tiled images."""
+    """Parse nd2 acquisition and return list of tiled images.
+
+    The selection and binning arguments are applied to every nd2 file of the
+    acquisition (see `build_tiled_image`). If output_dtype is set, the rescale
+    limits are computed once for the whole acquisition, so that all images of
+    the acquisition share the same intensity scaling.
+
+    If recursive is True, acq_path is searched recursively for plates and
+    folders of nd2 files (see `discover_nd2_acquisitions`).
+    """
     if not acq_path.exists():
         raise FileNotFoundError(f"File not found: {acq_path}")
 
-    nd2_list, mode = parse_input_path(acq_path)
+    if recursive:
+        acquisitions = discover_nd2_acquisitions(
+            acq_path, plate_name=plate_name, acquisition_id=acquisition_id or 0
+        )
+    else:
+        nd2_list, mode = parse_input_path(acq_path)
+        acquisitions = [
+            Nd2Acquisition(Path(acq_path), nd2_list, mode, plate_name, acquisition_id)
+        ]
+    nd2_list = [p for acquisition in acquisitions for p in acquisition.nd2_files]
+
+    rescale_limits = None
+    if output_dtype is not None:
+        rescale_limits = compute_rescale_limits(
+            nd2_list,
+            channels=channels,
+            positions=positions,
+            t_slice=t_slice,
+            z_slice=z_slice,
+            percentiles=rescale_percentiles,
+            num_frames=rescale_sample_frames,
+        )
+        logger.info(
+            f"Rescaling {acq_path} to {output_dtype} with per-channel "
+            f"limits {rescale_limits}"
+        )
+
+    tiled_images = []
+    for acquisition in acquisitions:
+        tiled_images.extend(
+            _acquisition_tiled_images(
+                acquisition,
+                channels=channels,
+                positions=positions,
+                t_slice=t_slice,
+                z_slice=z_slice,
+                xy_binning=xy_binning,
+                binning_reducer=binning_reducer,
+                output_dtype=output_dtype,
+                rescale_limits=rescale_limits,
+            )
+        )
+    return tiled_images
+
+
+def _acquisition_tiled_images(
+    acquisition: Nd2Acquisition, **build_kwargs
+) -> list[TiledImage]:
+    """Build the tiled images of the nd2 files of an acquisition."""
+    acq_path, nd2_list, mode, plate_name, acquisition_id = acquisition
 
     # get zarr-name for entire plate
     if mode == "plate":
@@ -286,6 +1206,7 @@ def parse_nd2_acquisition(
                 zarr_name=zarr_name,
                 acquisition_id=acquisition_id if mode == "plate" else None,
                 plate=True if mode == "plate" else False,
+                **build_kwargs,
             )
         )
     return tiled_images
@@ -0,0 +1,141 @@
+"""Opt-in profiling of the conversion tasks.
+
+Profiling is enabled by setting the ND2_CONVERTER_PROFILE_DIR environment
+variable to the directory where the reports are written. Each profiled run
+writes, named after the converted image:
+
+- `<name>.prof`: cProfile statistics, to open with `pstats` or snakeviz.
+- `<name>.memory.txt`: peak memory and top allocations traced by tracemalloc.
+
+ND2_CONVERTER_PROFILE selects the profilers as a comma separated list of
+"cpu" and "memory" (default: both). Only the task process is profiled, not
+the writer processes started with `num_writer_processes`.
+
+Jobs forwarded to the worker service are profiled with the settings of the
+compute task that submitted them, not with the environment of the service.
+"""
+
+import cProfile
+import logging
+import os
+import re
+import tracemalloc
+from collections.abc import Iterator, Mapping
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR_ENV = "ND2_CONVERTER_PROFILE_DIR"
+PROFILE_MODES_ENV = "ND2_CONVERTER_PROFILE"
+PROFILE_MODES = ("cpu", "memory")
+TOP_ALLOCATIONS = 30
+
+
+def profile_name(zarr_url: str) -> str:
+    """Get a file name for the reports of an image from its zarr url.
+
+    The name is built from the path within the zarr, e.g.
+    "/data/plate.zarr/B/03/0" gives "plate_B_03_0".
+    """
+    parts = Path(zarr_url).parts
+    zarr_parts = [i for i, part in enumerate(parts) if part.endswith(".zarr")]
+    if zarr_parts:
+        parts = parts[zarr_parts[0] :]
+    else:
+        parts = parts[-1:]
+    name = "_".join(part.removesuffix(".zarr") for part in parts)
+    return re.sub(r"[^\w.-]", "_", name)
+
+
+def profile_settings_from_env() -> dict[str, str]:
+    """Get the profiling variables set in the environment of the process."""
+    return {
+        variable: os.environ[variable]
+        for variable in (PROFILE_DIR_ENV, PROFILE_MODES_ENV)
+        if variable in os.environ
+    }
+
+
+def _profile_modes(settings: Mapping[str, str]) -> set[str]:
+    value = settings.get(PROFILE_MODES_ENV)
+    if not value:
+        return set(PROFILE_MODES)
+    modes = {mode.strip().lower() for mode in value.split(",") if mode.strip()}
+    unknown = modes - set(PROFILE_MODES)
+    if unknown:
+        raise ValueError(
+            f"Unknown profiling modes {sorted(unknown)} in {PROFILE_MODES_ENV}, "
+            f"expected a comma separated list of {PROFILE_MODES}."
+        )
+    return modes
+
+
+def _write_memory_report(path: Path, snapshot: tracemalloc.Snapshot, peak: int) -> None:
+    stats = snapshot.statistics("lineno")
+    lines = [
+        f"Peak traced memory: {peak / 1e6:.1f} MB",
+        f"Top {TOP_ALLOCATIONS} allocations still held at the end of the run:",
+    ]
+    lines.extend(str(stat) for stat in stats[:TOP_ALLOCATIONS])
+    path.write_text("\n".join(lines) + "\n")
+
+
+@contextmanager
+def profile_run(name: str, settings: Mapping[str, str] | None = None) -> Iterator[None]:
+    """Profile the code run in the context if profiling is enabled.
+
+    When ND2_CONVERTER_PROFILE_DIR is not set, nothing is done. Failing to
+    start a profiler (e.g. another profiler is already active in the process)
+    only skips that profiler, and reports are written even if the profiled
+    code raises.
+
+    Args:
+        name (str): Name of the reports, usually from `profile_name`.
+        settings (Mapping[str, str] | None): Profiling variables to use
+            instead of the environment of the process, e.g. the ones sent with
+            a job to the worker service.
+    """
+    if settings is None:
+        settings = os.environ
+    profile_dir = settings.get(PROFILE_DIR_ENV)
+    if not profile_dir:
+        yield
+        return
+
+    profile_dir = Path(profile_dir)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    modes = _profile_modes(settings)
+
+    profiler = None
+    if "cpu" in modes:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            logger.warning(f"CPU profiling of {name} skipped: {e}")
+            profiler = None
+
+    # tracemalloc is global to the process, leave it running if it was
+    # started by someone else
+    start_tracing = "memory" in modes and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            prof_path = profile_dir / f"{name}.prof"
+            profiler.dump_stats(prof_path)
+            logger.info(f"CPU profile written to {prof_path}")
+        if "memory" in modes and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            if start_tracing:
+                tracemalloc.stop()
+            memory_path = profile_dir / f"{name}.memory.txt"
+            _write_memory_report(memory_path, snapshot, peak)
+            logger.info(f"Memory report written to {memory_path}")
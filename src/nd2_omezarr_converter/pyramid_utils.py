@@ -0,0 +1,387 @@
+"""Pyramid levels built while the tiles of an image are written.
+
+`ngio` builds the pyramid of an image once its full resolution level is
+written (`Image.consolidate`), reading the whole level back from disk. A
+`StreamingPyramid` instead downsamples each tile in memory as it is written,
+and writes all the lower resolution levels in the same pass.
+
+The y and x axes are halved at each level, with the resampling of
+`consolidate` for levels of even size:
+
+- order 1 (images without a time axis): mean of each 2 x 2 block, rounded half
+  up for integer data.
+- order 0 (time series): bottom right pixel of each 2 x 2 block.
+
+At the edge of a level of odd size, the last blocks only use the pixels
+inside the image, while `consolidate` resamples the whole level by a factor
+slightly different from 2. The two pyramids are identical when the image
+size is divisible by 2 ** (num_levels - 1).
+
+Each pixel of the coarsest level is built from a block of B x B pixels of
+the full resolution, B = 2 ** (num_levels - 1). The blocks within a tile are
+downsampled straight from the tile data. The blocks cut by the edges of the
+tiles are carried in memory until the neighbouring tiles complete them. The
+chunks of the lower levels are buffered until they are complete, so that
+each chunk is compressed once. Both buffers are bounded: past `max_bytes`,
+the least recently used chunks are written as they are (and read back if
+needed again), then the least recently used blocks. Blocks written before
+they were complete are rebuilt from the full resolution level at the end.
+"""
+
+import logging
+import math
+from collections import OrderedDict
+
+import numpy as np
+import zarr
+
+logger = logging.getLogger(__name__)
+
+PYRAMID_BUFFER_BYTES = 1024**3
+
+
+def downsample_yx(data: np.ndarray, order: int = 1) -> np.ndarray:
+    """Halve the last two axes of data, as for the next pyramid level.
+
+    Odd sizes are rounded up: the last block only uses the last row or
+    column of data.
+
+    Args:
+        data (np.ndarray): The data, with y and x as last axes.
+        order (int): 1 for the mean of each 2 x 2 block, 0 for its bottom
+            right pixel.
+    """
+    pad_y, pad_x = data.shape[-2] % 2, data.shape[-1] % 2
+    if pad_y or pad_x:
+        pad = [(0, 0)] * (data.ndim - 2) + [(0, pad_y), (0, pad_x)]
+        data = np.pad(data, pad, mode="edge")
+    if order == 0:
+        return data[..., 1::2, 1::2].copy()
+
+    if data.dtype.kind in "ui":
+        # sum in a wider type, then round the mean half up
+        acc_dtype = np.promote_types(
+            data.dtype, np.uint32 if data.dtype.kind == "u" else np.int64
+        )
+    else:
+        acc_dtype = np.promote_types(data.dtype, np.float32)
+    total = np.add(data[..., 0::2, 0::2], data[..., 0::2, 1::2], dtype=acc_dtype)
+    total += data[..., 1::2, 0::2]
+    total += data[..., 1::2, 1::2]
+    if data.dtype.kind in "ui":
+        total += 2
+        total //= 4
+    else:
+        total /= 4
+    return total.astype(data.dtype)
+
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    """Insert a zero bit between the bits of 32 bit values."""
+    v = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in (
+        (16, 0x0000FFFF0000FFFF),
+        (8, 0x00FF00FF00FF00FF),
+        (4, 0x0F0F0F0F0F0F0F0F),
+        (2, 0x3333333333333333),
+        (1, 0x5555555555555555),
+    ):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def z_order(rects: np.ndarray) -> np.ndarray:
+    """Order (y, x, height, width) rectangles along a Z-order curve.
+
+    Written in this order, neighbouring tiles follow each other, so the
+    blocks and chunks of the lower levels are completed early.
+
+    Returns:
+        np.ndarray: The indices of the rectangles, in Z-order.
+    """
+    if len(rects) == 0:
+        return np.arange(0)
+    step_y = max(int(rects[:, 2].min()), 1)
+    step_x = max(int(rects[:, 3].min()), 1)
+    cells_y = (rects[:, 0] - rects[:, 0].min()) // step_y
+    cells_x = (rects[:, 1] - rects[:, 1].min()) // step_x
+    codes = (_spread_bits(cells_y) << np.uint64(1)) | _spread_bits(cells_x)
+    return np.argsort(codes, kind="stable")
+
+
+def rects_overlap(rects: np.ndarray, batch_size: int = 1024) -> bool:
+    """Check if any two (y, x, height, width) rectangles overlap."""
+    y0, x0 = rects[:, 0], rects[:, 1]
+    y1, x1 = y0 + rects[:, 2], x0 + rects[:, 3]
+    for start in range(0, len(rects), batch_size):
+        batch = slice(start, start + batch_size)
+        overlap = (
+            (y0[batch, None] < y1[None])
+            & (y0[None] < y1[batch, None])
+            & (x0[batch, None] < x1[None])
+            & (x0[None] < x1[batch, None])
+        )
+        # a rectangle always overlaps itself
+        rows = np.arange(overlap.shape[0])
+        overlap[rows, rows + start] = False
+        if overlap.any():
+            return True
+    return False
+
+
+class _ChunkBuffers:
+    """Write-back buffers of the yx chunks of the pyramid levels.
+
+    Each buffer holds the full extent of the other axes, so that complete
+    buffers are written as whole chunks.
+    """
+
+    def __init__(self, levels: list[zarr.Array]):
+        self.levels = levels
+        self.buffers: OrderedDict[tuple[int, int, int], np.ndarray] = OrderedDict()
+        self.covered: dict[tuple[int, int, int], int] = {}
+        self.written: set[tuple[int, int, int]] = set()
+        self.nbytes = 0
+
+    def _chunk_slices(self, key: tuple[int, int, int]) -> tuple[slice, slice]:
+        level, cy, cx = key
+        array = self.levels[level]
+        ch, cw = array.chunks[-2:]
+        height, width = array.shape[-2:]
+        return (
+            slice(cy * ch, min((cy + 1) * ch, height)),
+            slice(cx * cw, min((cx + 1) * cw, width)),
+        )
+
+    def _get(self, key: tuple[int, int, int]) -> np.ndarray:
+        buffer = self.buffers.get(key)
+        if buffer is not None:
+            self.buffers.move_to_end(key)
+            return buffer
+        array = self.levels[key[0]]
+        ys, xs = self._chunk_slices(key)
+        if key in self.written:
+            buffer = array[..., ys, xs]
+        else:
+            buffer = np.full(
+                (*array.shape[:-2], ys.stop - ys.start, xs.stop - xs.start),
+                array.fill_value or 0,
+                dtype=array.dtype,
+            )
+        self.buffers[key] = buffer
+        self.nbytes += buffer.nbytes
+        return buffer
+
+    def write(self, level: int, y: int, x: int, data: np.ndarray) -> None:
+        """Write data at (y, x) of a level."""
+        array = self.levels[level]
+        ch, cw = array.chunks[-2:]
+        h, w = data.shape[-2:]
+        for cy in range(y // ch, (y + h - 1) // ch + 1):
+            for cx in range(x // cw, (x + w - 1) // cw + 1):
+                key = (level, cy, cx)
+                buffer = self._get(key)
+                ys, xs = self._chunk_slices(key)
+                oy0, oy1 = max(y, ys.start), min(y + h, ys.stop)
+                ox0, ox1 = max(x, xs.start), min(x + w, xs.stop)
+                buffer[
+                    ...,
+                    oy0 - ys.start : oy1 - ys.start,
+                    ox0 - xs.start : ox1 - xs.start,
+                ] = data[..., oy0 - y : oy1 - y, ox0 - x : ox1 - x]
+                self.covered[key] = self.covered.get(key, 0) + (oy1 - oy0) * (ox1 - ox0)
+                if self.covered[key] >= buffer.shape[-2] * buffer.shape[-1]:
+                    self.flush(key)
+
+    def flush(self, key: tuple[int, int, int]) -> None:
+        """Write a buffered chunk to its level."""
+        buffer = self.buffers.pop(key)
+        self.nbytes -= buffer.nbytes
+        ys, xs = self._chunk_slices(key)
+        self.levels[key[0]][..., ys, xs] = buffer
+        self.written.add(key)
+
+    def flush_oldest(self) -> None:
+        """Write the least recently used chunk."""
+        self.flush(next(iter(self.buffers)))
+
+    def flush_all(self) -> None:
+        """Write all the buffered chunks."""
+        while self.buffers:
+            self.flush_oldest()
+
+
+class StreamingPyramid:
+    """Build the lower levels of a pyramid from the tiles of the first level.
+
+    The tiles must not overlap, and must span the full extent of all the
+    axes but y and x.
+    """
+
+    def __init__(
+        self,
+        level0: zarr.Array,
+        levels: list[zarr.Array],
+        order: int = 1,
+        max_bytes: int = PYRAMID_BUFFER_BYTES,
+    ):
+        """Initialize the pyramid.
+
+        Args:
+            level0 (zarr.Array): The full resolution level, where the tiles are
+                written.
+            levels (list[zarr.Array]): The lower resolution levels, each half
+                the size of the previous one in y and x.
+            order (int): 1 for the mean of each 2 x 2 block, 0 for its bottom
+                right pixel.
+            max_bytes (int): Maximum size of the buffered chunks and blocks.
+        """
+        self.level0 = level0
+        self.levels = levels
+        self.order = order
+        self.max_bytes = max_bytes
+        self.block = 2 ** len(levels)
+        self.height, self.width = level0.shape[-2:]
+        self._chunks = _ChunkBuffers(levels)
+        # partially covered blocks: data and mask of the covered pixels
+        self._blocks: OrderedDict[tuple[int, int], tuple[np.ndarray, np.ndarray]] = (
+            OrderedDict()
+        )
+        self._blocks_nbytes = 0
+        self._evicted: set[tuple[int, int]] = set()
+        self._stale: set[tuple[int, int]] = set()
+
+    def _write_region(self, data: np.ndarray, y: int, x: int) -> None:
+        """Downsample a region of the first level, aligned on the blocks."""
+        for level, array in enumerate(self.levels):
+            data = downsample_yx(data, order=self.order)
+            y, x = y // 2, x // 2
+            height, width = array.shape[-2:]
+            data = data[..., : height - y, : width - x]
+            if data.shape[-2] == 0 or data.shape[-1] == 0:
+                return
+            self._chunks.write(level, y, x, data)
+
+    def _block_slices(self, by: int, bx: int) -> tuple[slice, slice]:
+        b = self.block
+        return (
+            slice(by * b, min((by + 1) * b, self.height)),
+            slice(bx * b, min((bx + 1) * b, self.width)),
+        )
+
+    def _write_block(self, key: tuple[int, int]) -> None:
+        data, _ = self._blocks.pop(key)
+        self._blocks_nbytes -= data.nbytes
+        ys, xs = self._block_slices(*key)
+        self._write_region(data, ys.start, xs.start)
+
+    def _add_to_block(
+        self, key: tuple[int, int], data: np.ndarray, y0: int, x0: int
+    ) -> None:
+        """Copy the part of a tile within a block."""
+        if key in self._evicted:
+            self._stale.add(key)
+            return
+        ys, xs = self._block_slices(*key)
+        entry = self._blocks.get(key)
+        if entry is None:
+            entry = (
+                np.zeros(
+                    (*data.shape[:-2], ys.stop - ys.start, xs.stop - xs.start),
+                    dtype=data.dtype,
+                ),
+                np.zeros((ys.stop - ys.start, xs.stop - xs.start), dtype=bool),
+            )
+            self._blocks[key] = entry
+            self._blocks_nbytes += entry[0].nbytes
+        else:
+            self._blocks.move_to_end(key)
+        block, mask = entry
+        h, w = data.shape[-2:]
+        oy0, oy1 = max(y0, ys.start), min(y0 + h, ys.stop)
+        ox0, ox1 = max(x0, xs.start), min(x0 + w, xs.stop)
+        block_yx = (
+            slice(oy0 - ys.start, oy1 - ys.start),
+            slice(ox0 - xs.start, ox1 - xs.start),
+        )
+        block[(..., *block_yx)] = data[..., oy0 - y0 : oy1 - y0, ox0 - x0 : ox1 - x0]
+        mask[block_yx] = True
+        if mask.all():
+            self._write_block(key)
+
+    def _limit_memory(self) -> None:
+        while self._chunks.nbytes + self._blocks_nbytes > self.max_bytes:
+            if self._chunks.buffers:
+                self._chunks.flush_oldest()
+            elif self._blocks:
+                key = next(iter(self._blocks))
+                self._write_block(key)
+                self._evicted.add(key)
+            else:
+                return
+
+    def add_tile(self, data: np.ndarray, y0: int, x0: int) -> None:
+        """Add a tile, written at (y0, x0) of the first level.
+
+        Args:
+            data (np.ndarray): The tile data, with the same axes as the levels.
+            y0 (int): Position of the tile along y.
+            x0 (int): Position of the tile along x.
+        """
+        if data.shape[:-2] != self.level0.shape[:-2]:
+            raise ValueError(
+                f"Tile of shape {data.shape} does not span the image of shape "
+                f"{self.level0.shape} outside of the yx plane."
+            )
+        b = self.block
+        h, w = data.shape[-2:]
+        y1, x1 = min(y0 + h, self.height), min(x0 + w, self.width)
+
+        # blocks entirely within the tile
+        iy0, ix0 = math.ceil(y0 / b) * b, math.ceil(x0 / b) * b
+        iy1 = y1 if y1 == self.height else y1 // b * b
+        ix1 = x1 if x1 == self.width else x1 // b * b
+        inner = iy1 > iy0 and ix1 > ix0
+        if inner:
+            self._write_region(
+                data[..., iy0 - y0 : iy1 - y0, ix0 - x0 : ix1 - x0], iy0, ix0
+            )
+        else:
+            iy0 = iy1 = ix0 = ix1 = 0
+
+        # blocks cut by the edges of the tile
+        inner_rows = range(iy0 // b, math.ceil(iy1 / b))
+        inner_cols = range(ix0 // b, math.ceil(ix1 / b))
+        for by in range(y0 // b, math.ceil(y1 / b)):
+            if by in inner_rows:
+                cols = [
+                    bx
+                    for bx in range(x0 // b, math.ceil(x1 / b))
+                    if bx not in inner_cols
+                ]
+            else:
+                cols = range(x0 // b, math.ceil(x1 / b))
+            for bx in cols:
+                self._add_to_block((by, bx), data, y0, x0)
+        self._limit_memory()
+
+    def finalize(self) -> None:
+        """Write the remaining blocks and chunks.
+
+        The blocks not completed by the tiles are written as they are: their
+        missing pixels are not covered by any tile. The blocks written
+        before they were complete are rebuilt from the first level.
+        """
+        while self._blocks:
+            self._write_block(next(iter(self._blocks)))
+        if self._stale:
+            logger.warning(
+                f"{len(self._stale)} pyramid blocks did not fit in memory and "
+                "are rebuilt from the full resolution level."
+            )
+        for key in sorted(self._stale):
+            ys, xs = self._block_slices(*key)
+            self._write_region(self.level0[..., ys, xs], ys.start, xs.start)
+            self._limit_memory()
+        self._stale.clear()
+        self._chunks.flush_all()
@@ -0,0 +1,103 @@
+"""Shared memory buffers to hand image data between processes."""
+
+import queue
+from collections.abc import Sequence
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+class SharedMemoryRing:
+    """A fixed number of shared memory slots, handed out in turn.
+
+    The process producing the data acquires a free slot, fills it and passes
+    the slot index to a consumer process, which releases the slot once the
+    data has been used. Since a producer blocks while all the slots are in
+    use, the memory held by the data in flight is bounded by the number of
+    slots, whatever the speed of the consumers.
+    """
+
+    def __init__(self, num_slots: int, slot_nbytes: int, context):
+        """Allocate the shared memory slots.
+
+        Args:
+            num_slots (int): Number of slots.
+            slot_nbytes (int): Size of each slot in bytes.
+            context: The multiprocessing context used to create the queue of
+                free slots.
+        """
+        if num_slots < 1:
+            raise ValueError("At least one shared memory slot is required.")
+        self.slot_nbytes = slot_nbytes
+        self.slots = []
+        self.free_slots = context.Queue()
+        try:
+            for i in range(num_slots):
+                self.slots.append(SharedMemory(create=True, size=max(slot_nbytes, 1)))
+                self.free_slots.put(i)
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def names(self) -> list[str]:
+        """Names of the shared memory slots, to attach them in other processes."""
+        return [slot.name for slot in self.slots]
+
+    def acquire(self, timeout: float | None = None) -> int:
+        """Wait for a free slot and return its index.
+
+        Raises queue.Empty if no slot is released within the timeout.
+        """
+        return self.free_slots.get(timeout=timeout)
+
+    def view(self, slot: int, shape: Sequence[int], dtype: np.dtype) -> np.ndarray:
+        """Get an array backed by the memory of a slot."""
+        return shared_array(self.slots[slot], shape, dtype)
+
+    def close(self) -> None:
+        """Release the shared memory of all the slots."""
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+        self.slots = []
+
+    def __enter__(self) -> "SharedMemoryRing":
+        """Enter the context, the slots are released on exit."""
+        return self
+
+    def __exit__(self, *args) -> None:
+        """Release the shared memory of all the slots."""
+        self.close()
+
+
+def shared_array(
+    shared_memory: SharedMemory, shape: Sequence[int], dtype: np.dtype
+) -> np.ndarray:
+    """Get an array of a given shape and dtype backed by shared memory."""
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if nbytes > shared_memory.size:
+        raise ValueError(
+            f"An array of shape {tuple(shape)} and dtype {dtype} does not fit "
+            f"in a shared memory buffer of {shared_memory.size} bytes."
+        )
+    return np.ndarray(shape, dtype=dtype, buffer=shared_memory.buf)
+
+
+def get_with_liveness_check(items: queue.Queue, processes: Sequence, poll: float = 1):
+    """Get an item from a queue, failing if a process exits in the meantime.
+
+    Used by the parent process to wait for its workers without blocking
+    forever if one of them dies.
+    """
+    while True:
+        try:
+            return items.get(timeout=poll)
+        except queue.Empty:
+            for process in processes:
+                if not process.is_alive() and process.exitcode != 0:
+                    raise RuntimeError(
+                        f"Worker process {process.name} exited with code "
+                        f"{process.exitcode}."
+                    ) from None
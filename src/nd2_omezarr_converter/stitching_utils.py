@@ -0,0 +1,163 @@
+"""Fast placement of the tiles of nd2 grid scans."""
+
+import copy
+import logging
+from typing import Literal
+
+import numpy as np
+from fractal_converters_tools import Point, Tile
+from fractal_converters_tools._stitching import (
+    check_tiles_coplanar,
+    invert_x_tiles,
+    invert_y_tiles,
+    remove_tiles_offset_xy,
+    remove_tiles_offset_zt,
+    reset_tiles_origin,
+    standard_stitching_pipe,
+    swap_xy_tiles,
+    tiles_to_pixel_space,
+)
+
+logger = logging.getLogger(__name__)
+
+# stage positions within this fraction of the tile size are the same grid line
+GRID_TOLERANCE = 0.01
+# grids with more overlap than this fraction of the tile size are not snapped
+MAX_GRID_OVERLAP = 0.5
+
+
+def _grid_lines(
+    values: np.ndarray, tolerance: float
+) -> tuple[np.ndarray, float] | None:
+    """Assign 1D positions to the lines of a regular grid.
+
+    The sorted positions are split into clusters wherever two consecutive
+    positions are more than tolerance apart. The cluster centers must then
+    lie on a regular grid (missing lines are allowed), up to the tolerance.
+
+    Returns:
+        The grid line index of each position and the grid spacing, or None
+        if the positions are not on a regular grid.
+    """
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+    sorted_labels = np.concatenate([[0], np.cumsum(np.diff(sorted_values) > tolerance)])
+    labels = np.empty_like(sorted_labels)
+    labels[order] = sorted_labels
+    centers = np.bincount(labels, weights=values) / np.bincount(labels)
+    if np.any(np.abs(values - centers[labels]) > tolerance):
+        return None
+    if len(centers) == 1:
+        return np.zeros(len(values), dtype=np.int64), 0.0
+
+    distances = centers - centers[0]
+    lines = np.rint(distances / np.diff(centers).min())
+    # least squares spacing, averaging out the jitter of the stage
+    spacing = float(np.dot(lines, distances) / np.dot(lines, lines))
+    if np.any(np.abs(distances - lines * spacing) > tolerance):
+        return None
+    return lines.astype(np.int64)[labels], spacing
+
+
+def find_grid_indices(
+    tiles: list[Tile], tolerance: float = GRID_TOLERANCE
+) -> np.ndarray | None:
+    """Find the (x, y) grid indices of tiles placed on a regular grid.
+
+    Unlike `fractal_converters_tools.check_if_regular_grid`, the stage
+    positions may deviate from the grid by up to tolerance times the tile
+    size, and the cost is O(n log n) in the number of tiles. Only grids of
+    touching or overlapping tiles, as acquired by a tile scan, are found:
+    grids with gaps between the tiles (e.g. a few separate positions), or
+    overlapping by more than MAX_GRID_OVERLAP, are rejected.
+
+    Args:
+        tiles (list[Tile]): Tiles of the same size, in real space.
+        tolerance (float): Maximum deviation from the grid, as a fraction of
+            the tile size.
+
+    Returns:
+        A (n, 2) array of the x and y grid indices of the tiles, or None if
+        the tiles are not on a regular grid or two tiles share a grid cell.
+    """
+    if len(tiles) < 2:
+        return None
+    lengths = np.array([[tile.diag.x, tile.diag.y] for tile in tiles])
+    if not np.allclose(lengths, lengths[0]):
+        return None
+    tolerance = tolerance * float(lengths[0].min())
+
+    indices = []
+    for axis, length in zip(("x", "y"), lengths[0], strict=True):
+        values = np.array([getattr(tile.top_l, axis) for tile in tiles])
+        lines = _grid_lines(values, tolerance)
+        if lines is None:
+            return None
+        line_indices, spacing = lines
+        if spacing > 0 and not (
+            (1 - MAX_GRID_OVERLAP) * length <= spacing <= length + tolerance
+        ):
+            return None
+        indices.append(line_indices)
+    indices = np.stack(indices, axis=1)
+    if len(np.unique(indices, axis=0)) != len(tiles):
+        return None
+    return indices
+
+
+def snap_tiles_to_grid(tiles: list[Tile], grid_indices: np.ndarray) -> list[Tile]:
+    """Place the tiles side by side on their grid cells, in pixel space.
+
+    Same result as the grid mode of `standard_stitching_pipe`: the tiles are
+    ordered by x and y grid index, and the tile in grid cell (i, j) is
+    placed at (i, j) times the tile size in pixels.
+    """
+    order = np.lexsort((grid_indices[:, 1], grid_indices[:, 0]))
+    pixel_tiles = tiles_to_pixel_space([tiles[k] for k in order])
+    size_x, size_y = pixel_tiles[0].diag.x, pixel_tiles[0].diag.y
+    snapped = []
+    for tile, (i, j) in zip(pixel_tiles, grid_indices[order].tolist(), strict=True):
+        top_l = Point(
+            i * size_x, j * size_y, z=tile.top_l.z, c=tile.top_l.c, t=tile.top_l.t
+        )
+        snapped.append(tile.derive_from_diag(top_l, diag=tile.diag))
+    return snapped
+
+
+def nd2_stitching_pipe(
+    tiles: list[Tile],
+    mode: Literal["auto", "grid", "free", "none"] = "auto",
+    swap_xy: bool = False,
+    invert_x: bool = False,
+    invert_y: bool = False,
+) -> list[Tile]:
+    """Stitching pipe with a fast path for the regular grids of nd2 scans.
+
+    In "auto" and "grid" modes, the tiles are snapped to a regular grid found
+    with `find_grid_indices`. If no grid is found, or in the other modes, the
+    tiles go through `fractal_converters_tools.standard_stitching_pipe`.
+    """
+    if mode in ("auto", "grid"):
+        check_tiles_coplanar(tiles)
+        grid_tiles = copy.deepcopy(tiles)
+        if swap_xy:
+            grid_tiles = swap_xy_tiles(grid_tiles)
+        if invert_x:
+            grid_tiles = invert_x_tiles(grid_tiles)
+        if invert_y:
+            grid_tiles = invert_y_tiles(grid_tiles)
+        if any([swap_xy, invert_x, invert_y]):
+            grid_tiles = reset_tiles_origin(grid_tiles)
+        grid_tiles = remove_tiles_offset_xy(grid_tiles)
+        grid_tiles = remove_tiles_offset_zt(grid_tiles)
+
+        grid_indices = find_grid_indices(grid_tiles)
+        if grid_indices is not None:
+            num_x, num_y = grid_indices.max(axis=0) + 1
+            logger.info(f"Tiles placed on a regular {num_x} x {num_y} grid.")
+            return snap_tiles_to_grid(grid_tiles, grid_indices)
+        logger.info("Tiles not on a regular grid, using the standard pipe.")
+
+    return standard_stitching_pipe(
+        tiles, mode=mode, swap_xy=swap_xy, invert_x=invert_x, invert_y=invert_y
+    )
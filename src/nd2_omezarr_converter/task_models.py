@@ -0,0 +1,121 @@
+"""Shared models for the nd2 to OME-Zarr conversion tasks."""
+
+from typing import Literal
+
+from fractal_converters_tools import AdvancedComputeOptions, ConvertParallelInitArgs
+from pydantic import BaseModel, Field
+
+
+class AdvancedOptions(AdvancedComputeOptions):
+    """Advanced options for the conversion.
+
+    Attributes:
+        num_levels (int): The number of resolution levels in the pyramid.
+        tiling_mode (Literal["auto", "grid", "free", "none"]): Specify the tiling mode.
+            "auto" will automatically determine the tiling mode.
+            "grid" if the input data is a grid, it will be tiled using snap-to-grid.
+            "free" will remove any overlap between tiles using a snap-to-corner
+            approach.
+            "none" will write the positions as is, using the microscope metadata.
+        swap_xy (bool): Swap x and y axes coordinates in the metadata. This is sometimes
+            necessary to ensure correct image tiling and registration.
+        invert_x (bool): Invert x axis coordinates in the metadata. This is
+            sometimes necessary to ensure correct image tiling and registration.
+        invert_y (bool): Invert y axis coordinates in the metadata. This is
+            sometimes necessary to ensure correct image tiling and registration.
+        max_xy_chunk (int): XY chunk size is set as the minimum of this value and the
+            microscope tile size.
+        z_chunk (int): Z chunk size.
+        c_chunk (int): C chunk size.
+        t_chunk (int): T chunk size.
+        xy_binning (int): XY bin factor applied while reading the nd2 frames.
+            The pixel size is scaled accordingly. 1 disables binning.
+        binning_reducer (Literal["mean", "sum", "max"]): How the pixels of a bin
+            are combined. "sum" promotes integer data to 32 bit to avoid
+            overflows.
+        z_step (int): Only convert every z_step-th z-plane. The z spacing is
+            scaled accordingly.
+        output_dtype (Literal["source", "uint8", "uint16"]): Data type of the
+            output. "source" keeps the data type of the nd2 files. "uint8" and
+            "uint16" linearly rescale each channel between the rescale
+            percentiles, e.g. to reduce 16 bit data to 8 bit, or to stretch 12
+            bit camera data to the full 16 bit range.
+        rescale_low_percentile (float): Percentile of each channel mapped to 0
+            when rescaling.
+        rescale_high_percentile (float): Percentile of each channel mapped to the
+            maximum of output_dtype when rescaling.
+        rescale_sample_frames (int): Number of frames per nd2 file sampled to
+            compute the rescale percentiles.
+        projection (Literal["none", "mip", "mean", "sum"]): Also write a z
+            projection of every 3D image as an additional OME-Zarr image, computed
+            from the data read for the 3D image. "mip" is a maximum intensity
+            projection. The projected images are stored next to the 3D images,
+            in a zarr with the "_{projection}" suffix.
+        max_images_per_job (int): Convert up to this many small images in a single
+            compute job, to reduce the per-job overhead when converting folders
+            with many small nd2 files. 1 disables batching.
+        max_job_size_mb (float): Images are only batched together as long as the
+            total uncompressed size of the job stays below this size (MB).
+        num_writer_processes (int): Number of processes compressing and writing
+            the tiles of an image. With more than one, the nd2 frames are read
+            into shared memory buffers by the compute task process, and written
+            in parallel by the writer processes. Useful when the compute task
+            has several CPUs.
+        num_decode_threads (int | None): Number of threads decoding the frames
+            of nd2 files saved with lossless compression. If not set, one
+            thread per CPU allocated to the compute task (cpus_per_task) is
+            used. Uncompressed files are always read by a single thread.
+        streaming_pyramid (bool): Write the lower resolution levels of the
+            pyramid while the tiles are written, by downsampling each tile in
+            memory, instead of reading the full resolution image back once it
+            is written. The result is identical when the image size is
+            divisible by 2^(num_levels - 1), and only differs at the last
+            pixels of each level otherwise. Images with overlapping tiles are
+            always built by reading the image back.
+        chunking (Literal["static", "auto"]): "static" uses max_xy_chunk,
+            z_chunk, c_chunk and t_chunk for every image. "auto" chooses the
+            chunk shape of each image from its tile shape, its data type and
+            access_profile, with chunks of at most target_chunk_mb. The chosen
+            chunk shape is logged by the compute task.
+        access_profile (Literal["per-plane", "per-timepoint", "volumetric"]):
+            How the images are read downstream, for "auto" chunking.
+            "per-plane" chunks single z-planes, "per-timepoint" whole
+            z-stacks, and "volumetric" 3D blocks as close to cubes as the
+            target size allows.
+        target_chunk_mb (float): Maximum uncompressed size (MB) of a chunk,
+            for "auto" chunking.
+    """
+
+    # set invert_y to True by default
+    # (for use with ZMB Nikon SD microscope, test for others)
+    invert_y: bool = True
+    xy_binning: int = Field(default=1, ge=1)
+    binning_reducer: Literal["mean", "sum", "max"] = "mean"
+    z_step: int = Field(default=1, ge=1)
+    output_dtype: Literal["source", "uint8", "uint16"] = "source"
+    rescale_low_percentile: float = Field(default=0.0, ge=0, le=100)
+    rescale_high_percentile: float = Field(default=100.0, ge=0, le=100)
+    rescale_sample_frames: int = Field(default=32, ge=1)
+    projection: Literal["none", "mip", "mean", "sum"] = "none"
+    max_images_per_job: int = Field(default=1, ge=1)
+    max_job_size_mb: float = Field(default=1024, gt=0)
+    num_writer_processes: int = Field(default=1, ge=1)
+    num_decode_threads: int | None = Field(default=None, ge=1)
+    streaming_pyramid: bool = False
+    chunking: Literal["static", "auto"] = "static"
+    access_profile: Literal["per-plane", "per-timepoint", "volumetric"] = "per-plane"
+    target_chunk_mb: float = Field(default=16.0, gt=0)
+
+
+class BatchedImageArgs(BaseModel):
+    """An additional image converted in the same compute job."""
+
+    zarr_url: str
+    tiled_image_pickled_path: str
+
+
+class ConvertNd2InitArgs(ConvertParallelInitArgs):
+    """Arguments for the compute task."""
+
+    advanced_compute_options: AdvancedOptions
+    batched_images: list[BatchedImageArgs] = Field(default_factory=list)
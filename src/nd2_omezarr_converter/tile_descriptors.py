@@ -0,0 +1,313 @@
+"""Compact array-backed descriptors of the tiles of nd2 tiled images.
+
+The init task hands the tiled images to the compute tasks through files in
+the zarr directory. Pickling the tiled images stores a Tile, Point, Vector,
+PixelSize and nd2TileLoader object per tile, which is large and slow to load
+for scans with thousands of positions. All the tiles of a nd2 tiled image
+share their pixel size and loader options, so they are stored instead as a
+small header and a few arrays (positions, extents, origins and position
+indices) in a `.npz` file, and the tiles are rebuilt by the compute task.
+"""
+
+import json
+import logging
+import os
+import time
+from collections.abc import Sequence
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+from fractal_converters_tools import (
+    OriginDict,
+    PlatePathBuilder,
+    Point,
+    SimplePathBuilder,
+    Tile,
+    TiledImage,
+    Vector,
+)
+from fractal_converters_tools._pkl_utils import create_pkl, load_tiled_image
+from fractal_converters_tools._tile import TileSpace
+from ngio import PixelSize
+
+from nd2_omezarr_converter.nd2_utils import nd2TileLoader
+
+logger = logging.getLogger(__name__)
+
+DESCRIPTOR_SUFFIX = ".npz"
+
+# loader options shared by all the tiles of a tiled image
+_LOADER_OPTIONS = (
+    "path",
+    "channels",
+    "t_indices",
+    "z_indices",
+    "xy_binning",
+    "binning_reducer",
+    "output_dtype",
+    "rescale_limits",
+)
+
+
+def _encode_indices(indices: Sequence[int] | None) -> dict | list | None:
+    """Encode loader indices (None, a range or a sequence) as JSON."""
+    if indices is None:
+        return None
+    if isinstance(indices, range):
+        return {"start": indices.start, "stop": indices.stop, "step": indices.step}
+    return [int(i) for i in indices]
+
+
+def _decode_indices(value: dict | list | None) -> Sequence[int] | None:
+    """Decode loader indices encoded by `_encode_indices`."""
+    if isinstance(value, dict):
+        return range(value["start"], value["stop"], value["step"])
+    return value
+
+
+def _encode_path_builder(path_builder) -> dict | None:
+    if isinstance(path_builder, PlatePathBuilder):
+        return {
+            "type": "plate",
+            "plate_name": path_builder.plate_name,
+            "row": path_builder.row,
+            "column": path_builder.column,
+            "acquisition_id": path_builder.acquisition_id,
+        }
+    if isinstance(path_builder, SimplePathBuilder):
+        return {"type": "simple", "path": path_builder.path}
+    return None
+
+
+def _decode_path_builder(value: dict) -> PlatePathBuilder | SimplePathBuilder:
+    value = dict(value)
+    if value.pop("type") == "plate":
+        return PlatePathBuilder(**value)
+    return SimplePathBuilder(**value)
+
+
+def _loader_options(loader: nd2TileLoader) -> dict:
+    options = {name: getattr(loader, name) for name in _LOADER_OPTIONS}
+    # nd2 files may be given as Path objects
+    options["path"] = str(options["path"])
+    options["channels"] = _encode_indices(options["channels"])
+    options["t_indices"] = _encode_indices(options["t_indices"])
+    options["z_indices"] = _encode_indices(options["z_indices"])
+    if options["rescale_limits"] is not None:
+        options["rescale_limits"] = [
+            [int(low), int(high)] for low, high in options["rescale_limits"]
+        ]
+    return options
+
+
+def _pixel_size_dict(pixel_size: PixelSize) -> dict:
+    return {
+        "x": pixel_size.x,
+        "y": pixel_size.y,
+        "z": pixel_size.z,
+        "t": pixel_size.t,
+        "space_unit": pixel_size.space_unit,
+        "time_unit": pixel_size.time_unit,
+    }
+
+
+class Nd2TiledImageDescriptor:
+    """The tiles of a nd2 tiled image, stored as arrays.
+
+    Attributes:
+        header (dict): The tiled image metadata, pixel size and loader options
+            shared by all the tiles.
+        top_l (np.ndarray): (n, 5) top left corners (x, y, z, c, t) of the tiles.
+        diag (np.ndarray): (n, 5) diagonals (x, y, z, c, t) of the tiles.
+        origin (np.ndarray): (n, 3) original (x, y, z) positions of the tiles.
+        positions (np.ndarray): (n,) nd2 position index of each tile, -1 for
+            files without a position loop.
+    """
+
+    def __init__(
+        self,
+        header: dict,
+        top_l: np.ndarray,
+        diag: np.ndarray,
+        origin: np.ndarray,
+        positions: np.ndarray,
+    ):
+        """Initialize the descriptor from its header and arrays."""
+        self.header = header
+        self.top_l = top_l
+        self.diag = diag
+        self.origin = origin
+        self.positions = positions
+
+    def __len__(self) -> int:
+        """Number of tiles."""
+        return len(self.positions)
+
+    @classmethod
+    def from_tiled_image(
+        cls, tiled_image: TiledImage
+    ) -> "Nd2TiledImageDescriptor | None":
+        """Describe the tiles of a tiled image with arrays.
+
+        Returns None if the tiled image cannot be described: its tiles are
+        not all loaded from the same nd2 file with the same options and pixel
+        size, or its path builder is not a plate or simple path builder.
+        """
+        path_builder = _encode_path_builder(tiled_image.path_builder)
+        tiles = tiled_image.tiles
+        if path_builder is None or not tiles:
+            return None
+
+        # the tile loader and explicit shape are not exposed publicly by
+        # fractal_converters_tools
+        loaders = [tile._data_loader for tile in tiles]
+        if not all(isinstance(loader, nd2TileLoader) for loader in loaders):
+            return None
+        loader_options = _loader_options(loaders[0])
+        pixel_size = _pixel_size_dict(tiles[0].pixel_size)
+        for tile, loader in zip(tiles, loaders, strict=True):
+            if (
+                tile._shape is not None
+                or tile.space != tiles[0].space
+                or _pixel_size_dict(tile.pixel_size) != pixel_size
+                or _loader_options(loader) != loader_options
+            ):
+                return None
+
+        header = {
+            "name": str(tiled_image._name),
+            "path_builder": path_builder,
+            "channel_names": tiled_image.channel_names,
+            "wavelength_ids": tiled_image.wavelength_ids,
+            "attributes": tiled_image.attributes,
+            "pixel_size": pixel_size,
+            "space": tiles[0].space.value,
+            "loader": loader_options,
+        }
+        return cls(
+            header=header,
+            top_l=np.array(
+                [
+                    [t.top_l.x, t.top_l.y, t.top_l.z, t.top_l.c, t.top_l.t]
+                    for t in tiles
+                ],
+                dtype=np.float64,
+            ),
+            diag=np.array(
+                [[t.diag.x, t.diag.y, t.diag.z, t.diag.c, t.diag.t] for t in tiles],
+                dtype=np.float64,
+            ),
+            origin=np.array([tuple(tile.origin) for tile in tiles], dtype=np.float64),
+            positions=np.array(
+                [-1 if loader.p is None else loader.p for loader in loaders],
+                dtype=np.int64,
+            ),
+        )
+
+    def to_tiled_image(self) -> TiledImage:
+        """Rebuild the tiled image and its tiles."""
+        header = self.header
+        tiled_image = TiledImage(
+            name=header["name"],
+            path_builder=_decode_path_builder(header["path_builder"]),
+            channel_names=header["channel_names"],
+            wavelength_ids=header["wavelength_ids"],
+            attributes=header["attributes"] or None,
+        )
+        pixel_size = PixelSize(**header["pixel_size"])
+        space = TileSpace(header["space"])
+        loader_options = dict(header["loader"])
+        path = loader_options.pop("path")
+        for name in ("channels", "t_indices", "z_indices"):
+            loader_options[name] = _decode_indices(loader_options[name])
+        if loader_options["rescale_limits"] is not None:
+            loader_options["rescale_limits"] = [
+                tuple(limits) for limits in loader_options["rescale_limits"]
+            ]
+
+        for top_l, diag, origin, p in zip(
+            self.top_l.tolist(),
+            self.diag.tolist(),
+            self.origin.tolist(),
+            self.positions.tolist(),
+            strict=True,
+        ):
+            x, y, z, c, t = top_l
+            d_x, d_y, d_z, d_c, d_t = diag
+            tiled_image.add_tile(
+                Tile(
+                    top_l=Point(x=x, y=y, z=z, c=int(c), t=int(t)),
+                    diag=Vector(x=d_x, y=d_y, z=d_z, c=int(d_c), t=int(d_t)),
+                    pixel_size=pixel_size,
+                    origin=OriginDict(*origin),
+                    space=space,
+                    data_loader=nd2TileLoader(
+                        path=path, p=None if p < 0 else p, **loader_options
+                    ),
+                )
+            )
+        return tiled_image
+
+    def save(self, path: str | Path) -> None:
+        """Save the descriptor to a `.npz` file."""
+        with open(path, "wb") as f:
+            np.savez_compressed(
+                f,
+                header=np.frombuffer(json.dumps(self.header).encode(), dtype=np.uint8),
+                top_l=self.top_l,
+                diag=self.diag,
+                origin=self.origin,
+                positions=self.positions,
+            )
+
+    @classmethod
+    def load(cls, path: str | Path) -> "Nd2TiledImageDescriptor":
+        """Load a descriptor saved with `save`."""
+        with np.load(path) as data:
+            return cls(
+                header=json.loads(data["header"].tobytes()),
+                top_l=data["top_l"],
+                diag=data["diag"],
+                origin=data["origin"],
+                positions=data["positions"],
+            )
+
+
+def save_tiled_image(pickle_dir: Path, tiled_image: TiledImage) -> Path:
+    """Save a tiled image for a compute task.
+
+    nd2 tiled images are saved as a compact descriptor, other tiled images
+    are pickled.
+    """
+    descriptor = Nd2TiledImageDescriptor.from_tiled_image(tiled_image)
+    if descriptor is None:
+        return create_pkl(pickle_dir=pickle_dir, tiled_image=tiled_image)
+    pickle_dir.mkdir(parents=True, exist_ok=True)
+    path = pickle_dir / f"{uuid4()}{DESCRIPTOR_SUFFIX}"
+    descriptor.save(path)
+    logger.info(f"Tile descriptors created: {path}")
+    return path
+
+
+def load_saved_tiled_image(path: Path) -> TiledImage:
+    """Load a tiled image saved with `save_tiled_image`.
+
+    As for pickled tiled images, loading is retried if the file is not found,
+    in case it is not visible yet on a shared filesystem.
+    """
+    path = Path(path)
+    if path.suffix != DESCRIPTOR_SUFFIX:
+        return load_tiled_image(path)
+
+    num_retries = int(os.getenv("CONVERTERS_TOOLS_NUM_RETRIES", 5))
+    for t in range(num_retries):
+        try:
+            return Nd2TiledImageDescriptor.load(path).to_tiled_image()
+        except FileNotFoundError:
+            logger.error(f"Tile descriptors file does not exist: {path}")
+            if t < num_retries - 1:
+                time.sleep(2 ** (t + 1))
+    raise FileNotFoundError(
+        f"Tile descriptors file does not exist after {num_retries} retries: {path}"
+    )
@@ -0,0 +1,189 @@
+"""Optional long running worker service for the nd2 compute task.
+
+Every compute job of a Fractal task runs in a fresh python process, which
+pays for the imports and opens the nd2 files from scratch. On a single large
+node, a worker service started once keeps the imports and the nd2 files open
+(see `Nd2HandlePool`) and runs the jobs forwarded by the compute task.
+
+Start the service with:
+
+    python -m nd2_omezarr_converter.worker_service --socket /tmp/nd2.sock
+
+and set the ND2_CONVERTER_WORKER_SOCKET environment variable of the compute
+tasks to the same socket path. Without the variable, or if the service is not
+reachable, the compute task converts the images itself. The profiling
+variables of the compute task (see `profiling_utils`) are sent with its jobs,
+the ones set when starting the service are ignored.
+
+The service converts one job at a time: the jobs set process-wide state
+(the number of nd2 decode threads, the profilers), so concurrent jobs in one
+process would overwrite each other's settings. The other jobs wait for their
+turn. To convert several jobs at once, start one service per job slot, each
+with its own socket, or use `num_writer_processes` and `num_decode_threads`
+to parallelize within a job.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import traceback
+from pathlib import Path
+
+from nd2_omezarr_converter.compute_utils import compute_batched_tiled_images
+from nd2_omezarr_converter.nd2_utils import Nd2HandlePool, set_handle_pool
+from nd2_omezarr_converter.profiling_utils import profile_settings_from_env
+from nd2_omezarr_converter.task_models import ConvertNd2InitArgs
+
+logger = logging.getLogger(__name__)
+
+WORKER_SOCKET_ENV = "ND2_CONVERTER_WORKER_SOCKET"
+
+
+def worker_socket_path() -> Path | None:
+    """Get the socket of the worker service from the environment, if set."""
+    path = os.environ.get(WORKER_SOCKET_ENV)
+    return Path(path) if path else None
+
+
+def _send_message(connection: socket.socket, message: dict) -> None:
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+def _receive_message(stream) -> dict:
+    line = stream.readline()
+    if not line:
+        raise ConnectionError("The connection was closed without a message.")
+    return json.loads(line)
+
+
+class _JobHandler(socketserver.StreamRequestHandler):
+    """Run one convert job per connection."""
+
+    def handle(self) -> None:
+        try:
+            request = _receive_message(self.rfile)
+            with self.server.job_lock:
+                logger.info(f"Converting {request['zarr_url']}")
+                result = compute_batched_tiled_images(
+                    zarr_url=request["zarr_url"],
+                    init_args=ConvertNd2InitArgs(**request["init_args"]),
+                    profile_settings=request.get("profile_settings", {}),
+                )
+            response = {"ok": True, "result": result}
+        except Exception:
+            logger.exception("Job failed.")
+            response = {"ok": False, "error": traceback.format_exc()}
+        _send_message(self.connection, response)
+
+
+class WorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server running the forwarded compute jobs, one at a time."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str | Path):
+        """Bind the server to a socket only accessible to the current user.
+
+        Args:
+            socket_path (str | Path): Path of the Unix socket.
+        """
+        # connections are accepted concurrently, but jobs share process-wide
+        # state and are converted one after the other
+        self.job_lock = threading.Lock()
+        socket_path = Path(socket_path)
+        if socket_path.exists():
+            # a stale socket is left behind when the service is killed
+            socket_path.unlink()
+        umask = os.umask(0o177)
+        try:
+            super().__init__(str(socket_path), _JobHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self) -> None:
+        """Close the server and remove the socket."""
+        super().server_close()
+        Path(self.server_address).unlink(missing_ok=True)
+
+
+def serve(socket_path: str | Path, max_open_files: int = 32):
+    """Run the worker service until interrupted.
+
+    Jobs are converted one at a time (see the module documentation).
+
+    Args:
+        socket_path (str | Path): Path of the Unix socket.
+        max_open_files (int): Maximum number of nd2 files kept open.
+    """
+    pool = Nd2HandlePool(max_open=max_open_files)
+    set_handle_pool(pool)
+    try:
+        with WorkerServer(socket_path) as server:
+            logger.info(f"Worker service listening on {socket_path}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                logger.info("Worker service stopped.")
+    finally:
+        set_handle_pool(None)
+        pool.close()
+
+
+def submit_job(
+    socket_path: str | Path,
+    zarr_url: str,
+    init_args: dict,
+    profile_settings: dict[str, str] | None = None,
+) -> dict:
+    """Run a compute job in the worker service and wait for its result.
+
+    The job is profiled with profile_settings, by default the profiling
+    variables of the environment of the caller.
+
+    Raises:
+        OSError: If the service is not reachable. The job was not started.
+        RuntimeError: If the job failed in the service, or the connection to
+            the service was lost while the job was running.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(str(socket_path))
+        try:
+            request = {
+                "zarr_url": zarr_url,
+                "init_args": init_args,
+                "profile_settings": (
+                    profile_settings_from_env()
+                    if profile_settings is None
+                    else profile_settings
+                ),
+            }
+            _send_message(connection, request)
+            with connection.makefile("rb") as stream:
+                response = _receive_message(stream)
+        except OSError as e:
+            raise RuntimeError(f"Lost the connection to the worker service: {e}") from e
+    if not response["ok"]:
+        raise RuntimeError(
+            f"The job failed in the worker service:\n{response['error']}"
+        )
+    return response["result"]
+
+
+def main():
+    """Command line entry point of the worker service."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", required=True, help="Path of the Unix socket.")
+    parser.add_argument(
+        "--max-open-files", type=int, default=32, help="nd2 files kept open."
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(args.socket, max_open_files=args.max_open_files)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,22 @@ def convert_nd2_to_omezarr(
     z_chunk: int = 10,
     c_chunk: int = 1,
     t_chunk: int = 1,
+    xy_binning: int = 1,
+    binning_reducer: Literal["mean", "sum", "max"] = "mean",
+    z_step: int = 1,
+    output_dtype: Literal["source", "uint8", "uint16"] = "source",
+    rescale_low_percentile: float = 0.0,
+    rescale_high_percentile: float = 100.0,
+    rescale_sample_frames: int = 32,
+    projection: Literal["none", "mip", "mean", "sum"] = "none",
+    max_images_per_job: int = 1,
+    max_job_size_mb: float = 1024,
+    num_writer_processes: int = 1,
+    num_decode_threads: int | None = None,
+    streaming_pyramid: bool = False,
+    chunking: Literal["static", "auto"] = "static",
+    access_profile: Literal["per-plane", "per-timepoint", "volumetric"] = "per-plane",
+    target_chunk_mb: float = 16.0,
 ):
     """Convert ND2 file(s) to OME-Zarr format.
 
@@ -52,6 +68,37 @@ def convert_nd2_to_omezarr(
         z_chunk (int): Z chunk size.
         c_chunk (int): C chunk size.
         t_chunk (int): T chunk size.
+        xy_binning (int): XY bin factor applied while reading the nd2 frames.
+        binning_reducer (Literal["mean", "sum", "max"]): How the pixels of a bin
+            are combined.
+        z_step (int): Only convert every z_step-th z-plane.
+        output_dtype (Literal["source", "uint8", "uint16"]): Data type of the
+            output. "source" keeps the data type of the nd2 files, otherwise each
+            channel is linearly rescaled between the rescale percentiles.
+        rescale_low_percentile (float): Percentile of each channel mapped to 0.
+        rescale_high_percentile (float): Percentile of each channel mapped to the
+            maximum of output_dtype.
+        rescale_sample_frames (int): Number of frames per nd2 file sampled to
+            compute the rescale percentiles.
+        projection (Literal["none", "mip", "mean", "sum"]): Also write a z
+            projection of every 3D image as an additional OME-Zarr image.
+        max_images_per_job (int): Convert up to this many small images in a single
+            compute job. 1 disables batching.
+        max_job_size_mb (float): Maximum total uncompressed size (MB) of the
+            images of a batched compute job.
+        num_writer_processes (int): Number of processes compressing and writing
+            the tiles of an image.
+        num_decode_threads (int | None): Number of threads decoding compressed
+            nd2 frames. If None, one thread per available CPU is used.
+        streaming_pyramid (bool): Write the pyramid levels while the tiles are
+            written, instead of reading the image back.
+        chunking (Literal["static", "auto"]): "auto" chooses the chunk shape of
+            each image from its tiles, data type and access_profile, instead of
+            max_xy_chunk, z_chunk, c_chunk and t_chunk.
+        access_profile (Literal["per-plane", "per-timepoint", "volumetric"]):
+            How the images are read downstream, for "auto" chunking.
+        target_chunk_mb (float): Maximum uncompressed size (MB) of a chunk, for
+            "auto" chunking.
     """
     if isinstance(acquisitions, str | Path):
         acquisitions = [Nd2InputModel(path=str(acquisitions))]
@@ -69,6 +116,22 @@ def convert_nd2_to_omezarr(
             z_chunk=z_chunk,
             c_chunk=c_chunk,
             t_chunk=t_chunk,
+            xy_binning=xy_binning,
+            binning_reducer=binning_reducer,
+            z_step=z_step,
+            output_dtype=output_dtype,
+            rescale_low_percentile=rescale_low_percentile,
+            rescale_high_percentile=rescale_high_percentile,
+            rescale_sample_frames=rescale_sample_frames,
+            projection=projection,
+            max_images_per_job=max_images_per_job,
+            max_job_size_mb=max_job_size_mb,
+            num_writer_processes=num_writer_processes,
+            num_decode_threads=num_decode_threads,
+            streaming_pyramid=streaming_pyramid,
+            chunking=chunking,
+            access_profile=access_profile,
+            target_chunk_mb=target_chunk_mb,
         ),
     )
 
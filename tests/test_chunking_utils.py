@@ -0,0 +1,34 @@
+import logging
+
+import pytest
+
+from nd2_omezarr_converter.chunking_utils import auto_chunk_shape
+
+
+@pytest.mark.parametrize(
+    "access_profile, tile_shape, expected",
+    [
+        ("per-plane", (1, 2, 3, 2048, 2048), (1, 1, 1, 2048, 2048)),
+        ("per-plane", (1, 1, 1, 4096, 4096), (1, 1, 1, 2048, 2048)),
+        ("per-plane", (1, 1, 5, 300, 400), (1, 1, 1, 300, 400)),
+        ("per-timepoint", (1, 2, 3, 2048, 2048), (1, 1, 3, 1024, 1024)),
+        ("per-timepoint", (2000, 1, 100, 2048, 2048), (1, 1, 100, 256, 256)),
+        ("volumetric", (1, 1, 100, 2048, 2048), (1, 1, 100, 256, 256)),
+        ("volumetric", (1, 1, 2000, 256, 256), (1, 1, 250, 128, 128)),
+    ],
+)
+def test_auto_chunk_shape(access_profile, tile_shape, expected):
+    chunks = auto_chunk_shape(tile_shape, itemsize=2, access_profile=access_profile)
+    assert chunks == expected
+
+
+def test_auto_chunk_shape_logs_rationale(caplog):
+    with caplog.at_level(logging.INFO):
+        auto_chunk_shape((1, 1, 1, 300, 400), itemsize=1, target_chunk_mb=1)
+    assert "(1, 1, 1, 300, 400), 0.12 MB per chunk" in caplog.text
+    assert "below the target" in caplog.text
+
+
+def test_auto_chunk_shape_unknown_profile():
+    with pytest.raises(ValueError, match="Unknown access profile"):
+        auto_chunk_shape((1, 1, 1, 16, 16), itemsize=1, access_profile="random")
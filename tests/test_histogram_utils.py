@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from nd2_omezarr_converter.histogram_utils import StreamingHistogram
+
+
+def test_streaming_histogram():
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 4096, size=(2, 64, 64), dtype=np.uint16)
+
+    histogram = StreamingHistogram.for_dtype(num_channels=2, dtype=np.uint16, bits=12)
+    assert histogram.num_bins == 4096
+    histogram.update(0, data[0, :32])
+    histogram.update(1, data[1])
+
+    other = StreamingHistogram.for_dtype(num_channels=2, dtype=np.uint16, bits=12)
+    other.update(0, data[0, 32:])
+    histogram.merge(other)
+
+    assert histogram.percentiles(0) == [data[0].min(), data[1].min()]
+    assert histogram.percentiles(100) == [data[0].max(), data[1].max()]
+    for c in range(2):
+        median = histogram.percentiles(50)[c]
+        assert abs(median - np.percentile(data[c], 50)) <= 1
+
+    with pytest.raises(ValueError):
+        histogram.merge(StreamingHistogram(num_channels=1, num_bins=4096))
+    with pytest.raises(ValueError):
+        histogram.percentiles(101)
+
+
+def test_streaming_histogram_overflow():
+    # values above the significant bits are counted in the last bin
+    histogram = StreamingHistogram.for_dtype(num_channels=1, dtype=np.uint16, bits=8)
+    histogram.update(0, np.array([1, 2, 300, 65535], dtype=np.uint16))
+    assert histogram.counts.sum() == 4
+    assert histogram.counts[0, 255] == 2
+    assert histogram.percentiles(100) == [255]
+
+    histogram.update(0, np.zeros(10, dtype=np.uint16))
+    assert histogram.percentiles(50) == [0]
+    assert histogram.percentiles(50, ignore_zeros=True) == [2]
+
+    assert StreamingHistogram.for_dtype(1, np.uint8).num_bins == 256
+    with pytest.raises(ValueError):
+        StreamingHistogram.for_dtype(1, np.float32)
@@ -0,0 +1,278 @@
+from functools import partial
+
+import numpy as np
+import numpy.testing as npt
+import pytest
+from fractal_converters_tools import (
+    OriginDict,
+    Point,
+    SimplePathBuilder,
+    Tile,
+    TiledImage,
+    Vector,
+)
+from fractal_converters_tools._stitching import standard_stitching_pipe
+from ngio import PixelSize, open_ome_zarr_container
+
+from nd2_omezarr_converter import image_writers
+from nd2_omezarr_converter.image_writers import (
+    _chunk_conflict_groups,
+    project_z,
+    set_channel_windows,
+    write_tiled_image,
+)
+
+
+class NumpyTileLoader:
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def dtype(self):
+        return str(self.data.dtype)
+
+    def load(self):
+        return self.data
+
+
+def _tiled_image(tiles_data, pixel_size=0.5, path="test"):
+    tiled_image = TiledImage(
+        name=path,
+        path_builder=SimplePathBuilder(path=path),
+        channel_names=["DAPI", "GFP"],
+        wavelength_ids=["450", "510"],
+    )
+    for i, data in enumerate(tiles_data):
+        t, c, z, y, x = data.shape
+        top_l = Point(x=i * x * pixel_size, y=0, z=0, c=0, t=0)
+        tiled_image.add_tile(
+            Tile(
+                top_l=top_l,
+                diag=Vector(x=x * pixel_size, y=y * pixel_size, z=z, c=c, t=t),
+                pixel_size=PixelSize(x=pixel_size, y=pixel_size, z=1),
+                origin=OriginDict(),
+                data_loader=NumpyTileLoader(data),
+            )
+        )
+    return tiled_image
+
+
+def test_write_tiled_image_channel_windows(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    tiles_data = [
+        rng.integers(1, 1000, size=(1, 2, 3, 32, 32), dtype=np.uint16),
+        rng.integers(500, 4000, size=(1, 2, 3, 32, 32), dtype=np.uint16),
+    ]
+    tiled_image = _tiled_image(tiles_data)
+    zarr_url = tmp_path / "test.zarr"
+    initial_channels = None
+
+    def record_initial_channels(ome_zarr_container, histogram):
+        nonlocal initial_channels
+        initial_channels = ome_zarr_container.image_meta.channels_meta.channels
+        set_channel_windows(ome_zarr_container, histogram)
+
+    monkeypatch.setattr(image_writers, "set_channel_windows", record_initial_channels)
+    types = write_tiled_image(
+        zarr_url=zarr_url,
+        tiled_image=tiled_image,
+        stiching_pipe=partial(standard_stitching_pipe, mode="none"),
+        num_levels=2,
+    )
+    assert types == {str(zarr_url): {"is_3D": True, "has_time": False}}
+
+    container = open_ome_zarr_container(zarr_url)
+    image = container.get_image()
+    data = image.get_array(mode="numpy")
+    npt.assert_array_equal(data[:, :, :, :32], tiles_data[0][0])
+    npt.assert_array_equal(data[:, :, :, 32:], tiles_data[1][0])
+
+    channels = container.image_meta.channels_meta.channels
+    for c, channel in enumerate(channels):
+        values = data[c].ravel()
+        visualisation = channel.channel_visualisation
+        assert abs(visualisation.start - np.percentile(values, 1)) <= 1
+        assert abs(visualisation.end - np.percentile(values, 99.9)) <= 1
+        # only the windows change
+        initial = initial_channels[c]
+        assert channel.label == initial.label
+        assert channel.wavelength_id == initial.wavelength_id
+        assert visualisation.model_dump(
+            exclude={"start", "end"}
+        ) == initial.channel_visualisation.model_dump(exclude={"start", "end"})
+
+
+def test_write_tiled_image_float_fallback(tmp_path):
+    rng = np.random.default_rng(0)
+    tiles_data = [rng.random(size=(1, 2, 1, 16, 16)).astype(np.float32)]
+    zarr_url = tmp_path / "test.zarr"
+    write_tiled_image(
+        zarr_url=zarr_url,
+        tiled_image=_tiled_image(tiles_data),
+        stiching_pipe=partial(standard_stitching_pipe, mode="none"),
+        num_levels=1,
+    )
+    container = open_ome_zarr_container(zarr_url)
+    channel = container.image_meta.channels_meta.channels[0]
+    assert channel.channel_visualisation.end <= 1.0
+
+
+def test_project_z():
+    data = np.arange(2 * 3 * 4, dtype=np.uint16).reshape(1, 2, 3, 2, 2)
+    npt.assert_array_equal(project_z(data, "mip"), data[:, :, -1:])
+    npt.assert_array_equal(project_z(data, "mean"), data[:, :, 1:2])
+    projected = project_z(data, "sum")
+    assert projected.dtype == np.uint32
+    npt.assert_array_equal(projected, data.sum(axis=2, keepdims=True))
+
+
+@pytest.mark.parametrize("projection", ["mip", "sum"])
+def test_write_tiled_image_projection(tmp_path, projection):
+    rng = np.random.default_rng(0)
+    tiles_data = [
+        rng.integers(1, 1000, size=(1, 2, 3, 32, 32), dtype=np.uint16),
+        rng.integers(500, 4000, size=(1, 2, 3, 32, 32), dtype=np.uint16),
+    ]
+    zarr_url = tmp_path / "test.zarr"
+    projection_zarr_url = tmp_path / f"test_{projection}.zarr"
+    types = write_tiled_image(
+        zarr_url=zarr_url,
+        tiled_image=_tiled_image(tiles_data),
+        stiching_pipe=partial(standard_stitching_pipe, mode="none"),
+        num_levels=2,
+        projection=projection,
+        projection_zarr_url=projection_zarr_url,
+    )
+    assert types[str(projection_zarr_url)] == {"is_3D": False, "has_time": False}
+
+    container = open_ome_zarr_container(projection_zarr_url)
+    assert container.list_tables() == ["well_ROI_table", "FOV_ROI_table"]
+    data = container.get_image().get_array(mode="numpy")
+    assert data.shape == (2, 1, 32, 64)
+    for i, tile_data in enumerate(tiles_data):
+        expected = project_z(tile_data, projection)[0]
+        npt.assert_array_equal(data[..., i * 32 : (i + 1) * 32], expected)
+
+
+def test_write_tiled_image_projection_2d(tmp_path):
+    tiles_data = [np.ones((1, 2, 1, 16, 16), dtype=np.uint16)]
+    projection_zarr_url = tmp_path / "test_mip.zarr"
+    types = write_tiled_image(
+        zarr_url=tmp_path / "test.zarr",
+        tiled_image=_tiled_image(tiles_data),
+        stiching_pipe=partial(standard_stitching_pipe, mode="none"),
+        num_levels=1,
+        projection="mip",
+        projection_zarr_url=projection_zarr_url,
+    )
+    assert str(projection_zarr_url) not in types
+    assert not projection_zarr_url.exists()
+
+
+def test_chunk_conflict_groups():
+    tiled_image = _tiled_image([np.zeros((1, 1, 1, 32, 32), dtype=np.uint16)] * 3)
+    tiles = standard_stitching_pipe(tiled_image.tiles, mode="none")
+    assert _chunk_conflict_groups(tiles, chunk_yx=(32, 32)) == [0, 1, 2]
+    assert _chunk_conflict_groups(tiles, chunk_yx=(32, 64)) == [0, 0, 1]
+    assert _chunk_conflict_groups(tiles, chunk_yx=(32, 48)) == [0, 0, 0]
+
+
+def test_write_tiled_image_parallel(tmp_path):
+    rng = np.random.default_rng(0)
+    tiles_data = [
+        rng.integers(1, 1000, size=(1, 2, 3, 32, 32), dtype=np.uint16) for _ in range(4)
+    ]
+    tiled_image = _tiled_image(tiles_data)
+    for num_workers in (1, 3):
+        write_tiled_image(
+            zarr_url=tmp_path / f"test_{num_workers}.zarr",
+            tiled_image=tiled_image,
+            stiching_pipe=partial(standard_stitching_pipe, mode="none"),
+            num_levels=2,
+            max_xy_chunk=16,
+            projection="mip",
+            projection_zarr_url=tmp_path / f"test_{num_workers}_mip.zarr",
+            num_workers=num_workers,
+        )
+
+    for suffix in ("", "_mip"):
+        serial = open_ome_zarr_container(tmp_path / f"test_1{suffix}.zarr")
+        parallel = open_ome_zarr_container(tmp_path / f"test_3{suffix}.zarr")
+        npt.assert_array_equal(
+            parallel.get_image().get_array(mode="numpy"),
+            serial.get_image().get_array(mode="numpy"),
+        )
+        assert parallel.image_meta.channels_meta == serial.image_meta.channels_meta
+        serial_rois = serial.get_table("FOV_ROI_table").rois()
+        parallel_rois = parallel.get_table("FOV_ROI_table").rois()
+        assert [roi.name for roi in parallel_rois] == [roi.name for roi in serial_rois]
+
+
+@pytest.mark.parametrize("num_workers", [1, 2])
+def test_write_tiled_image_streaming_pyramid(tmp_path, num_workers):
+    # tiles of 30 pixels, not aligned on the 4 x 4 blocks of the last level
+    rng = np.random.default_rng(0)
+    tiles_data = [
+        rng.integers(1, 1000, size=(1, 2, 3, 32, 30), dtype=np.uint16) for _ in range(4)
+    ]
+    tiled_image = _tiled_image(tiles_data)
+    for streaming_pyramid in (False, True):
+        write_tiled_image(
+            zarr_url=tmp_path / f"test_{streaming_pyramid}.zarr",
+            tiled_image=tiled_image,
+            stiching_pipe=partial(standard_stitching_pipe, mode="none"),
+            num_levels=3,
+            max_xy_chunk=16,
+            projection="mip",
+            projection_zarr_url=tmp_path / f"test_{streaming_pyramid}_mip.zarr",
+            num_workers=num_workers,
+            streaming_pyramid=streaming_pyramid,
+        )
+
+    for suffix in ("", "_mip"):
+        consolidated = open_ome_zarr_container(tmp_path / f"test_False{suffix}.zarr")
+        streamed = open_ome_zarr_container(tmp_path / f"test_True{suffix}.zarr")
+        for path in consolidated.levels_paths:
+            npt.assert_array_equal(
+                streamed.get_image(path=path).get_array(mode="numpy"),
+                consolidated.get_image(path=path).get_array(mode="numpy"),
+            )
+        assert (
+            streamed.image_meta.channels_meta == consolidated.image_meta.channels_meta
+        )
+
+
+@pytest.mark.parametrize("access_profile", ["per-plane", "per-timepoint", "volumetric"])
+def test_write_tiled_image_auto_chunking(tmp_path, access_profile):
+    rng = np.random.default_rng(0)
+    tiles_data = [
+        rng.integers(1, 1000, size=(1, 2, 4, 64, 64), dtype=np.uint16) for _ in range(3)
+    ]
+    tiled_image = _tiled_image(tiles_data)
+    for chunking in ("static", "auto"):
+        write_tiled_image(
+            zarr_url=tmp_path / f"{chunking}.zarr",
+            tiled_image=tiled_image,
+            stiching_pipe=partial(standard_stitching_pipe, mode="none"),
+            num_levels=2,
+            chunking=chunking,
+            access_profile=access_profile,
+            target_chunk_mb=0.01,
+        )
+
+    static = open_ome_zarr_container(tmp_path / "static.zarr")
+    auto = open_ome_zarr_container(tmp_path / "auto.zarr")
+    expected_chunks = {
+        "per-plane": (1, 1, 64, 64),
+        "per-timepoint": (1, 4, 32, 32),
+        "volumetric": (1, 4, 32, 32),
+    }
+    assert auto.get_image().chunks == expected_chunks[access_profile]
+    assert auto.get_image().chunks != static.get_image().chunks
+    # same pixels, pyramid and metadata whatever the chunk shape
+    for path in static.levels_paths:
+        npt.assert_array_equal(
+            auto.get_image(path=path).get_array(mode="numpy"),
+            static.get_image(path=path).get_array(mode="numpy"),
+        )
+    assert auto.image_meta.channels_meta == static.image_meta.channels_meta
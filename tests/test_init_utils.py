@@ -0,0 +1,196 @@
+import json
+
+import numpy as np
+import pytest
+from fractal_converters_tools import (
+    PlatePathBuilder,
+    SimplePathBuilder,
+    Tile,
+    TiledImage,
+    initiate_ome_zarr_plates,
+)
+
+from nd2_omezarr_converter import convert_nd2_init_task as convert_nd2_init_task_module
+from nd2_omezarr_converter import init_utils
+from nd2_omezarr_converter.compute_utils import compute_batched_tiled_images
+from nd2_omezarr_converter.convert_nd2_init_task import (
+    Nd2InputModel,
+    convert_nd2_init_task,
+)
+from nd2_omezarr_converter.init_utils import (
+    batch_tiled_images,
+    build_parallelization_list,
+    order_tiled_images,
+    projected_path_builder,
+    projected_tiled_images,
+    tiled_image_nbytes,
+    tiled_image_source,
+)
+from nd2_omezarr_converter.task_models import AdvancedOptions, ConvertNd2InitArgs
+
+from .test_image_writers import _tiled_image
+
+
+def test_projected_path_builder():
+    builder = PlatePathBuilder(plate_name="plate", row="B", column=3, acquisition_id=1)
+    projected = projected_path_builder(builder, suffix="_mip")
+    assert projected.path == "plate_mip.zarr/B/3/1"
+    assert projected.plate_path == "plate_mip.zarr"
+
+    projected = projected_path_builder(SimplePathBuilder("dir/image"), "_sum")
+    assert projected.path == "dir/image_sum.zarr"
+
+
+def _plate_tiled_image(column, num_z):
+    tiled_image = TiledImage(
+        name=f"image_{column}",
+        path_builder=PlatePathBuilder(plate_name="plate", row="A", column=column),
+        channel_names=["DAPI", "GFP"],
+        wavelength_ids=["450", "510"],
+    )
+    data = np.ones((1, 2, num_z, 16, 16), dtype=np.uint16)
+    for tile in _tiled_image([data]).tiles:
+        tiled_image.add_tile(tile)
+    return tiled_image
+
+
+def test_projected_tiled_images():
+    tiled_images = [_plate_tiled_image(1, num_z=3), _plate_tiled_image(2, num_z=1)]
+    projected = projected_tiled_images(tiled_images, suffix="_mean")
+    # 2D images are not projected
+    assert [tiled_image.path for tiled_image in projected] == ["plate_mean.zarr/A/1/0"]
+
+
+@pytest.mark.parametrize("num_z", [1, 3])
+def test_init_task_projected_plate(tmp_path, monkeypatch, num_z):
+    monkeypatch.setattr(
+        convert_nd2_init_task_module,
+        "parse_nd2_acquisition",
+        lambda **kwargs: [_plate_tiled_image(1, num_z=num_z)],
+    )
+    convert_nd2_init_task(
+        zarr_dir=str(tmp_path),
+        acquisitions=[Nd2InputModel(path=str(tmp_path))],
+        advanced_options=AdvancedOptions(projection="mip"),
+    )
+    assert (tmp_path / "plate.zarr").exists()
+    assert (tmp_path / "plate_mip.zarr").exists() == (num_z > 1)
+
+
+def _small_tiled_images(num_images, shape=(1, 2, 1, 16, 16)):
+    return [
+        _tiled_image([np.zeros(shape, dtype=np.uint16)], path=f"image_{i}")
+        for i in range(num_images)
+    ]
+
+
+def test_tiled_image_nbytes():
+    (tiled_image,) = _small_tiled_images(1)
+    assert tiled_image_nbytes(tiled_image) == 2 * 16 * 16 * 2
+
+
+def test_tiled_image_nbytes_single_dtype_lookup(monkeypatch):
+    data = [np.zeros((1, 2, 3, 16, 16), dtype=np.uint16)] * 4
+    tiled_image = _tiled_image(data)
+    # getting the dtype of an nd2 tile opens its file
+    dtype = Tile.dtype
+    calls = []
+
+    def counting_dtype(tile):
+        calls.append(tile)
+        return dtype(tile)
+
+    monkeypatch.setattr(Tile, "dtype", counting_dtype)
+    assert tiled_image_nbytes(tiled_image) == 4 * 2 * 3 * 16 * 16 * 2
+    assert len(calls) == 1
+
+
+def test_batch_tiled_images():
+    tiled_images = _small_tiled_images(5)
+    assert [len(b) for b in batch_tiled_images(tiled_images)] == [1] * 5
+    batches = batch_tiled_images(tiled_images, max_images=2)
+    assert [len(b) for b in batches] == [2, 2, 1]
+    batches = batch_tiled_images(tiled_images, max_images=10, max_bytes=3000)
+    assert [len(b) for b in batches] == [2, 2, 1]
+    batches = batch_tiled_images(tiled_images, max_images=10, max_bytes=100)
+    assert [len(b) for b in batches] == [1] * 5
+
+
+def test_order_tiled_images(tmp_path):
+    class _FileLoader:
+        def __init__(self, path):
+            self.path = path
+
+    # image name: (source file, size)
+    layout = {
+        "small_a0": ("a.nd2", 16),
+        "large_b": ("b.nd2", 64),
+        "small_a1": ("a.nd2", 32),
+        "unknown": (None, 48),
+        "small_c": ("c.nd2", 16),
+    }
+    tiled_images = []
+    for name, (source, size) in layout.items():
+        tiled_image = _tiled_image([np.zeros((1, 1, 1, size, size))], path=name)
+        if source is not None:
+            for tile in tiled_image.tiles:
+                tile._data_loader = _FileLoader(str(tmp_path / source))
+        tiled_images.append(tiled_image)
+
+    assert tiled_image_source(tiled_images[0]) == str(tmp_path / "a.nd2")
+    assert tiled_image_source(tiled_images[3]) is None
+    ordered = order_tiled_images(tiled_images)
+    # largest sources first, images of the same source together and largest first
+    assert [tiled_image.path for tiled_image in ordered] == [
+        "large_b.zarr",
+        "unknown.zarr",
+        "small_a1.zarr",
+        "small_a0.zarr",
+        "small_c.zarr",
+    ]
+
+
+def test_batched_compute(tmp_path):
+    tiled_images = _small_tiled_images(3)
+    parallelization_list = build_parallelization_list(
+        zarr_dir=tmp_path,
+        tiled_images=tiled_images,
+        overwrite=False,
+        advanced_compute_options=AdvancedOptions(tiling_mode="none", num_levels=1),
+        max_images_per_job=2,
+    )
+    assert len(parallelization_list) == 2
+
+    zarr_urls = []
+    for task_args in parallelization_list:
+        init_args = ConvertNd2InitArgs(**task_args["init_args"])
+        updates = compute_batched_tiled_images(
+            zarr_url=task_args["zarr_url"], init_args=init_args
+        )
+        zarr_urls.extend(u["zarr_url"] for u in updates["image_list_updates"])
+    assert zarr_urls == [str(tmp_path / f"image_{i}.zarr") for i in range(3)]
+    assert not (tmp_path / "_tmp_converter_dir").exists()
+
+
+def test_initiate_ome_zarr_plates(tmp_path):
+    tiled_images = [
+        TiledImage(
+            name="image",
+            path_builder=PlatePathBuilder(
+                plate_name=plate, row=row, column=column, acquisition_id=acquisition
+            ),
+        )
+        for plate in ("plate", "other")
+        for acquisition in (0, 2)
+        for row in "BC"
+        for column in (3, 11)
+    ]
+    init_utils.initiate_ome_zarr_plates(tmp_path / "nd2", tiled_images, max_workers=3)
+    initiate_ome_zarr_plates(tmp_path / "reference", tiled_images)
+
+    # same metadata as the fractal-converters-tools plates
+    reference_files = sorted((tmp_path / "reference").rglob(".z*"))
+    assert len(reference_files) == 24
+    for reference_file in reference_files:
+        path = tmp_path / "nd2" / reference_file.relative_to(tmp_path / "reference")
+        assert json.loads(path.read_text()) == json.loads(reference_file.read_text())
@@ -1,15 +1,31 @@
+import threading
+import time
+from types import SimpleNamespace
+
 import nd2
 import numpy as np
 import numpy.testing as npt
 import pytest
 
 from nd2_omezarr_converter.nd2_utils import (
+    Nd2HandlePool,
+    available_cpus,
+    bin_xy,
     build_tiled_image,
     build_tiles,
+    compute_rescale_limits,
+    discover_nd2_acquisitions,
+    frame_time_step,
     nd2TileLoader,
     parse_input_path,
     parse_nd2_acquisition,
     parse_well_info,
+    position_z_origins,
+    rescale_lut,
+    resolve_channel_selection,
+    resolve_slice_selection,
+    scan_nd2_directories,
+    set_decode_threads,
 )
 
 
@@ -51,6 +67,238 @@ def test_nd2TileLoader(temp_dir):
     assert data.shape == (4, 2, 1, 512, 1024)
 
 
+def _nd2_reference(path, p, t=None, c=None, z=None):
+    """Read a position with the nd2 library, as a (t, c, z, y, x) array."""
+    with nd2.ND2File(path) as nd2_file:
+        axes = list(nd2_file.sizes)
+        data = nd2_file.asarray().reshape(tuple(nd2_file.sizes.values()))
+    for axis in "PTCZ":
+        if axis not in axes:
+            data = data[np.newaxis]
+            axes.insert(0, axis)
+    data = np.moveaxis(data, [axes.index(axis) for axis in "PTCZYX"], range(6))[p]
+    for axis, indices in enumerate((t, c, z)):
+        if indices is not None:
+            data = np.take(data, list(indices), axis=axis)
+    return data
+
+
+def test_nd2TileLoader_selection(temp_dir):
+    path = temp_dir / "ND_Acquisitions_nd2" / "05_2c_3z.nd2"
+    tile_loader = nd2TileLoader(
+        path=str(path), p=0, channels=[1], z_indices=range(1, 3)
+    )
+    data = tile_loader.load()
+    assert data.shape == (1, 1, 2, 512, 1024)
+    npt.assert_array_equal(data, _nd2_reference(path, p=0, c=[1], z=range(1, 3)))
+
+    path = temp_dir / "ND_Acquisitions_nd2" / "13_4t_XY2_2c_0z.nd2"
+    tile_loader = nd2TileLoader(
+        path=str(path), p=1, channels=[1, 0], t_indices=range(0, 4, 2)
+    )
+    data = tile_loader.load()
+    assert data.shape == (2, 2, 1, 512, 1024)
+    npt.assert_array_equal(data, _nd2_reference(path, p=1, t=range(0, 4, 2), c=[1, 0]))
+
+
+def test_nd2TileLoader_binning(temp_dir):
+    path = temp_dir / "ND_Acquisitions_nd2" / "05_2c_3z.nd2"
+    full_data = nd2TileLoader(path=str(path), p=0).load()
+    tile_loader = nd2TileLoader(
+        path=str(path), p=0, z_indices=range(0, 3, 2), xy_binning=4
+    )
+    assert tile_loader.dtype == "uint16"
+    data = tile_loader.load()
+    assert data.shape == (1, 2, 2, 128, 256)
+    npt.assert_array_equal(data, bin_xy(full_data[:, :, ::2], 4, "mean"))
+
+    tile_loader = nd2TileLoader(
+        path=str(path), p=0, xy_binning=2, binning_reducer="sum"
+    )
+    assert tile_loader.dtype == "uint32"
+    assert tile_loader.load().shape == (1, 2, 3, 256, 512)
+
+
+def test_nd2TileLoader_rescale(temp_dir):
+    path = temp_dir / "ND_Acquisitions_nd2" / "05_2c_3z.nd2"
+    full_data = nd2TileLoader(path=str(path), p=0).load()
+    limits = compute_rescale_limits([path], channels=[1], num_frames=3)
+    assert limits == [(full_data[:, 1].min(), full_data[:, 1].max())]
+
+    tile_loader = nd2TileLoader(
+        path=str(path), p=0, channels=[1], output_dtype="uint8", rescale_limits=limits
+    )
+    assert tile_loader.dtype == "uint8"
+    data = tile_loader.load()
+    assert data.shape == (1, 1, 3, 512, 1024)
+    assert data.min() == 0
+    assert data.max() == 255
+
+
+def test_nd2_handle_pool(tmp_path, monkeypatch):
+    opened = []
+
+    class FakeND2File:
+        def __init__(self, path):
+            self.closed = False
+            opened.append(self)
+
+        def close(self):
+            self.closed = True
+
+    monkeypatch.setattr(nd2, "ND2File", FakeND2File)
+    paths = [tmp_path / f"{i}.nd2" for i in range(3)]
+    for path in paths:
+        path.touch()
+
+    pool = Nd2HandlePool(max_open=2)
+    with pool.open(paths[0]) as first:
+        pass
+    with pool.open(paths[0]) as handle:
+        assert handle is first
+    with pool.open(paths[1]), pool.open(paths[2]):
+        # the least recently used file was closed
+        assert len(pool) == 2
+        assert first.closed
+        # files being read are not closed
+        with pool.open(paths[0]) as handle:
+            assert handle is not first
+            assert len(pool) == 3
+    pool.close()
+    assert len(pool) == 0
+    assert all(handle.closed for handle in opened)
+
+
+def test_nd2TileLoader_compressed(monkeypatch):
+    data = np.arange(2 * 3 * 4 * 2 * 8 * 8, dtype=np.uint16).reshape(2, 3, 4, 2, 8, 8)
+    threads = set()
+
+    class FakeND2File:
+        dtype = np.dtype(np.uint16)
+        is_rgb = False
+        attributes = SimpleNamespace(compressionType="lossless")
+
+        def __init__(self, path):
+            self.sizes = {"T": 2, "P": 3, "Z": 4, "C": 2, "Y": 8, "X": 8}
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def read_frame(self, index):
+            threads.add(threading.get_ident())
+            time.sleep(0.01)
+            return data.reshape(-1, 2, 8, 8)[index]
+
+    monkeypatch.setattr(nd2, "ND2File", FakeND2File)
+    tile_loader = nd2TileLoader(path="fake.nd2", p=1, channels=[1], xy_binning=2)
+    expected = bin_xy(data[:, 1, :, [1]].transpose(1, 0, 2, 3, 4), 2, "mean")
+    try:
+        set_decode_threads(1)
+        npt.assert_array_equal(tile_loader.load(), expected)
+        assert len(threads) == 1
+
+        set_decode_threads(4)
+        npt.assert_array_equal(tile_loader.load(), expected)
+        assert len(threads) > 1
+    finally:
+        set_decode_threads(None)
+
+
+def test_available_cpus(monkeypatch):
+    monkeypatch.delenv("SLURM_CPUS_PER_TASK", raising=False)
+    cpus = available_cpus()
+    assert cpus >= 1
+    monkeypatch.setenv("SLURM_CPUS_PER_TASK", "1")
+    assert available_cpus() == 1
+
+
+def test_rescale_lut():
+    lut = rescale_lut(100, 200, np.uint16, np.uint8)
+    assert lut.shape == (65536,)
+    assert lut.dtype == np.uint8
+    npt.assert_array_equal(lut[[0, 100, 180, 200, 65535]], [0, 0, 204, 255, 255])
+    lut = rescale_lut(0, 4095, np.uint16, np.uint16)
+    assert lut[4095] == 65535
+    with pytest.raises(ValueError):
+        rescale_lut(0, 1, np.float32, np.uint8)
+
+
+def test_bin_xy():
+    data = np.arange(2 * 5 * 4, dtype=np.uint16).reshape(2, 5, 4)
+    npt.assert_array_equal(
+        bin_xy(data, 2, "max"), data[:, :4].reshape(2, 2, 2, 2, 2).max(axis=(2, 4))
+    )
+    binned = bin_xy(data, 2, "sum")
+    assert binned.dtype == np.uint32
+    assert binned.shape == (2, 2, 2)
+    assert binned[0, 0, 0] == 0 + 1 + 4 + 5
+    binned = bin_xy(data, 2, "mean")
+    assert binned.dtype == np.uint16
+    assert binned[0, 0, 0] == 3  # 2.5 rounded
+    npt.assert_allclose(bin_xy(data.astype(np.float32), 2, "mean")[0, 0, 0], 2.5)
+    assert bin_xy(data, 1, "mean") is data
+    with pytest.raises(ValueError):
+        bin_xy(data, 8, "mean")
+
+
+def test_resolve_selection():
+    channel_names = ["DAPI", "GFP", "RFP"]
+    assert resolve_channel_selection(channel_names, None) is None
+    assert resolve_channel_selection(channel_names, ["RFP", 0]) == [2, 0]
+    with pytest.raises(ValueError):
+        resolve_channel_selection(channel_names, ["Cy5"])
+    with pytest.raises(ValueError):
+        resolve_channel_selection(channel_names, [3])
+    with pytest.raises(ValueError):
+        resolve_channel_selection(channel_names, ["GFP", 1])
+
+    assert resolve_slice_selection(10, None, "T") is None
+    assert resolve_slice_selection(10, slice(2, 5), "T") == range(2, 5)
+    assert resolve_slice_selection(10, slice(8, 20), "T") == range(8, 10)
+    with pytest.raises(ValueError):
+        resolve_slice_selection(3, slice(5, None), "Z")
+
+
+def _events(num_t, num_p, num_z):
+    t, p, z = np.meshgrid(
+        np.arange(num_t), np.arange(num_p), np.arange(num_z), indexing="ij"
+    )
+    t, p, z = t.ravel(), p.ravel(), z.ravel()
+    return {
+        "Index": np.arange(len(t), dtype=float),
+        "T Index": t.astype(float),
+        "P Index": p.astype(float),
+        "Z Index": z.astype(float),
+        "Time [s]": t * 30.0 + np.arange(len(t)) * 0.1,
+        "Z-Series": z * 2.0 - 3.0,
+    }
+
+
+def test_frame_time_step():
+    events = _events(num_t=4, num_p=2, num_z=3)
+    assert frame_time_step(events, range(4)) == pytest.approx(30.6)
+    assert frame_time_step(events, range(0, 4, 2)) == pytest.approx(61.2)
+    assert frame_time_step(events, [1]) is None
+    assert frame_time_step({}, range(4)) is None
+
+
+def test_position_z_origins():
+    events = _events(num_t=2, num_p=2, num_z=4)
+    origins = position_z_origins(events, [0, 1], t_index=0, z_indices=range(4))
+    assert origins == {0: -3.0, 1: -3.0}
+    origins = position_z_origins(events, [1], t_index=0, z_indices=[2, 3])
+    assert origins == {1: 1.0}
+
+    # absolute stage z recorded for every frame
+    events["Z Coord [\u00b5m]"] = 100 + events["P Index"] * 10 + events["Z Index"]
+    origins = position_z_origins(events, [0, 1], t_index=1, z_indices=[1, 2])
+    assert origins == {0: 101.0, 1: 111.0}
+    assert position_z_origins({}, [0], t_index=0, z_indices=[0]) == {}
+
+
 def test_build_tiles(temp_dir):
     path = (
         temp_dir
@@ -67,6 +315,14 @@ def test_build_tiles(temp_dir):
         npt.assert_allclose(tile.top_l.z, 0)
         npt.assert_allclose(tile.top_l.c, 0)
         npt.assert_allclose(tile.top_l.t, 0)
+        # single timepoint, no time step
+        assert tile.pixel_size.t == 1
+        assert np.isfinite(tile.origin.z_micrometer_original)
+
+        tiles = list(build_tiles(nd2file, xy_binning=2))
+        assert len(tiles) == 6
+        npt.assert_allclose(tiles[0].pixel_size.x, 2 * nd2file.voxel_size().x)
+        npt.assert_allclose(tiles[0].diag.x, tile.diag.x, rtol=1e-3)
 
 
 def test_parse_well_info():
@@ -103,6 +359,19 @@ def test_build_tiled_image(temp_dir):
     assert tiled_image.channel_names == ["SD DAPI- EM", "SD GFP - EM"]
     assert tiled_image.wavelength_ids == ["438.0", "511.0"]
 
+    tiled_image = build_tiled_image(
+        nd2_path=str(path),
+        zarr_name="test_zarr",
+        acquisition_id=1,
+        plate=True,
+        channels=["SD GFP - EM"],
+        positions=[0, 5],
+    )
+    assert len(tiled_image.tiles) == 2
+    assert tiled_image.channel_names == ["SD GFP - EM"]
+    assert tiled_image.wavelength_ids == ["511.0"]
+    assert tiled_image.tiles[0].shape[1] == 1
+
 
 def test_parse_input_path(temp_dir):
     path = (
@@ -133,6 +402,69 @@ def test_parse_input_path(temp_dir):
         nd2_list, mode = parse_input_path(path)
 
 
+def _touch(*paths):
+    for path in paths:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+
+
+def test_discover_nd2_acquisitions(tmp_path):
+    root = tmp_path / "export"
+    _touch(
+        root / "20250101_120000_001" / "WellA01_Seq0000.nd2",
+        root / "20250101_120000_001" / "WellA02_Seq0001.nd2",
+        root / "20250102_120000_002" / "WellA01_Seq0000.nd2",
+        root / "20250102_120000_002" / "notes.txt",
+        root / ".hidden" / "WellA01_Seq0000.nd2",
+        root / "out.zarr" / "WellA01_Seq0000.nd2",
+    )
+    directories = scan_nd2_directories(root)
+    assert list(directories) == [
+        root / "20250101_120000_001",
+        root / "20250102_120000_002",
+    ]
+    assert directories[root / "20250102_120000_002"] == [
+        root / "20250102_120000_002" / "WellA01_Seq0000.nd2"
+    ]
+
+    acquisitions = discover_nd2_acquisitions(root, acquisition_id=1)
+    assert [(a.mode, a.plate_name, a.acquisition_id) for a in acquisitions] == [
+        ("plate", "export", 1),
+        ("plate", "export", 2),
+    ]
+
+    # a folder of non-plate files next to the plate
+    _touch(root / "other" / "sample 1.nd2")
+    acquisitions = discover_nd2_acquisitions(root, plate_name="exp")
+    assert [(a.mode, a.plate_name, a.acquisition_id) for a in acquisitions] == [
+        ("plate", "exp", 0),
+        ("plate", "exp", 1),
+        ("folder", "exp_other", None),
+    ]
+
+    (tmp_path / "empty").mkdir()
+    with pytest.raises(ValueError):
+        discover_nd2_acquisitions(tmp_path / "empty")
+
+
+def test_discover_nd2_acquisitions_separate_plates(tmp_path):
+    root = tmp_path / "export"
+    _touch(
+        root / "PlateA" / "WellA01_Seq0000.nd2",
+        root / "PlateB" / "WellA01_Seq0000.nd2",
+        root / "PlateC" / "20250101_120000_001" / "WellA01_Seq0000.nd2",
+        root / "PlateC" / "20250102_120000_002" / "WellA01_Seq0000.nd2",
+    )
+    # only the runs of a JOBS export are acquisitions of the same plate
+    acquisitions = discover_nd2_acquisitions(root)
+    assert [(a.mode, a.plate_name, a.acquisition_id) for a in acquisitions] == [
+        ("plate", "export_PlateA", 0),
+        ("plate", "export_PlateB", 0),
+        ("plate", "export_PlateC", 0),
+        ("plate", "export_PlateC", 1),
+    ]
+
+
 def test_parse_nd2_acquisition(temp_dir):
     # Test with a single ND2 file
     path = temp_dir / "ND_Acquisitions_nd2" / "01_0c_0z.nd2"
@@ -189,6 +521,13 @@ def test_parse_nd2_acquisition(temp_dir):
     assert tiled_images[1].path == "20250506_124144_018.zarr/B/3/0"
     assert tiled_images[2].path == "20250506_124144_018.zarr/C/2/0"
 
+    # Test with the recursive discovery of a JOBS export
+    path = temp_dir / "WellPlate_Jobs_3w6p2c0z0t_overlap"
+
+    tiled_images = parse_nd2_acquisition(acq_path=path, recursive=True)
+    assert len(tiled_images) == 3
+    assert tiled_images[0].path == "WellPlate_Jobs_3w6p2c0z0t_overlap.zarr/B/2/0"
+
     # Test with a non-existent file
     path = temp_dir / "non_existent.nd2"
     with pytest.raises(FileNotFoundError):
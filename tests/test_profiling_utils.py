@@ -0,0 +1,71 @@
+import pstats
+
+import pytest
+
+from nd2_omezarr_converter.profiling_utils import (
+    PROFILE_DIR_ENV,
+    PROFILE_MODES_ENV,
+    profile_name,
+    profile_run,
+    profile_settings_from_env,
+)
+
+
+def test_profile_name():
+    assert profile_name("/data/plate.zarr/B/03/0") == "plate_B_03_0"
+    assert profile_name("/data/image 1.zarr") == "image_1"
+    assert profile_name("/data/output") == "output"
+
+
+def test_profile_run_disabled(tmp_path, monkeypatch):
+    monkeypatch.delenv(PROFILE_DIR_ENV, raising=False)
+    with profile_run("image"):
+        sum(range(1000))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_profile_run(tmp_path, monkeypatch):
+    monkeypatch.setenv(PROFILE_DIR_ENV, str(tmp_path / "profiles"))
+    monkeypatch.delenv(PROFILE_MODES_ENV, raising=False)
+    with pytest.raises(RuntimeError):
+        with profile_run("image"):
+            data = [bytearray(1000) for _ in range(100)]
+            raise RuntimeError(len(data))
+
+    # reports are written even if the run fails
+    memory_report = (tmp_path / "profiles" / "image.memory.txt").read_text()
+    assert memory_report.startswith("Peak traced memory")
+    prof_path = tmp_path / "profiles" / "image.prof"
+    if prof_path.exists():
+        # cpu profiling is skipped if another profiler is active
+        assert pstats.Stats(str(prof_path)).total_calls > 0
+
+    monkeypatch.setenv(PROFILE_MODES_ENV, "memory")
+    with profile_run("memory_only"):
+        pass
+    assert (tmp_path / "profiles" / "memory_only.memory.txt").exists()
+    assert not (tmp_path / "profiles" / "memory_only.prof").exists()
+
+    monkeypatch.setenv(PROFILE_MODES_ENV, "cpu,gpu")
+    with pytest.raises(ValueError, match="gpu"):
+        with profile_run("image"):
+            pass
+
+
+def test_profile_run_settings(tmp_path, monkeypatch):
+    monkeypatch.setenv(PROFILE_DIR_ENV, str(tmp_path / "env"))
+    monkeypatch.setenv(PROFILE_MODES_ENV, "memory")
+    settings = profile_settings_from_env()
+    assert settings == {
+        PROFILE_DIR_ENV: str(tmp_path / "env"),
+        PROFILE_MODES_ENV: "memory",
+    }
+
+    # explicit settings replace the environment
+    settings[PROFILE_DIR_ENV] = str(tmp_path / "job")
+    with profile_run("image", settings):
+        pass
+    assert (tmp_path / "job" / "image.memory.txt").exists()
+    with profile_run("image", {}):
+        pass
+    assert not (tmp_path / "env").exists()
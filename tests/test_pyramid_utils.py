@@ -0,0 +1,83 @@
+import numpy as np
+import numpy.testing as npt
+import pytest
+import zarr
+from ngio.common._zoom import fast_zoom
+
+from nd2_omezarr_converter.pyramid_utils import (
+    StreamingPyramid,
+    downsample_yx,
+    rects_overlap,
+    z_order,
+)
+
+
+@pytest.mark.parametrize("order", [0, 1])
+def test_downsample_yx_matches_zoom(order):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 2**16, size=(2, 3, 16, 24), dtype=np.uint16)
+    expected = fast_zoom(data, (1, 1, 0.5, 0.5), order=order)
+    npt.assert_array_equal(downsample_yx(data, order=order), expected)
+
+
+def test_downsample_yx_odd():
+    data = np.array([[1, 3, 5], [3, 5, 7]], dtype=np.uint8)
+    npt.assert_array_equal(downsample_yx(data), [[3, 6]])
+    npt.assert_array_equal(downsample_yx(data, order=0), [[5, 7]])
+    data = np.array([[1.0, 2.0], [3.0, 5.0]], dtype=np.float32)
+    npt.assert_array_equal(downsample_yx(data), [[2.75]])
+
+
+def test_z_order():
+    rects = np.array([(y, x, 10, 10) for y in (0, 10, 20, 30) for x in (0, 10)])
+    order = z_order(rects)
+    assert rects[order][:4, :2].tolist() == [[0, 0], [0, 10], [10, 0], [10, 10]]
+
+
+def test_rects_overlap():
+    rects = np.array([(0, 0, 10, 10), (0, 10, 10, 10), (10, 0, 10, 20)])
+    assert not rects_overlap(rects, batch_size=2)
+    assert rects_overlap(np.concatenate([rects, [(5, 15, 10, 10)]]), batch_size=2)
+
+
+def _levels(shape, chunks, num_levels):
+    arrays = []
+    for _ in range(num_levels):
+        arrays.append(zarr.zeros(shape, chunks=chunks, dtype=np.uint16))
+        shape = (*shape[:-2], (shape[-2] + 1) // 2, (shape[-1] + 1) // 2)
+    return arrays
+
+
+@pytest.mark.parametrize("max_bytes", [2**30, 2000])
+def test_streaming_pyramid(max_bytes):
+    # tiles of 30 x 36 pixels, not aligned on the 8 x 8 blocks of the last
+    # level, with a missing tile
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 2**16, size=(2, 96, 120), dtype=np.uint16)
+    image[:, 30:60, 36:72] = 0
+    level0, *levels = _levels(image.shape, (1, 16, 16), num_levels=4)
+    pyramid = StreamingPyramid(level0, levels, max_bytes=max_bytes)
+    rects = [
+        (y, x, 30, 36)
+        for y in range(0, 96, 30)
+        for x in range(0, 120, 36)
+        if (y, x) != (30, 36)
+    ]
+    for i in z_order(np.array(rects)):
+        y, x, h, w = rects[i]
+        tile = image[:, y : y + h, x : x + w]
+        level0[:, y : y + h, x : x + w] = tile
+        pyramid.add_tile(tile, y, x)
+    pyramid.finalize()
+
+    expected = image
+    for level in levels:
+        expected = fast_zoom(expected, (1, 0.5, 0.5), order=1)
+        npt.assert_array_equal(level[...], expected)
+
+
+def test_streaming_pyramid_tile_shape():
+    level0, *levels = _levels((2, 32, 32), (1, 16, 16), num_levels=2)
+    pyramid = StreamingPyramid(level0, levels)
+    with pytest.raises(ValueError, match="does not span"):
+        pyramid.add_tile(np.zeros((1, 16, 16), dtype=np.uint16), 0, 0)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+from fractal_converters_tools import Point, Tile, Vector
+from fractal_converters_tools._stitching import standard_stitching_pipe
+from ngio import PixelSize
+
+from nd2_omezarr_converter.stitching_utils import find_grid_indices, nd2_stitching_pipe
+
+
+def _grid_tiles(num_x, num_y, jitter=0.0, missing=(), spacing=180.0, seed=0):
+    rng = np.random.default_rng(seed)
+    tiles = []
+    for i in range(num_x):
+        for j in range(num_y):
+            if (i, j) in missing:
+                continue
+            x = 1000 + i * spacing + rng.normal() * jitter
+            y = -500 + j * spacing + rng.normal() * jitter
+            tiles.append(
+                Tile(
+                    top_l=Point(x, y, z=0, c=0, t=0),
+                    diag=Vector(204.8, 204.8, z=1, c=1, t=1),
+                    pixel_size=PixelSize(x=0.1, y=0.1, z=1),
+                )
+            )
+    order = rng.permutation(len(tiles))
+    return [tiles[k] for k in order]
+
+
+def _positions(tiles):
+    return [
+        (
+            tile.top_l.x,
+            tile.top_l.y,
+            tile.origin.x_micrometer_original,
+            tile.origin.y_micrometer_original,
+        )
+        for tile in tiles
+    ]
+
+
+@pytest.mark.parametrize(
+    "flips",
+    [{}, {"invert_y": True}, {"swap_xy": True, "invert_x": True}],
+)
+def test_nd2_stitching_pipe_grid(flips):
+    # same placement as the generic grid mode, including missing tiles
+    tiles = _grid_tiles(6, 4, missing={(2, 3), (5, 0)})
+    expected = standard_stitching_pipe(tiles, mode="grid", **flips)
+    assert _positions(nd2_stitching_pipe(tiles, mode="grid", **flips)) == _positions(
+        expected
+    )
+
+
+def test_nd2_stitching_pipe_jitter():
+    # stage jitter is snapped to the grid, the generic mode falls back to "free"
+    tiles = _grid_tiles(5, 3, jitter=0.5)
+    indices = find_grid_indices(tiles)
+    assert indices.max(axis=0).tolist() == [4, 2]
+    stitched = nd2_stitching_pipe(tiles, mode="auto")
+    assert sorted((tile.top_l.x, tile.top_l.y) for tile in stitched) == [
+        (i * 2048, j * 2048) for i in range(5) for j in range(3)
+    ]
+
+
+def test_nd2_stitching_pipe_fallback():
+    tiles = _grid_tiles(3, 3)
+    # tiles on the same grid cell
+    assert find_grid_indices([*tiles, tiles[0]]) is None
+    # tiles off the grid
+    tiles[4] = tiles[4].move_by(Vector(60, 0, z=0, c=0, t=0))
+    assert find_grid_indices(tiles) is None
+    # tiles with gaps between them
+    assert find_grid_indices(_grid_tiles(3, 3, spacing=250)) is None
+    expected = standard_stitching_pipe(tiles, mode="auto")
+    assert _positions(nd2_stitching_pipe(tiles, mode="auto")) == _positions(expected)
+    with pytest.raises(ValueError, match="regular grid"):
+        nd2_stitching_pipe(tiles, mode="grid")
@@ -0,0 +1,104 @@
+import numpy as np
+import numpy.testing as npt
+from fractal_converters_tools import (
+    OriginDict,
+    PlatePathBuilder,
+    Point,
+    Tile,
+    TiledImage,
+    Vector,
+)
+from ngio import PixelSize
+
+from nd2_omezarr_converter.nd2_utils import nd2TileLoader, parse_nd2_acquisition
+from nd2_omezarr_converter.tile_descriptors import (
+    DESCRIPTOR_SUFFIX,
+    Nd2TiledImageDescriptor,
+    load_saved_tiled_image,
+    save_tiled_image,
+)
+
+from .test_image_writers import _tiled_image
+
+
+def _nd2_tiled_image(num_tiles, **loader_kwargs):
+    tiled_image = TiledImage(
+        name="scan",
+        path_builder=PlatePathBuilder(
+            plate_name="plate", row="B", column=3, acquisition_id=1
+        ),
+        channel_names=["DAPI", "GFP"],
+        wavelength_ids=["450", "510"],
+        attributes={"cell_line": "HeLa"},
+    )
+    for p in range(num_tiles):
+        tiled_image.add_tile(
+            Tile(
+                top_l=Point(x=p * 90.5, y=-p * 10.25, z=0.0, c=0, t=0),
+                diag=Vector(x=100.0, y=50.0, z=6.0, c=2, t=3),
+                pixel_size=PixelSize(x=0.5, y=0.5, z=2.0, t=61.5),
+                origin=OriginDict(p * 90.5, -p * 10.25, 12.5 + p),
+                data_loader=nd2TileLoader(path="scan.nd2", p=p, **loader_kwargs),
+            )
+        )
+    return tiled_image
+
+
+def test_descriptor_round_trip(tmp_path):
+    tiled_image = _nd2_tiled_image(
+        num_tiles=5,
+        channels=[1, 0],
+        t_indices=[0, 2, 4],
+        z_indices=range(1, 12, 2),
+        xy_binning=2,
+        output_dtype="uint8",
+        rescale_limits=[(100, 4000), (0, 255)],
+    )
+    path = save_tiled_image(tmp_path, tiled_image)
+    assert path.suffix == DESCRIPTOR_SUFFIX
+    assert len(Nd2TiledImageDescriptor.load(path)) == 5
+
+    loaded = load_saved_tiled_image(path)
+    assert loaded.path == tiled_image.path
+    assert loaded.channel_names == tiled_image.channel_names
+    assert loaded.wavelength_ids == tiled_image.wavelength_ids
+    assert loaded.attributes == tiled_image.attributes
+    for tile, loaded_tile in zip(tiled_image.tiles, loaded.tiles, strict=True):
+        assert repr(loaded_tile) == repr(tile)
+        assert loaded_tile.origin == tile.origin
+        assert loaded_tile.shape == tile.shape
+        assert loaded_tile.pixel_size.t == tile.pixel_size.t
+        assert vars(loaded_tile._data_loader) == vars(tile._data_loader)
+
+
+def test_descriptor_round_trip_parsed_acquisition(temp_dir, tmp_path):
+    # the tiled images built from nd2 files are named after the nd2 Path
+    tiled_images = parse_nd2_acquisition(
+        acq_path=temp_dir / "WellPlate_Jobs_3w6p2c0z0t_overlap",
+        plate_name="test_plate",
+        acquisition_id=0,
+    )
+    for tiled_image in tiled_images:
+        path = save_tiled_image(tmp_path, tiled_image)
+        assert path.suffix == DESCRIPTOR_SUFFIX
+
+        loaded = load_saved_tiled_image(path)
+        assert loaded.path == tiled_image.path
+        assert str(loaded._name) == str(tiled_image._name)
+        for tile, loaded_tile in zip(tiled_image.tiles, loaded.tiles, strict=True):
+            assert repr(loaded_tile) == repr(tile)
+            npt.assert_array_equal(loaded_tile.load(), tile.load())
+
+
+def test_descriptor_fallback(tmp_path):
+    # tiles not loaded from nd2 files are pickled
+    tiled_image = _tiled_image([np.zeros((1, 2, 1, 8, 8), dtype=np.uint16)])
+    assert Nd2TiledImageDescriptor.from_tiled_image(tiled_image) is None
+    path = save_tiled_image(tmp_path, tiled_image)
+    assert path.suffix == ".pkl"
+    assert len(load_saved_tiled_image(path).tiles) == 1
+
+    # tiles with different loader options are pickled
+    tiled_image = _nd2_tiled_image(num_tiles=2)
+    tiled_image.tiles[1]._data_loader.channels = [0]
+    assert Nd2TiledImageDescriptor.from_tiled_image(tiled_image) is None
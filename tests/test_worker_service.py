@@ -0,0 +1,111 @@
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from nd2_omezarr_converter import worker_service
+from nd2_omezarr_converter.convert_nd2_compute_task import convert_nd2_compute_task
+from nd2_omezarr_converter.init_utils import build_parallelization_list
+from nd2_omezarr_converter.profiling_utils import PROFILE_DIR_ENV, PROFILE_MODES_ENV
+from nd2_omezarr_converter.task_models import AdvancedOptions
+from nd2_omezarr_converter.worker_service import (
+    WORKER_SOCKET_ENV,
+    WorkerServer,
+    submit_job,
+)
+
+from .test_image_writers import _tiled_image
+
+
+@pytest.fixture
+def worker_socket():
+    # unix socket paths are limited to ~100 characters, keep it short
+    with tempfile.TemporaryDirectory(dir="/tmp") as tmp_dir:
+        socket_path = Path(tmp_dir) / "nd2.sock"
+        with WorkerServer(socket_path) as server:
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            yield socket_path
+            server.shutdown()
+            thread.join()
+        assert not socket_path.exists()
+
+
+def _parallelization_list(zarr_dir, num_images):
+    tiled_images = [
+        _tiled_image([np.ones((1, 2, 1, 16, 16), dtype=np.uint16)], path=f"im_{i}")
+        for i in range(num_images)
+    ]
+    return build_parallelization_list(
+        zarr_dir=zarr_dir,
+        tiled_images=tiled_images,
+        overwrite=False,
+        advanced_compute_options=AdvancedOptions(tiling_mode="none", num_levels=1),
+    )
+
+
+def test_worker_service(tmp_path, worker_socket, monkeypatch):
+    first, second = _parallelization_list(tmp_path, num_images=2)
+    result = submit_job(worker_socket, **first)
+    assert result["image_list_updates"][0]["zarr_url"] == first["zarr_url"]
+    assert Path(first["zarr_url"]).exists()
+
+    # the compute task forwards the job to the service
+    monkeypatch.setenv(WORKER_SOCKET_ENV, str(worker_socket))
+    result = convert_nd2_compute_task(**second)
+    assert result["image_list_updates"][0]["zarr_url"] == second["zarr_url"]
+
+    # failed jobs are reported to the client
+    with pytest.raises(RuntimeError, match="ValidationError"):
+        submit_job(worker_socket, zarr_url=first["zarr_url"], init_args={})
+
+
+def test_worker_service_one_job_at_a_time(tmp_path, worker_socket, monkeypatch):
+    # jobs share process-wide state, the service must not run them concurrently
+    compute = worker_service.compute_batched_tiled_images
+    running = []
+    max_running = 0
+
+    def compute_and_count(**kwargs):
+        nonlocal max_running
+        running.append(None)
+        max_running = max(max_running, len(running))
+        time.sleep(0.2)
+        result = compute(**kwargs)
+        running.pop()
+        return result
+
+    monkeypatch.setattr(
+        worker_service, "compute_batched_tiled_images", compute_and_count
+    )
+    task_args = _parallelization_list(tmp_path, num_images=3)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(
+            executor.map(lambda args: submit_job(worker_socket, **args), task_args)
+        )
+    assert len(results) == 3
+    assert max_running == 1
+
+
+def test_worker_service_profiling(tmp_path, worker_socket, monkeypatch):
+    first, second = _parallelization_list(tmp_path / "zarr", num_images=2)
+    # the profiling settings of the job are used, not the ones of the service
+    monkeypatch.delenv(PROFILE_DIR_ENV, raising=False)
+    settings = {PROFILE_DIR_ENV: str(tmp_path / "job"), PROFILE_MODES_ENV: "memory"}
+    submit_job(worker_socket, **first, profile_settings=settings)
+    assert (tmp_path / "job" / "im_0.memory.txt").exists()
+
+    monkeypatch.setenv(PROFILE_DIR_ENV, str(tmp_path / "env"))
+    submit_job(worker_socket, **second, profile_settings={})
+    assert not (tmp_path / "env").exists()
+
+
+def test_worker_service_unreachable(tmp_path, monkeypatch):
+    (task_args,) = _parallelization_list(tmp_path, num_images=1)
+    monkeypatch.setenv(WORKER_SOCKET_ENV, str(tmp_path / "missing.sock"))
+    result = convert_nd2_compute_task(**task_args)
+    assert Path(result["image_list_updates"][0]["zarr_url"]).exists()